@@ -195,10 +195,11 @@ class ContractingClient:
             driver=Driver(),
             metering=False,
             compiler=ContractingCompiler(),
-            environment={}
+            environment={},
+            cache=None
     ):
 
-        self.executor = Executor(metering=metering, driver=driver)
+        self.executor = Executor(metering=metering, driver=driver, cache=cache)
         self.raw_driver = driver
         self.signer = signer
         self.compiler = compiler
@@ -0,0 +1,201 @@
+from contracting import constants
+from contracting.execution.parallel import WorkerPool, EXECUTOR_OPTIONS
+from contracting.storage.driver import COMPILED_KEY
+from contracting.storage.encoder import encode
+from collections import OrderedDict, Counter
+from concurrent.futures import Future
+from itertools import count
+from threading import Lock, BoundedSemaphore, Thread
+
+import hashlib
+
+# Estimates kept, by contract code hash, function, arguments and state version
+CACHE_SIZE = 4096
+
+# Estimates waiting for or running on a worker at a time, per worker. Further estimates wait for one to finish.
+PENDING_PER_WORKER = 16
+
+
+class StampEstimator:
+    """
+    Estimates the stamps transactions use, and the keys they read and write, on worker processes, so a burst of
+    estimates does not hold up executing blocks in this process.
+
+    Workers run a transaction the way executor would with bypass_balance_amount, on a snapshot of the committed state of
+    executor.driver. Every write to the store starts a new state version: estimates handed out after it read a new
+    snapshot and estimates of older versions are no longer served from the cache. Estimates already running finish on
+    the snapshot they started on.
+    """
+
+    def __init__(self, executor, workers=4, max_pending=None, cache_size=CACHE_SIZE, start_method="spawn"):
+        self.driver = executor.driver
+        options = {option: getattr(executor, option) for option in EXECUTOR_OPTIONS}
+        options.update(metering=True, bypass_balance_amount=True)
+        self.pool = WorkerPool(options, workers, start_method, self.__read, self.__scan)
+        self.workers = workers
+        self.slots = BoundedSemaphore(max_pending or workers * PENDING_PER_WORKER)
+        self.lock = Lock()
+
+        self.versions = count()
+        self.version = next(self.versions)
+        # {version: [snapshot, estimates running on it]}
+        self.snapshots = {}
+        # {index: (future, key, version)} of the estimates handed to each worker
+        self.running = []
+        self.futures = {}
+        self.indexes = count()
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.stats = Counter()
+        self.router = None
+
+    def start(self):
+        self.driver.backend.listeners.add(self)
+        self.version = next(self.versions)
+        self.running = [{} for _ in range(self.workers)]
+        self.pool.start()
+        self.router = Thread(target=self.__route, args=(self.pool.results,), daemon=True)
+        self.router.start()
+
+    def close(self):
+        if self.router is None:
+            return
+        self.driver.backend.listeners.discard(self)
+        self.pool.close()
+        self.pool.results.put((None, None))
+        self.router.join()
+        self.router = None
+        with self.lock:
+            for snapshot, _ in self.snapshots.values():
+                snapshot.close()
+            self.snapshots = {}
+            self.cache.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def invalidate(self, keys):
+        # Called by the backend after a write, maybe with its lock held, so it does not take self.lock
+        self.version = next(self.versions)
+
+    def __read(self, version, key):
+        return self.snapshots[version][0].get(key)
+
+    def __scan(self, version, prefix, length, cursor):
+        return self.snapshots[version][0].iter_prefix(prefix, length, cursor)
+
+    def __snapshot(self, version):
+        # Called with self.lock held
+        if version not in self.snapshots:
+            for old in [v for v, (_, running) in self.snapshots.items() if running == 0]:
+                self.snapshots.pop(old)[0].close()
+            self.snapshots[version] = [self.driver.snapshot(), 0]
+        return self.snapshots[version][0]
+
+    def __key(self, version, tx):
+        blob = self.__snapshot(version).get(self.driver.make_key(tx["contract_name"], COMPILED_KEY))
+        if blob is None:
+            return None
+        code_hash = hashlib.sha256(blob if type(blob) == bytes else blob.encode()).hexdigest()
+
+        try:
+            arguments = encode(tx["kwargs"]), encode(tx["environment"])
+        except TypeError:
+            return None
+        return (code_hash, tx["contract_name"], tx["function_name"], arguments, tx["sender"], tx["stamps"], version)
+
+    def estimate(self, sender, contract_name, function_name, kwargs, environment={},
+                 stamps=constants.DEFAULT_STAMPS, timeout=None) -> dict:
+        """
+        Runs a transaction on the committed state and returns a dict with its status_code, result, stamps_used, the
+        {key: value} it read before writing them as reads and the {key: value} it would write as writes. Waits up to
+        timeout seconds for a place if max_pending estimates are already pending.
+        """
+        if not self.pool.processes:
+            self.start()
+
+        tx = {"sender": sender, "contract_name": contract_name, "function_name": function_name, "kwargs": kwargs,
+              "environment": environment, "stamps": stamps}
+        slot = False
+        try:
+            while True:
+                with self.lock:
+                    version = self.version
+                    key = self.__key(version, tx)
+                    if key in self.cache:
+                        self.cache.move_to_end(key)
+                        self.stats["hits"] += 1
+                        return dict(self.cache[key])
+
+                    future = self.futures.get(key) if key is not None else None
+                    if future is None and slot:
+                        future = self.__dispatch(key, version, tx)
+                        slot = False
+                if future is not None:
+                    break
+
+                slot = self.slots.acquire(timeout=timeout)
+                assert slot, "Too many stamp estimates are pending."
+        finally:
+            if slot:
+                self.slots.release()
+
+        return dict(future.result(timeout))
+
+    def __dispatch(self, key, version, tx):
+        # Called with self.lock held and a slot taken, which is given back when the estimate is done
+        future = Future()
+        index = next(self.indexes)
+        worker = min(range(self.workers), key=lambda w: len(self.running[w]))
+
+        self.snapshots[version][1] += 1
+        self.running[worker][index] = (future, key, version)
+        if key is not None:
+            self.futures[key] = future
+        self.stats["estimates"] += 1
+
+        self.pool.send(worker, ("run", version, index, tx))
+        return future
+
+    def __finish(self, worker, index):
+        with self.lock:
+            future, key, version = self.running[worker].pop(index)
+            self.snapshots[version][1] -= 1
+            if key is not None:
+                self.futures.pop(key, None)
+        self.slots.release()
+        return future, key
+
+    def __route(self, results):
+        # Hands the results of the workers to the estimates waiting for them
+        while True:
+            worker, message = results.get()
+            if worker is None:
+                return
+
+            if message is None:
+                for index in list(self.running[worker]):
+                    future, _ = self.__finish(worker, index)
+                    future.set_exception(AssertionError("A worker of the stamp estimator stopped."))
+                continue
+
+            _, index, output, reads, _, _ = message
+            future, key = self.__finish(worker, index)
+            estimate = {
+                "status_code": output["status_code"],
+                "result": output["result"],
+                "stamps_used": output["stamps_used"],
+                "reads": reads,
+                "writes": output["writes"],
+            }
+            if key is not None:
+                with self.lock:
+                    self.cache[key] = estimate
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            future.set_result(estimate)
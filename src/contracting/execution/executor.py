@@ -1,15 +1,14 @@
 from contracting.execution import runtime
-from contracting.storage.driver import Driver
-from contracting.execution.module import install_database_loader, uninstall_builtins, enable_restricted_imports, disable_restricted_imports
+from contracting.storage.driver import Driver, ReadOnlyDriver, copy_value
+from contracting.execution.module import install_database_loader, uninstall_builtins, enable_restricted_imports, disable_restricted_imports, import_contract, DatabaseFinder, INSTANCE_CACHE
 from contracting.stdlib.bridge.decimal import ContractingDecimal, CONTEXT
 from contracting.stdlib.bridge.random import Seeded
 from contracting import constants
 from loguru import logger
 import re
-from copy import deepcopy
 
-import importlib
 import decimal
+import sys
 import traceback
 
 
@@ -22,13 +21,17 @@ class Executor:
                  balances_hash='balances',
                  bypass_privates=False,
                  bypass_balance_amount=False,
-                 bypass_cache=False):
+                 bypass_cache=False,
+                 cache=None,
+                 runtime_state=None):
 
         self.metering = metering
         self.driver = driver
 
         if not self.driver:
-            self.driver = Driver(bypass_cache=bypass_cache)
+            self.driver = Driver(bypass_cache=bypass_cache, cache=cache)
+        elif cache is not None:
+            self.driver.cache = cache
         self.production = production
 
         self.currency_contract = currency_contract
@@ -37,7 +40,14 @@ class Executor:
         self.bypass_privates = bypass_privates
         self.bypass_balance_amount = bypass_balance_amount  # For Stamp Estimation
 
-        runtime.rt.env.update({'__Driver': self.driver})
+        # Reads the committed state for queries, created on the first one
+        self.query_driver = None
+
+        # Transactions run in runtime_state, the state of the process unless one is given, and queries in their own
+        self.runtime_state = runtime_state if runtime_state is not None else runtime.DEFAULT_STATE
+        self.query_state = runtime.RuntimeState()
+
+        self.runtime_state.env.update({'__Driver': self.driver})
 
     def wipe_modules(self):
         uninstall_builtins()
@@ -51,25 +61,181 @@ class Executor:
                 stamp_cost=constants.STAMPS_PER_TAU,
                 metering=None) -> dict:
 
-        current_driver_pending_writes = deepcopy(self.driver.pending_writes)
-
         if not self.bypass_privates:
             assert not function_name.startswith(constants.PRIVATE_METHOD_PREFIX), 'Private method not callable.'
 
         if metering is None:
             metering = self.metering
 
-        runtime.rt.env.update({'__Driver': self.driver})
+        with runtime.rt.use(self.runtime_state), runtime.rt.lock:
+            runtime.rt.env.update({'__Driver': self.driver})
+
+            if driver:
+                runtime.rt.env.update({'__Driver': driver})
+            else:
+                driver = runtime.rt.env.get('__Driver')
 
-        if driver:
+            install_database_loader(driver=driver)
+
+            output = self.__execute(driver, sender, contract_name, function_name, kwargs, environment, auto_commit,
+                                    stamps, stamp_cost, metering)
+
+            runtime.rt.clean_up()
             runtime.rt.env.update({'__Driver': driver})
-        else:
-            driver = runtime.rt.env.get('__Driver')
 
-        install_database_loader(driver=driver)
+            disable_restricted_imports()
+        return output
+
+    def execute_batch(self, txs, environment={}, driver=None) -> list:
+        """
+        Executes txs, a list of keyword arguments for execute, one after the other and returns their outputs in order.
+        The outputs are the same as those of calling execute for each of them.
+
+        The database loader and the env are set up once for the batch, and contract modules stay imported from one
+        transaction to the next. Between transactions only the context and metering are reset, and the environment a
+        transaction added is taken out again. The writes of every transaction are still its own, and so is a failure.
+        environment is the environment of every transaction; the environment of a transaction is added to it. Queries
+        can run between the transactions.
+
+        A module an earlier transaction left imported is only used as it is where execute would bind it, see
+        import_contract. Importing it otherwise executes it again, see Runtime.unload_stale, and modules that are not
+        reusable do not stay imported.
+        """
+        driver = driver or self.driver
+        # Contract modules that stay imported for the next transactions
+        kept = set()
+
+        with runtime.rt.use(self.runtime_state), runtime.rt.lock:
+            runtime.rt.clean_up()
+            runtime.rt.env.update({'__Driver': driver})
+            runtime.rt.env.update(environment)
+            install_database_loader(driver=driver)
+            batch_env = dict(runtime.rt.env)
 
+        outputs = []
+        try:
+            for tx in txs:
+                tx = dict(tx)
+                contract_name = tx.pop('contract_name')
+                function_name = tx.pop('function_name')
+                tx_environment = tx.pop('environment', {})
+                metering = tx.pop('metering', None)
+
+                if not self.bypass_privates:
+                    assert not function_name.startswith(constants.PRIVATE_METHOD_PREFIX), 'Private method not callable.'
+
+                if metering is None:
+                    metering = self.metering
+
+                with runtime.rt.use(self.runtime_state), runtime.rt.lock:
+                    if DatabaseFinder.driver is not driver:
+                        # Something that ran in between, e.g. a query, installed the loader for another driver
+                        install_database_loader(driver=driver)
+
+                    outputs.append(self.__execute(driver, contract_name=contract_name, function_name=function_name,
+                                                  environment=tx_environment, metering=metering, **tx))
+
+                    for name in runtime.rt.loaded_modules:
+                        instance = INSTANCE_CACHE.get(name)
+                        if instance is not None and sys.modules.get(name) is instance.module:
+                            kept.add(name)
+                        else:
+                            # Its module level state may have been changed by the transaction
+                            sys.modules.pop(name, None)
+                            kept.discard(name)
+                    runtime.rt.loaded_modules.clear()
+
+                    for name in tx_environment:
+                        if name in batch_env:
+                            runtime.rt.env[name] = batch_env[name]
+                        else:
+                            runtime.rt.env.pop(name, None)
+
+                    runtime.rt.reset()
+                    disable_restricted_imports()
+        finally:
+            with runtime.rt.use(self.runtime_state), runtime.rt.lock:
+                runtime.rt.loaded_modules.extend(kept)
+                runtime.rt.clean_up()
+                runtime.rt.env.update({'__Driver': driver})
+                disable_restricted_imports()
+
+        return outputs
+
+    def query(self, contract_name, function_name, kwargs, signer=None, environment={}) -> dict:
+        """
+        Calls a function that only reads state, e.g. balance_of, on the committed state and returns a dict with the
+        status_code and result, as execute does. Writing state fails the query. Nothing is metered and no stamps are
+        deducted, so it does not need a sender with a balance.
+
+        Queries can be made from any thread. They read through a driver of their own, see ReadOnlyDriver, and run in a
+        runtime state of their own, so they do not touch the pending writes, the cache or the env transactions run
+        with, and they run in between the transactions of a block.
+
+        They do not run concurrently with transactions or with each other: contract modules, the import hook and the
+        database loader are shared by the process, so a query holds Runtime.lock as a transaction does. A query made
+        while a transaction runs waits for it to finish, and transactions wait for queries. bench_query.py measures
+        what that costs.
+        """
+        if not self.bypass_privates:
+            assert not function_name.startswith(constants.PRIVATE_METHOD_PREFIX), 'Private method not callable.'
+
+        with runtime.rt.use(self.query_state), runtime.rt.lock:
+            if self.query_driver is None or self.query_driver.backend is not self.driver.backend:
+                self.query_driver = ReadOnlyDriver(self.driver)
+            driver = self.query_driver
+            driver.pending_reads.clear()
+
+            runtime.rt.env.update({'__Driver': driver})
+            runtime.rt.env.update(environment)
+            install_database_loader(driver=driver)
+
+            try:
+                runtime.rt.context._base_state = {
+                    'signer': signer,
+                    'caller': signer,
+                    'this': contract_name,
+                    'entry': (contract_name, function_name),
+                    'owner': driver.get_owner(contract_name),
+                    'submission_name': None
+                }
+
+                if runtime.rt.context.owner is not None and runtime.rt.context.owner != runtime.rt.context.caller:
+                    raise Exception(f'Caller {runtime.rt.context.caller} is not the owner {runtime.rt.context.owner}!')
+
+                decimal.setcontext(CONTEXT)
+
+                module = import_contract(contract_name)
+                func = getattr(module, function_name)
+
+                kwargs = {k: ContractingDecimal(str(v)) if type(v) == float else v for k, v in kwargs.items()}
+
+                runtime.rt.context._reset()
+                enable_restricted_imports()
+                result = func(**kwargs)
+                status_code = 0
+            except Exception as e:
+                result = e
+                status_code = 1
+            finally:
+                disable_restricted_imports()
+                Seeded.s = False
+                runtime.rt.clean_up()
+                install_database_loader(driver=self.runtime_state.env.get('__Driver') or self.driver)
+
+        return {
+            'status_code': status_code,
+            'result': result
+        }
+
+    def __execute(self, driver, sender, contract_name, function_name, kwargs, environment={}, auto_commit=False,
+                  stamps=constants.DEFAULT_STAMPS, stamp_cost=constants.STAMPS_PER_TAU, metering=True) -> dict:
         balances_key = None
 
+        # Journals the keys this transaction touches, so reverting it and returning its writes does not copy the writes
+        # of the transactions before it
+        savepoint = driver.savepoint()
+
         try:
             if metering:
                 balances_key = (f'{self.currency_contract}'
@@ -114,7 +280,7 @@ class Executor:
 
             decimal.setcontext(CONTEXT)
 
-            module = importlib.import_module(contract_name)
+            module = import_contract(contract_name)
             func = getattr(module, function_name)
 
             # Add the contract name to the context on a submission call
@@ -139,8 +305,8 @@ class Executor:
             status_code = 1
 
             # Revert the writes if the transaction fails
-            driver.pending_writes = current_driver_pending_writes
-            
+            driver.rollback_to_savepoint(savepoint)
+
             if auto_commit:
                 driver.flush_cache()
 
@@ -177,16 +343,14 @@ class Executor:
                 driver.commit()
 
         Seeded.s = False
-        runtime.rt.clean_up()
-        runtime.rt.env.update({'__Driver': driver})
 
-        output = {
+        # The values are still pending, copied so later transactions that change them in place do not change these
+        writes = {key: copy_value(value) for key, value in driver.release_savepoint(savepoint).items()}
+
+        return {
             'status_code': status_code,
             'result': result,
             'stamps_used': stamps_used,
-            'writes': deepcopy(driver.pending_writes),
+            'writes': writes,
             'reads': driver.pending_reads
         }
-
-        disable_restricted_imports()
-        return output
@@ -0,0 +1,195 @@
+from contracting.execution.metering.tracer import cu_costs, MAX_STAMPS, MAX_CALL_COUNT, MEMORY_RSS
+from threading import get_ident, Lock
+
+import sys
+import weakref
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The sys.monitoring tool id metering uses, one that debuggers, coverage and profilers do not
+TOOL_ID = 3
+
+# Whether this Python has sys.monitoring (PEP 669), 3.12 and later
+AVAILABLE = hasattr(sys, "monitoring")
+
+# Lines between two reads of the memory the process uses, which is a system call
+MEMORY_SAMPLE_LINES = 1000
+
+# The most the maximum resident set size may grow during a transaction, in kilobytes, as the tracer allows on unix
+MAX_MEMORY = 500000
+
+# {thread id: MonitoringTracer} of the tracers that are started. Events are reported for all threads.
+_started = {}
+_lock = Lock()
+
+# {code object: (cost of the instruction at each byte offset, line of each byte offset)} for contract code
+_tables = weakref.WeakKeyDictionary()
+
+
+def cost_table(code):
+    """
+    The cost of every instruction of code by byte offset, as the tracer looks it up. It reads opcodes as signed chars,
+    so an opcode above 127 costs what the opcode 256 minus it does.
+    """
+    return [cu_costs[op if op < 128 else 256 - op] for op in code.co_code]
+
+
+def line_table(code):
+    lines = [None] * len(code.co_code)
+    for start, end, line in code.co_lines():
+        lines[start:end] = [line] * (end - start)
+    return lines
+
+
+def _on_start(code, offset):
+    # The first call of every code object. Contract code reports lines from then on, other code never again.
+    frame = sys._getframe(1)
+    if frame.f_globals.get("__contract__") is True:
+        # Equal code objects, e.g. of a contract that was executed again, share tables but not their events
+        if code not in _tables:
+            _tables[code] = (cost_table(code), line_table(code))
+        sys.monitoring.set_local_events(TOOL_ID, code, sys.monitoring.events.LINE | sys.monitoring.events.JUMP)
+    return sys.monitoring.DISABLE
+
+
+def _on_line(code, line):
+    tracer = _started.get(get_ident())
+    if tracer is None:
+        return
+    tracer.line(code, sys._getframe(1).f_lasti)
+
+
+def _on_jump(code, source, destination):
+    # A trace function sees a line again when a loop jumps back within it, e.g. in a comprehension
+    if destination > source:
+        return sys.monitoring.DISABLE
+    lines = _tables[code][1]
+    if lines[source] != lines[destination]:
+        # The line event of the destination is reported as such
+        return sys.monitoring.DISABLE
+
+    tracer = _started.get(get_ident())
+    if tracer is None:
+        return
+    tracer.line(code, sys._getframe(1).f_lasti)
+
+
+class MonitoringTracer:
+    """
+    Meters contract code like contracting.execution.metering.tracer.Tracer and has its methods, with sys.monitoring
+    instead of a trace function. Only the code objects of contracts report events: other code reports its first call and
+    is then left alone, so library code and the interpreter's fast paths cost nothing while a transaction is metered.
+
+    Every line, and every jump back within the same line, costs the same as with the tracer, so the stamps used are the
+    same. Events are counted per line of contract code rather than per trace event of any code, and the memory the
+    process uses is read every MEMORY_SAMPLE_LINES lines instead of on every line.
+    """
+
+    def __init__(self):
+        assert AVAILABLE, "Metering with sys.monitoring needs Python 3.12 or later."
+        self.cost = 0
+        self.stamp_supplied = 0
+        self.started = 0
+        self.call_count = 0
+        self.last_frame_mem_usage = 0
+        self.total_mem_usage = 0
+
+    def start(self):
+        self.cost = 0
+        self.call_count = 0
+        self.started = 1
+        with _lock:
+            if not _started:
+                install()
+            _started[get_ident()] = self
+
+    def stop(self):
+        if self.started:
+            self.started = 0
+            with _lock:
+                if _started.get(get_ident()) is self:
+                    del _started[get_ident()]
+                if not _started:
+                    uninstall()
+
+    def reset(self):
+        self.cost = 0
+        self.stamp_supplied = 0
+        self.started = 0
+        self.last_frame_mem_usage = 0
+        self.total_mem_usage = 0
+
+    def set_stamp(self, stamps):
+        self.stamp_supplied = stamps
+
+    def add_cost(self, cost):
+        self.cost += cost
+        if self.cost > self.stamp_supplied:
+            self.stop()
+            raise AssertionError("The cost has exceeded the stamp supplied!\n")
+
+    def get_stamp_used(self):
+        return self.cost
+
+    def get_last_frame_mem_usage(self):
+        return self.last_frame_mem_usage
+
+    def get_total_mem_usage(self):
+        return self.total_mem_usage
+
+    def set_memory_metering(self, mode):
+        assert mode == MEMORY_RSS, "Only the tracer engine can meter memory by allocations."
+
+    def get_peak_mem_allocated(self):
+        return 0
+
+    def get_total_mem_allocated(self):
+        return 0
+
+    def is_started(self):
+        return self.started
+
+    def line(self, code, offset):
+        self.call_count += 1
+        if self.call_count > MAX_CALL_COUNT:
+            self.stop()
+            raise AssertionError("Call count exceeded threshold! Infinite Loop?")
+
+        if self.cost > self.stamp_supplied or self.cost > MAX_STAMPS:
+            self.stop()
+            raise AssertionError("The cost has exceeded the stamp supplied!")
+
+        if resource is not None and self.call_count % MEMORY_SAMPLE_LINES == 1:
+            self.sample_memory()
+
+        self.cost += _tables[code][0][offset]
+
+    def sample_memory(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.last_frame_mem_usage and usage > self.last_frame_mem_usage:
+            self.total_mem_usage += usage - self.last_frame_mem_usage
+        self.last_frame_mem_usage = usage
+
+        if self.total_mem_usage > MAX_MEMORY:
+            self.stop()
+            raise AssertionError(f"Transaction exceeded memory usage! Total usage: {self.total_mem_usage} kilobytes")
+
+
+def install():
+    # Called with _lock held, when the first tracer starts
+    if sys.monitoring.get_tool(TOOL_ID) is None:
+        sys.monitoring.use_tool_id(TOOL_ID, "contracting")
+    sys.monitoring.register_callback(TOOL_ID, sys.monitoring.events.PY_START, _on_start)
+    sys.monitoring.register_callback(TOOL_ID, sys.monitoring.events.LINE, _on_line)
+    sys.monitoring.register_callback(TOOL_ID, sys.monitoring.events.JUMP, _on_jump)
+    sys.monitoring.set_events(TOOL_ID, sys.monitoring.events.PY_START)
+
+
+def uninstall():
+    # Called with _lock held, when the last tracer stops. The lines of contract code stay registered for the next one.
+    sys.monitoring.set_events(TOOL_ID, 0)
+    sys.monitoring.register_callback(TOOL_ID, sys.monitoring.events.LINE, None)
+    sys.monitoring.register_callback(TOOL_ID, sys.monitoring.events.JUMP, None)
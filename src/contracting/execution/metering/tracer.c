@@ -30,6 +30,8 @@
 
 #include <string.h>
 
+#include <stdint.h>
+
 /* Py 2.x and 3.x compatibility */
 
 #ifndef Py_TYPE
@@ -67,8 +69,50 @@ unsigned long long cu_costs[256] = {
 
 unsigned long long MAX_STAMPS = 6500000;
 
+/* Trace events a transaction may cause before it is taken for an infinite loop */
+#define MAX_CALL_COUNT 400000
+
+/* "__contract__", interned once, so looking it up in the globals of a frame allocates nothing */
+static PyObject * contract_key = NULL;
+
+/* The co_extra slot keeping the bytecode of a code object once a line of it is metered, or -1 without one */
+static Py_ssize_t code_extra_index = -1;
+
+/* How the memory of a transaction is metered: by the growth of the resident set of the process or by its allocations */
+#define MEMORY_RSS 0
+#define MEMORY_ALLOCATIONS 1
+
+/* The most a transaction may have allocated and not freed at once when its allocations are metered, in bytes */
+#define MAX_ALLOCATED 500000000ULL
+
+/* Slots the table of the blocks a transaction allocated starts with, a power of two */
+#define ALLOCATION_TABLE_SIZE 1024
+
+#ifdef _MSC_VER
+#define THREAD_LOCAL __declspec(thread)
+#else
+#define THREAD_LOCAL _Thread_local
+#endif
+
+#if PY_VERSION_HEX >= 0x030C0000
+#define Code_RequestExtraIndex PyUnstable_Eval_RequestCodeExtraIndex
+#define Code_GetExtra PyUnstable_Code_GetExtra
+#define Code_SetExtra PyUnstable_Code_SetExtra
+#else
+#define Code_RequestExtraIndex _PyEval_RequestCodeExtraIndex
+#define Code_GetExtra _PyCode_GetExtra
+#define Code_SetExtra _PyCode_SetExtra
+#endif
+
 /* The Tracer type. */
 
+/* A block of memory a transaction allocated */
+typedef struct {
+  void * ptr;
+  size_t size;
+}
+Allocation;
+
 typedef struct {
   PyObject_HEAD
 
@@ -80,9 +124,26 @@ typedef struct {
   int started;
   char * cu_cost_fname;
   unsigned long long call_count; // Add this line to track call counts
+
+  /* Memory metering by allocations, see set_memory_metering */
+  int memory_metering;
+  Allocation * allocations; // Open addressing table of the blocks allocated and not freed since start
+  size_t allocations_size;
+  size_t allocations_count;
+  unsigned long long allocated;
+  unsigned long long peak_allocated;
+  unsigned long long total_allocated;
 }
 Tracer;
 
+/* The tracer counting the allocations of this thread, if one is started with MEMORY_ALLOCATIONS */
+static THREAD_LOCAL Tracer * allocating = NULL;
+
+/* The allocators of the MEM and OBJ domains, which the hooks below wrap once installed */
+static PyMemAllocatorEx original_mem;
+static PyMemAllocatorEx original_obj;
+static int hooks_installed = 0;
+
 static int
 Tracer_init(Tracer * self, PyObject * args, PyObject * kwds) {
   //char *fname = getenv("CU_COST_FNAME");
@@ -94,6 +155,14 @@ Tracer_init(Tracer * self, PyObject * args, PyObject * kwds) {
   self -> last_frame_mem_usage = 0;
   self -> total_mem_usage = 0;
 
+  self -> memory_metering = MEMORY_RSS;
+  self -> allocations = NULL;
+  self -> allocations_size = 0;
+  self -> allocations_count = 0;
+  self -> allocated = 0;
+  self -> peak_allocated = 0;
+  self -> total_allocated = 0;
+
   return RET_OK;
 }
 
@@ -102,6 +171,10 @@ Tracer_dealloc(Tracer * self) {
   if (self -> started) {
     PyEval_SetTrace(NULL, NULL);
   }
+  if (allocating == self) {
+    allocating = NULL;
+  }
+  free(self -> allocations);
 
   Py_TYPE(self) -> tp_free((PyObject * ) self);
 }
@@ -123,11 +196,250 @@ static long get_memory_usage() {
 #endif
 }
 
+/*
+ * Allocation metering
+ *
+ * While a tracer is started with MEMORY_ALLOCATIONS, the allocators of the MEM and OBJ domains, which all Python
+ * objects are allocated with, count what its thread allocates and frees. The blocks allocated since start are kept in
+ * a table by address, taken from the C allocator so that keeping it is not counted, which tells the size of a block
+ * when it is freed. Blocks allocated before start and freed during the transaction are not taken off.
+ */
+
+static size_t
+allocation_slot(Tracer * self, void * ptr) {
+  uint64_t h = (uint64_t)(uintptr_t) ptr;
+  h ^= h >> 17;
+  h *= 0x9E3779B97F4A7C15ULL;
+  h ^= h >> 29;
+  return (size_t) h & (self -> allocations_size - 1);
+}
+
+static size_t
+find_allocation(Tracer * self, void * ptr) {
+  size_t i = allocation_slot(self, ptr);
+  while (self -> allocations[i].ptr != NULL) {
+    if (self -> allocations[i].ptr == ptr) {
+      return i;
+    }
+    i = (i + 1) & (self -> allocations_size - 1);
+  }
+  return self -> allocations_size;
+}
+
+static int
+grow_allocations(Tracer * self) {
+  size_t old_size = self -> allocations_size;
+  Allocation * old = self -> allocations;
+  Allocation * table = calloc(old_size * 2, sizeof(Allocation));
+  if (table == NULL) {
+    return -1;
+  }
+
+  self -> allocations = table;
+  self -> allocations_size = old_size * 2;
+  for (size_t i = 0; i < old_size; i++) {
+    if (old[i].ptr != NULL) {
+      size_t j = allocation_slot(self, old[i].ptr);
+      while (table[j].ptr != NULL) {
+        j = (j + 1) & (self -> allocations_size - 1);
+      }
+      table[j] = old[i];
+    }
+  }
+  free(old);
+  return 0;
+}
+
+static void
+remove_allocation(Tracer * self, size_t i) {
+  // Moves the blocks after i that probed past it back, so no lookup stops at the emptied slot
+  size_t mask = self -> allocations_size - 1;
+  size_t j = i;
+  for (;;) {
+    j = (j + 1) & mask;
+    if (self -> allocations[j].ptr == NULL) {
+      break;
+    }
+    size_t k = allocation_slot(self, self -> allocations[j].ptr);
+    if ((j > i && (k <= i || k > j)) || (j < i && k <= i && k > j)) {
+      self -> allocations[i] = self -> allocations[j];
+      i = j;
+    }
+  }
+  self -> allocations[i].ptr = NULL;
+  self -> allocations_count--;
+}
+
+static void
+count_free(Tracer * self, void * ptr) {
+  size_t i = find_allocation(self, ptr);
+  if (i < self -> allocations_size) {
+    self -> allocated -= self -> allocations[i].size;
+    remove_allocation(self, i);
+  }
+}
+
+static void
+count_allocation(Tracer * self, void * ptr, size_t size, size_t freed) {
+  // freed is what a reallocated block had, which counts towards the total only once
+  self -> total_allocated += size > freed ? size - freed : 0;
+  self -> allocated += size;
+  if (self -> allocated > self -> peak_allocated) {
+    self -> peak_allocated = self -> allocated;
+  }
+
+  size_t i = find_allocation(self, ptr);
+  if (i < self -> allocations_size) {
+    // Freed by another thread and handed out again
+    self -> allocated -= self -> allocations[i].size;
+    self -> allocations[i].size = size;
+    return;
+  }
+
+  if ((self -> allocations_count + 1) * 3 > self -> allocations_size * 2 && grow_allocations(self) < 0) {
+    return; // Counted, but never taken off
+  }
+  i = allocation_slot(self, ptr);
+  while (self -> allocations[i].ptr != NULL) {
+    i = (i + 1) & (self -> allocations_size - 1);
+  }
+  self -> allocations[i].ptr = ptr;
+  self -> allocations[i].size = size;
+  self -> allocations_count++;
+}
+
+static void *
+hook_malloc(void * ctx, size_t size) {
+  PyMemAllocatorEx * alloc = (PyMemAllocatorEx * ) ctx;
+  void * ptr = alloc -> malloc(alloc -> ctx, size);
+  if (ptr != NULL && allocating != NULL) {
+    count_allocation(allocating, ptr, size, 0);
+  }
+  return ptr;
+}
+
+static void *
+hook_calloc(void * ctx, size_t nelem, size_t elsize) {
+  PyMemAllocatorEx * alloc = (PyMemAllocatorEx * ) ctx;
+  void * ptr = alloc -> calloc(alloc -> ctx, nelem, elsize);
+  if (ptr != NULL && allocating != NULL) {
+    count_allocation(allocating, ptr, nelem * elsize, 0);
+  }
+  return ptr;
+}
+
+static void *
+hook_realloc(void * ctx, void * ptr, size_t new_size) {
+  PyMemAllocatorEx * alloc = (PyMemAllocatorEx * ) ctx;
+  void * new_ptr = alloc -> realloc(alloc -> ctx, ptr, new_size);
+  if (new_ptr != NULL && allocating != NULL) {
+    size_t freed = 0;
+    if (ptr != NULL) {
+      size_t i = find_allocation(allocating, ptr);
+      if (i < allocating -> allocations_size) {
+        freed = allocating -> allocations[i].size;
+        allocating -> allocated -= freed;
+        remove_allocation(allocating, i);
+      }
+    }
+    count_allocation(allocating, new_ptr, new_size, freed);
+  }
+  return new_ptr;
+}
+
+static void
+hook_free(void * ctx, void * ptr) {
+  PyMemAllocatorEx * alloc = (PyMemAllocatorEx * ) ctx;
+  if (ptr != NULL && allocating != NULL) {
+    count_free(allocating, ptr);
+  }
+  alloc -> free(alloc -> ctx, ptr);
+}
+
+static void
+install_hooks(void) {
+  // Once installed, the hooks stay: with no tracer counting, they only check that
+  PyMemAllocatorEx hooks = {NULL, hook_malloc, hook_calloc, hook_realloc, hook_free};
+
+  PyMem_GetAllocator(PYMEM_DOMAIN_MEM, & original_mem);
+  hooks.ctx = & original_mem;
+  PyMem_SetAllocator(PYMEM_DOMAIN_MEM, & hooks);
+
+  PyMem_GetAllocator(PYMEM_DOMAIN_OBJ, & original_obj);
+  hooks.ctx = & original_obj;
+  PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, & hooks);
+
+  hooks_installed = 1;
+}
+
+static int
+start_allocations(Tracer * self) {
+  if (self -> allocations_size != ALLOCATION_TABLE_SIZE) {
+    // A table grown by a large transaction is not kept for the next ones
+    free(self -> allocations);
+    self -> allocations = calloc(ALLOCATION_TABLE_SIZE, sizeof(Allocation));
+    if (self -> allocations == NULL) {
+      self -> allocations_size = 0;
+      PyErr_NoMemory();
+      return -1;
+    }
+    self -> allocations_size = ALLOCATION_TABLE_SIZE;
+  } else {
+    memset(self -> allocations, 0, ALLOCATION_TABLE_SIZE * sizeof(Allocation));
+  }
+  self -> allocations_count = 0;
+  self -> allocated = 0;
+  self -> peak_allocated = 0;
+  self -> total_allocated = 0;
+
+  if (!hooks_installed) {
+    install_hooks();
+  }
+  allocating = self;
+  return 0;
+}
+
+static void
+free_code_bytes(void * bytes) {
+  Py_XDECREF((PyObject * ) bytes);
+}
+
+/*
+ * The bytecode of code as PyCode_GetCode returns it, with the opcodes the costs are for. It is kept in the co_extra
+ * slot of code, so it is made and looked up once per code object rather than on every line. Returns a borrowed
+ * reference.
+ */
+static PyObject *
+get_code_bytes(PyCodeObject * code) {
+  void * extra = NULL;
+  if (code_extra_index >= 0) {
+    if (Code_GetExtra((PyObject * ) code, code_extra_index, & extra) < 0) {
+      return NULL;
+    }
+    if (extra != NULL) {
+      return (PyObject * ) extra;
+    }
+  }
+
+  PyObject * bytes = PyCode_GetCode(code);
+  if (bytes == NULL) {
+    return NULL;
+  }
+  if (code_extra_index >= 0 && Code_SetExtra((PyObject * ) code, code_extra_index, bytes) == 0) {
+    return bytes; // The slot owns the reference
+  }
+  PyErr_Clear();
+
+  // Code keeps the bytes it returned cached itself, so they stay alive without this reference
+  Py_DECREF(bytes);
+  return bytes;
+}
+
 static int
 Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
     self->call_count++;
 
-    if (self->call_count > 400000) {
+    if (self->call_count > MAX_CALL_COUNT) {
         PyErr_SetString(PyExc_AssertionError, "Call count exceeded threshold! Infinite Loop?");
         PyEval_SetTrace(NULL, NULL); // Stop tracing
         self->started = 0; // Mark tracer as stopped
@@ -139,17 +451,15 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
     unsigned long long factor = 1000;
     const char * str;
     // IF, Frame object globals contains __contract__ and it is true, continue
-    PyObject * kv = PyUnicode_FromString("__contract__");
     PyObject * globals = PyFrame_GetGlobals(frame);
-    int t = PyDict_Contains(globals, kv);
+    int t = PyDict_Contains(globals, contract_key);
     Py_DECREF(globals);
-    Py_DECREF(kv);
 
     if (t != 1) {
       return RET_OK;
     }
 
-    if (self -> last_frame_mem_usage == 0) {
+    if (self -> memory_metering == MEMORY_RSS && self -> last_frame_mem_usage == 0) {
       self -> last_frame_mem_usage = get_memory_usage();
     }
 
@@ -157,9 +467,15 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
 
     switch (what) {
     case PyTrace_LINE: /* 2 */ {
-      PyObject * code = PyFrame_GetCode(frame); // Declare 'code' variable here
-      const char * str = PyBytes_AS_STRING(PyCode_GetCode((PyCodeObject * ) code));
+      PyCodeObject * code = PyFrame_GetCode(frame);
+      PyObject * bytes = get_code_bytes(code);
       Py_DECREF(code);
+      if (bytes == NULL) {
+        PyEval_SetTrace(NULL, NULL);
+        self -> started = 0;
+        return RET_ERROR;
+      }
+      const char * str = PyBytes_AS_STRING(bytes);
       int lasti = PyFrame_GetLasti(frame);
       opcode = str[lasti];
 
@@ -167,13 +483,15 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
       estimate = (self -> cost + cu_costs[opcode]) / factor;
       estimate = estimate + 1;
 
-      long new_memory_usage = get_memory_usage();
+      if (self -> memory_metering == MEMORY_RSS) {
+        long new_memory_usage = get_memory_usage();
 
-      if (new_memory_usage > self -> last_frame_mem_usage) {
-        self -> total_mem_usage += (new_memory_usage - self -> last_frame_mem_usage);
-      }
+        if (new_memory_usage > self -> last_frame_mem_usage) {
+          self -> total_mem_usage += (new_memory_usage - self -> last_frame_mem_usage);
+        }
 
-      self -> last_frame_mem_usage = new_memory_usage;
+        self -> last_frame_mem_usage = new_memory_usage;
+      }
 
       //estimate = estimate * factor;
       if ((self -> cost > self -> stamp_supplied) || self -> cost > MAX_STAMPS) {
@@ -194,6 +512,15 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
           self -> started = 0;
           return RET_ERROR;
         }
+
+        // The hooks keep the counts up to date, so checking them is all a line costs
+        if (self -> peak_allocated > MAX_ALLOCATED) {
+          PyErr_Format(PyExc_AssertionError, "Transaction exceeded memory usage! Peak allocated: %llu bytes",
+            self -> peak_allocated);
+          PyEval_SetTrace(NULL, NULL);
+          self -> started = 0;
+          return RET_ERROR;
+        }
         //printf("Opcode: %d\n Cost: %lld\n Total Cost: %lld\n", opcode, cu_costs[opcode], self -> cost);
         self -> cost += cu_costs[opcode];
         break;
@@ -207,6 +534,9 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
 
     static PyObject *
       Tracer_start(Tracer * self, PyObject * args) {
+        if (self -> memory_metering == MEMORY_ALLOCATIONS && start_allocations(self) < 0) {
+          return NULL;
+        }
         PyEval_SetTrace((Py_tracefunc) Tracer_trace, (PyObject * ) self);
         self -> cost = 0;
         self->call_count = 0;
@@ -220,6 +550,10 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
           PyEval_SetTrace(NULL, NULL);
           self -> started = 0;
         }
+        // Also after the trace function stopped the tracer, which leaves the allocations counted
+        if (allocating == self) {
+          allocating = NULL;
+        }
 
         return Py_BuildValue("");
       }
@@ -237,10 +571,30 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
         self -> started = 0;
         self -> last_frame_mem_usage = 0;
         self -> total_mem_usage = 0;
+        self -> peak_allocated = 0;
+        self -> total_allocated = 0;
 
         return Py_BuildValue("");
       }
 
+    static PyObject *
+      Tracer_set_memory_metering(Tracer * self, PyObject * args) {
+        int mode;
+        if (!PyArg_ParseTuple(args, "i", & mode)) {
+          return NULL;
+        }
+        if (mode != MEMORY_RSS && mode != MEMORY_ALLOCATIONS) {
+          PyErr_Format(PyExc_AssertionError, "Unknown memory metering mode %d!", mode);
+          return NULL;
+        }
+        if (self -> started) {
+          PyErr_SetString(PyExc_AssertionError, "Cannot change memory metering during a transaction!");
+          return NULL;
+        }
+        self -> memory_metering = mode;
+        return Py_BuildValue("");
+      }
+
     static PyObject *
       Tracer_add_cost(Tracer * self, PyObject * args, PyObject * kwds) {
         // This allows you to arbitrarily add to the cost variable from Python
@@ -274,6 +628,16 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
         return Py_BuildValue("L", self -> total_mem_usage);
       }
 
+    static PyObject *
+      Tracer_get_peak_mem_allocated(Tracer * self, PyObject * args, PyObject * kwds) {
+        return Py_BuildValue("K", self -> peak_allocated);
+      }
+
+    static PyObject *
+      Tracer_get_total_mem_allocated(Tracer * self, PyObject * args, PyObject * kwds) {
+        return Py_BuildValue("K", self -> total_allocated);
+      }
+
     static PyObject *
       Tracer_is_started(Tracer * self) {
         return Py_BuildValue("i", self -> started);
@@ -348,6 +712,27 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
         PyDoc_STR("Get the total memory usage after it's been completed")
       },
 
+      {
+        "set_memory_metering",
+        (PyCFunction) Tracer_set_memory_metering,
+        METH_VARARGS,
+        PyDoc_STR("Meter memory by the resident set (MEMORY_RSS) or by what is allocated (MEMORY_ALLOCATIONS)")
+      },
+
+      {
+        "get_peak_mem_allocated",
+        (PyCFunction) Tracer_get_peak_mem_allocated,
+        METH_VARARGS,
+        PyDoc_STR("Get the most bytes the transaction had allocated and not freed at once, with MEMORY_ALLOCATIONS")
+      },
+
+      {
+        "get_total_mem_allocated",
+        (PyCFunction) Tracer_get_total_mem_allocated,
+        METH_VARARGS,
+        PyDoc_STR("Get all the bytes the transaction allocated, with MEMORY_ALLOCATIONS")
+      },
+
       {
         "is_started",
         (PyCFunction) Tracer_is_started,
@@ -444,6 +829,29 @@ Tracer_trace(Tracer * self, PyFrameObject * frame, int what, PyObject * arg) {
         }
 
         PyModule_AddObject(mod, "Tracer", (PyObject * ) & TracerType);
+
+        contract_key = PyUnicode_InternFromString("__contract__");
+        if (contract_key == NULL) {
+          Py_DECREF(mod);
+          return NULL;
+        }
+        code_extra_index = Code_RequestExtraIndex(free_code_bytes);
+
+        /* The cost table and limits, for metering engines written in Python */
+        PyObject * costs = PyTuple_New(256);
+        if (costs == NULL) {
+          Py_DECREF(mod);
+          return NULL;
+        }
+        for (int i = 0; i < 256; i++) {
+          PyTuple_SET_ITEM(costs, i, PyLong_FromUnsignedLongLong(cu_costs[i]));
+        }
+        PyModule_AddObject(mod, "cu_costs", costs);
+        PyModule_AddObject(mod, "MAX_STAMPS", PyLong_FromUnsignedLongLong(MAX_STAMPS));
+        PyModule_AddIntConstant(mod, "MAX_CALL_COUNT", MAX_CALL_COUNT);
+        PyModule_AddIntConstant(mod, "MEMORY_RSS", MEMORY_RSS);
+        PyModule_AddIntConstant(mod, "MEMORY_ALLOCATIONS", MEMORY_ALLOCATIONS);
+        PyModule_AddObject(mod, "MAX_ALLOCATED", PyLong_FromUnsignedLongLong(MAX_ALLOCATED));
         return mod;
       }
 
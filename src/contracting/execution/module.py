@@ -1,13 +1,19 @@
 from importlib.abc import Loader
 from importlib import invalidate_caches, __import__
 from importlib.machinery import ModuleSpec
-from contracting.storage.driver import Driver
+from contracting.storage.driver import Driver, CONTRACT_LISTENERS
 from contracting.stdlib import env
 from contracting.execution.runtime import rt
+from contracting.execution.module_cache import CODE_CACHE
+from contracting.storage.orm import Datum, Variable, Hash
+from contracting.storage.contract import Contract
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from contracting.stdlib.bridge.time import Datetime, Timedelta
 
-import marshal
+import types
 import builtins
 import sys
+import importlib
 import importlib.util
 
 # This function overrides the __import__ function, which is the builtin function that is called whenever Python runs
@@ -27,6 +33,7 @@ def is_valid_import(name):
 
 def restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
     if globals is not None and globals.get('__contract__') is True:
+        rt.unload_stale(name)
         spec = importlib.util.find_spec(name)
         if spec is None or not isinstance(spec.loader, DatabaseLoader):
             raise ImportError("module {} cannot be imported in a smart contract.".format(name))
@@ -63,6 +70,55 @@ def uninstall_database_loader():
         sys.meta_path.remove(DatabaseFinder)
 
 
+# Module level values of these types can not be changed by a transaction
+IMMUTABLE_TYPES = (int, float, str, bytes, bool, type(None), ContractingDecimal, Datetime, Timedelta)
+
+
+def is_immutable(value):
+    if isinstance(value, tuple):
+        return all(is_immutable(v) for v in value)
+    return isinstance(value, IMMUTABLE_TYPES)
+
+
+def is_reusable(module, seen=None):
+    """
+    Returns whether a contract module can run more than one transaction: whether everything it defines at module level
+    is a function, an ORM object or a value no transaction can change, so running a transaction leaves it as it was.
+    Names that come from the stdlib env or rt.env are not looked at.
+    """
+    seen = seen if seen is not None else set()
+    if id(module) in seen:
+        return True
+    seen.add(id(module))
+
+    # The stdlib, also under other names
+    gathered = {id(value) for value in env.gather().values()}
+    for name, value in vars(module).items():
+        if name.startswith('__') and name.endswith('__'):
+            continue
+        if id(value) in gathered or value is rt.env.get(name, object()):
+            continue
+
+        if isinstance(value, types.FunctionType):
+            # Exported functions are wrapped by __export
+            while value is not None:
+                kwdefaults = tuple((value.__kwdefaults__ or {}).values())
+                if not is_immutable(value.__defaults__) or not is_immutable(kwdefaults):
+                    return False
+                value = getattr(value, '__wrapped__', None)
+        elif isinstance(value, Hash):
+            if not is_immutable(value._default_value):
+                return False
+        elif isinstance(value, types.ModuleType):
+            spec = getattr(value, '__spec__', None)
+            if spec is None or not isinstance(spec.loader, DatabaseLoader) or not is_reusable(value, seen):
+                return False
+        elif not isinstance(value, (Variable, Contract)) and not is_immutable(value):
+            return False
+
+    return True
+
+
 def install_system_contracts(directory=''):
     pass
 
@@ -77,15 +133,11 @@ class DatabaseFinder:
     driver = Driver()
 
     def find_spec(self, fullname, path=None, target=None):
-        if MODULE_CACHE.get(self) is None:
-            if DatabaseFinder.driver.get_contract(self) is None:
-                return None
+        if CODE_CACHE.get(self, DatabaseFinder.driver, use=False) is None:
+            return None
         return ModuleSpec(self, DatabaseLoader(DatabaseFinder.driver))
 
 
-MODULE_CACHE = {}
-
-
 class DatabaseLoader(Loader):
     def __init__(self, d=Driver()):
         self.d = d
@@ -95,18 +147,7 @@ class DatabaseLoader(Loader):
 
     def exec_module(self, module):
         # fetch the individual contract
-        code = MODULE_CACHE.get(module.__name__)
-
-        if MODULE_CACHE.get(module.__name__) is None:
-            code = self.d.get_compiled(module.__name__)
-            if code is None:
-                raise ImportError("Module {} not found".format(module.__name__))
-
-            if type(code) != bytes:
-                code = bytes.fromhex(code)
-
-            code = marshal.loads(code)
-            MODULE_CACHE[module.__name__] = code
+        code = CODE_CACHE.get(module.__name__, self.d)
 
         if code is None:
             raise ImportError("Module {} not found".format(module.__name__))
@@ -115,6 +156,7 @@ class DatabaseLoader(Loader):
         scope.update(rt.env)
 
         scope.update({'__contract__': True})
+        before = dict(scope)
 
         # execute the module with the std env and update the module to pass forward
         exec(code, scope)
@@ -123,7 +165,107 @@ class DatabaseLoader(Loader):
         vars(module).update(scope)
         del vars(module)['__builtins__']
 
+        defined = {name for name, value in scope.items() if name not in before or before[name] is not value}
+        module.__instance__ = ContractInstance(module, code, scope, defined, rt.env)
+
         rt.loaded_modules.append(module.__name__)
 
     def module_repr(self, module):
         return '<module {!r} (smart contract)>'.format(module.__name__)
+
+
+class ContractInstance:
+    """
+    An executed contract module, with what its scope got from the env and what the module defined itself, so it can be
+    bound to the driver and env of another transaction instead of being executed again.
+    """
+
+    def __init__(self, module, code, scope, defined, environment):
+        self.module = module
+        self.code = code
+        self.scope = scope
+        self.defined = defined
+        self.environment = {name: value for name, value in environment.items() if name not in defined}
+        self.driver = environment.get('__Driver')
+
+    def imports(self, seen=None):
+        """
+        Yields this instance and the instances of the contracts it imports, and so on.
+        """
+        seen = seen if seen is not None else set()
+        if self.module.__name__ in seen:
+            return
+        seen.add(self.module.__name__)
+
+        yield self
+        for name in self.defined:
+            if isinstance(self.scope[name], types.ModuleType) and hasattr(self.scope[name], '__instance__'):
+                yield from self.scope[name].__instance__.imports(seen)
+
+    def bind(self, environment):
+        """
+        Makes the module what executing it with environment as rt.env would have made it.
+        """
+        gathered = None
+        for name in self.environment.keys() - environment.keys():
+            gathered = gathered if gathered is not None else env.gather()
+            for values in (self.scope, vars(self.module)):
+                if name in gathered:
+                    values[name] = gathered[name]
+                else:
+                    values.pop(name, None)
+
+        for name, value in environment.items():
+            if name not in self.defined:
+                self.scope[name] = value
+                vars(self.module)[name] = value
+        self.environment = {name: value for name, value in environment.items() if name not in self.defined}
+
+        driver = environment.get('__Driver')
+        if driver is not self.driver:
+            for name in self.defined:
+                if isinstance(self.scope[name], (Datum, Contract)):
+                    self.scope[name]._driver = driver
+            self.driver = driver
+
+
+# Contract modules that can run more than one transaction, by name, see import_contract
+INSTANCE_CACHE = {}
+
+
+def import_contract(name):
+    """
+    Imports the module of contract name for a transaction. A module that was imported before, from the same code, and
+    that no transaction can change, see is_reusable, is bound to rt.env instead of being executed again. So are the
+    contracts it imports. Contracts that a transaction imports while it runs are always executed, as that is metered.
+    Otherwise the module and what it imports are executed, not taken from modules an earlier transaction left imported.
+    """
+    instance = INSTANCE_CACHE.get(name)
+    driver = rt.env.get('__Driver')
+    if instance is not None and driver is not None and instance.code is CODE_CACHE.get(name, driver):
+        for imported in instance.imports():
+            imported.bind(rt.env)
+            sys.modules[imported.module.__name__] = imported.module
+            rt.loaded_modules.append(imported.module.__name__)
+        return instance.module
+
+    rt.unload_stale(name)
+    for imported in INSTANCE_CACHE:
+        rt.unload_stale(imported)
+
+    module = importlib.import_module(name)
+    instance = getattr(module, '__instance__', None)
+    if instance is not None and instance.driver is not None and is_reusable(module):
+        INSTANCE_CACHE[name] = instance
+    return module
+
+
+def invalidate_contract(name):
+    """
+    Drops the cached instance of contract name, when it is set or deleted.
+    """
+    INSTANCE_CACHE.pop(name, None)
+    rt.unload_stale(name)
+
+
+CONTRACT_LISTENERS.append(invalidate_contract)
@@ -0,0 +1,117 @@
+from contracting.storage.driver import COMPILED_KEY, CONTRACT_LISTENERS
+from collections import OrderedDict, Counter
+from pathlib import Path
+from threading import RLock
+
+import json
+import marshal
+import os
+
+# Compiled contracts kept in memory
+CACHE_SIZE = 1024
+
+# Uses of each contract, saved by save_usage so warm_up can preload the most used ones after a restart
+USAGE_FILENAME = "code_usage.json"
+
+
+class CodeCache:
+    """
+    The compiled code of the size contracts used last, by contract name and hash of the compiled code.
+
+    A lookup reads the compiled code from the driver, which costs a dictionary lookup once the driver has cached it. It
+    is a read of the transaction like any other, metered and recorded in its reads. So code is never run for a contract
+    that was deleted or submitted again since, or that is different in another store, even when no one called
+    invalidate.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.lock = RLock()
+        # {(name, hash): (compiled code as stored, code object)} in least recently used order
+        self.entries = OrderedDict()
+        self.uses = Counter()
+        self.stats = Counter()
+
+    def get(self, name, driver, use=True):
+        """
+        Returns the code object of contract name in driver, or None if there is no such contract. With use=False the
+        lookup is not counted as a use of the contract.
+        """
+        if use:
+            with self.lock:
+                self.uses[name] += 1
+        return self.__load(name, driver.get(driver.make_key(name, COMPILED_KEY)))
+
+    def __load(self, name, blob):
+        if blob is None:
+            return None
+        if type(blob) != bytes:
+            blob = bytes.fromhex(blob)
+
+        key = (name, hash(blob))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is blob or entry[0] == blob):
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+
+        code = marshal.loads(blob)
+        with self.lock:
+            self.stats["misses"] += 1
+            self.entries[key] = (blob, code)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return code
+
+    def invalidate(self, name=None):
+        """
+        Drops the code of contract name, or of all contracts.
+        """
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if key[0] == name]:
+                del self.entries[key]
+
+    def most_used(self, n):
+        with self.lock:
+            return [name for name, _ in self.uses.most_common(n)]
+
+    def save_usage(self, path):
+        """
+        Writes the uses of each contract to path, next to it first so a crash does not leave half a file.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with self.lock:
+            uses = dict(self.uses)
+        with open(tmp_path, "w") as f:
+            json.dump(uses, f)
+        os.replace(tmp_path, path)
+
+    def warm_up(self, driver, n=None, path=None, names=None):
+        """
+        Loads the code of names, or of the n contracts most used according to the file save_usage wrote to path, e.g.
+        when a node starts. Returns the names of the contracts that were loaded.
+        """
+        n = n if n is not None else self.size
+        if names is None:
+            if path is None or not Path(path).is_file():
+                return []
+            with open(path) as f:
+                uses = Counter(json.load(f))
+            names = [name for name, _ in uses.most_common(n)]
+            with self.lock:
+                self.uses.update(uses)
+
+        # Not a read of any transaction
+        return [name for name in list(names)[:n]
+                if self.__load(name, driver.find(driver.make_key(name, COMPILED_KEY))) is not None]
+
+
+CODE_CACHE = CodeCache()
+CONTRACT_LISTENERS.append(CODE_CACHE.invalidate)
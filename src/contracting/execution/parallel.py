@@ -0,0 +1,337 @@
+from contracting.execution.executor import Executor
+from contracting.storage.backend import StorageBackend
+from contracting.storage.driver import Driver
+from collections import Counter
+from copy import deepcopy
+from threading import Lock, Thread
+
+import multiprocessing
+import pickle
+import queue
+
+# Transactions handed to a worker before it reports back, so a worker does not idle while its next one is sent
+IN_FLIGHT = 2
+
+# Executor options the workers are set up with
+EXECUTOR_OPTIONS = ("metering", "currency_contract", "balances_hash", "bypass_privates", "bypass_balance_amount")
+
+
+class RemoteBackend(StorageBackend):
+    """
+    The state of a block as the process that runs it sees it, read over a pipe. Workers never open the store.
+    """
+
+    def __init__(self, connection, inbox):
+        super().__init__()
+        self.connection = connection
+        # Messages that arrive while waiting for a reply, handled once the transaction is done
+        self.inbox = inbox
+        # The block being run, sent with every read
+        self.block = None
+
+    def __request(self, *message):
+        self.connection.send((message[0], self.block, *message[1:]))
+        while True:
+            reply = self.connection.recv()
+            if reply[0] == "reply":
+                return reply[1]
+            self.inbox.append(reply)
+
+    def get(self, key):
+        return self.__request("get", key)
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        return self.__request("scan", prefix, length, cursor)
+
+    def write(self, values, block_num=None):
+        raise AssertionError("Speculative execution can not write to the store.")
+
+    def flush(self):
+        raise AssertionError("Speculative execution can not write to the store.")
+
+
+class SpeculativeDriver(Driver):
+    """
+    Runs a transaction on top of the writes of the transactions committed before it, kept in pending_writes, and
+    records what it read: the keys it read before writing them and the prefixes it listed.
+    """
+
+    def __init__(self, backend):
+        super().__init__(backend=backend)
+        self.reads = {}
+        self.written = set()
+        self.scans = []
+
+    def find(self, key: str):
+        value = super().find(key)
+        if key not in self.reads and key not in self.written:
+            self.reads[key] = deepcopy(value) if isinstance(value, (dict, list)) else value
+        return value
+
+    def set(self, key, value):
+        super().set(key, value)
+        self.written.add(key)
+
+    def items(self, prefix=""):
+        self.scans.append(prefix)
+        return super().items(prefix)
+
+    def begin(self):
+        self.reads = {}
+        self.written = set()
+        self.scans = []
+        self.pending_reads = {}
+
+
+def picklable(value):
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return Exception(repr(value)) if isinstance(value, BaseException) else repr(value)
+
+
+def run_worker(connection, options):
+    inbox = []
+    driver = SpeculativeDriver(RemoteBackend(connection, inbox))
+    executor = Executor(driver=driver, **options)
+    block = None
+
+    while True:
+        message = inbox.pop(0) if inbox else connection.recv()
+        kind = message[0]
+
+        if kind == "stop":
+            return
+
+        if message[1] != block:
+            # Messages of a block come after all messages of the one before. Values cached from its state are stale.
+            block = message[1]
+            driver.backend.block = block
+            driver.pending_writes = {}
+            driver.cache.clear()
+
+        if kind == "commit":
+            driver.pending_writes.update(message[2])
+            continue
+
+        _, _, index, tx = message
+
+        driver.begin()
+        savepoint = driver.savepoint()
+        output = executor.execute(**tx)
+        driver.rollback_to_savepoint(savepoint)
+        driver.release_savepoint(savepoint)
+
+        # A result that can not be sent is replaced, and the transaction is not exact
+        result = output["result"]
+        output["result"] = picklable(result)
+        exact = output["result"] is result
+        connection.send(("done", index, output, driver.reads, list(driver.scans), exact))
+
+
+class WorkerPool:
+    """
+    Processes that run transactions with run_worker. Their reads are answered in this process by read(block, key) and
+    scan(block, prefix, length, cursor), with the block the worker is running, everything else they send is put in
+    results as (worker, message), and (worker, None) when a worker stopped. A transaction that is done is sent as
+    ("done", index, output, {key: value} read before written, prefixes listed, whether its result could be sent).
+    """
+
+    def __init__(self, options, workers, start_method, read, scan):
+        self.options = options
+        self.workers = workers
+        self.context = multiprocessing.get_context(start_method)
+        self.read = read
+        self.scan = scan
+        self.processes = []
+        self.connections = []
+        self.send_locks = []
+        self.results = queue.Queue()
+
+    def start(self):
+        self.results = queue.Queue()
+        for worker in range(self.workers):
+            connection, child = self.context.Pipe()
+            process = self.context.Process(target=run_worker, args=(child, self.options), daemon=True)
+            process.start()
+            child.close()
+
+            self.processes.append(process)
+            self.connections.append(connection)
+            self.send_locks.append(Lock())
+            Thread(target=self.__serve, args=(worker,), daemon=True).start()
+
+    def close(self):
+        for worker in range(len(self.connections)):
+            self.send(worker, ("stop",))
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.connections = []
+        self.send_locks = []
+
+    def send(self, worker, message):
+        with self.send_locks[worker]:
+            self.connections[worker].send(message)
+
+    def __serve(self, worker):
+        connection = self.connections[worker]
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                self.results.put((worker, None))
+                return
+
+            if message[0] == "get":
+                self.send(worker, ("reply", self.read(*message[1:])))
+            elif message[0] == "scan":
+                self.send(worker, ("reply", self.scan(*message[1:])))
+            else:
+                self.results.put((worker, message))
+
+
+class ParallelExecutor:
+    """
+    Executes the transactions of a block on several processes, with the same results as executing them one after the
+    other with executor, in the style of Block-STM.
+
+    Every transaction is run speculatively by a worker, on top of the writes of the transactions that were committed
+    when it was handed out. Transactions are committed in block order. A transaction that read a key or listed a prefix
+    that a transaction committed after it was handed out wrote to is run again on the exact state before it, so it
+    always commits what a serial run would have.
+
+    Workers read the state of the block from this process: the store and the pending writes of executor.driver, to
+    which every transaction that is committed is applied. When the block is done its writes and reads are pending in
+    executor.driver and its outputs are those of a serial run. A transaction whose result can not be sent from a worker
+    is run again in this process once all transactions before it are committed.
+    """
+
+    def __init__(self, executor, workers=4, start_method="spawn"):
+        self.executor = executor
+        self.driver = executor.driver
+        self.workers = workers
+        options = {option: getattr(executor, option) for option in EXECUTOR_OPTIONS}
+        self.pool = WorkerPool(options, workers, start_method, self.__read, self.__scan)
+        self.blocks = 0
+        self.stats = Counter()
+        # Held while the state of the block changes, so workers never read a transaction that is half applied
+        self.lock = Lock()
+
+    def start(self):
+        self.pool.start()
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __read(self, block, key):
+        with self.lock:
+            return self.driver.find(key)
+
+    def __scan(self, block, prefix, length, cursor):
+        keys = {key for key in self.driver.backend.iter_prefix(prefix)}
+        with self.lock:
+            for key, value in self.driver.pending_writes.items():
+                if key.startswith(prefix):
+                    if value is None:
+                        keys.discard(key)
+                    else:
+                        keys.add(key)
+
+        keys = sorted(key for key in keys if cursor is None or key > cursor)
+        return keys if length == 0 else keys[:length]
+
+    def execute_block(self, txs):
+        """
+        Executes txs, a list of keyword arguments for Executor.execute, and returns their outputs in order.
+        """
+        if not self.pool.processes:
+            self.start()
+
+        self.blocks += 1
+        block = self.blocks
+        txs = [{key: value for key, value in tx.items() if key != "auto_commit"} for tx in txs]
+
+        outputs = [None] * len(txs)
+        # index: (output, reads, scans, exact)
+        speculated = {}
+        # index: number of transactions committed when it was handed out
+        dispatched = {}
+        # The keys each committed transaction wrote
+        commit_log = []
+
+        busy = [0] * self.workers
+        next_tx = 0
+        retries = []
+
+        def dispatch(index):
+            worker = min(range(self.workers), key=lambda w: busy[w])
+            busy[worker] += 1
+            dispatched[index] = len(commit_log)
+            self.pool.send(worker, ("run", block, index, txs[index]))
+
+        def valid(index, reads, scans):
+            touched = {}
+            for keys in commit_log[dispatched[index]:]:
+                touched.update(dict.fromkeys(keys))
+            if not touched:
+                return True
+            if any(key in touched for key in reads):
+                return False
+            return not any(key.startswith(prefix) for prefix in scans for key in touched)
+
+        def commit(output):
+            # What executing it serially would have left pending, in the journal of open savepoints too
+            with self.lock:
+                self.driver.apply_writes(output["writes"], output["reads"])
+
+        while len(commit_log) < len(txs):
+            while retries and min(busy) < IN_FLIGHT:
+                dispatch(retries.pop(0))
+            while next_tx < len(txs) and min(busy) < IN_FLIGHT:
+                dispatch(next_tx)
+                next_tx += 1
+
+            worker, message = self.pool.results.get()
+            assert message is not None, "A worker of the parallel executor stopped."
+            _, index, output, reads, scans, exact = message
+            busy[worker] -= 1
+            self.stats["executions"] += 1
+            speculated[index] = (output, reads, scans, exact)
+
+            while len(commit_log) < len(txs) and len(commit_log) in speculated:
+                index = len(commit_log)
+                output, reads, scans, exact = speculated.pop(index)
+
+                if not valid(index, reads, scans):
+                    # Run again on the exact state before it, which makes it valid
+                    self.stats["retries"] += 1
+                    retries.append(index)
+                    break
+
+                if exact:
+                    commit(output)
+                else:
+                    # Everything before it is committed, so running it here is running it serially
+                    self.stats["local_executions"] += 1
+                    with self.lock:
+                        output = self.executor.execute(**txs[index])
+
+                outputs[index] = output
+                commit_log.append(list(output["writes"]))
+                for w in range(self.workers):
+                    self.pool.send(w, ("commit", block, output["writes"]))
+
+        # Serial outputs all hold the reads pending in the driver
+        for output in outputs:
+            output["reads"] = self.driver.pending_reads
+
+        return outputs
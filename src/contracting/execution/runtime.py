@@ -1,5 +1,9 @@
 from contracting import constants
-from contracting.execution.metering.tracer import Tracer
+from contracting.execution.metering.tracer import Tracer, MEMORY_RSS, MEMORY_ALLOCATIONS
+from contracting.execution.metering.monitoring import MonitoringTracer
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import RLock
 
 import contracting
 import sys
@@ -9,6 +13,8 @@ import os
 class Context:
     def __init__(self, base_state, maxlen=constants.RECURSION_LIMIT):
         self._state = []
+        # (driver, savepoint) opened for each state, so the writes of a call that fails can be undone on their own
+        self._savepoints = []
         self._base_state = base_state
         self._maxlen = maxlen
 
@@ -22,16 +28,28 @@ class Context:
             return self._base_state
         return self._state[-1]
 
-    def _add_state(self, state: dict):
+    def _add_state(self, state: dict, driver=None):
         if self._context_changed(state['this']) and len(self._state) < self._maxlen:
             self._state.append(state)
+            self._savepoints.append((driver, driver.savepoint()) if driver is not None else None)
 
-    def _pop_state(self):
+    def _pop_state(self, failed=False):
+        """
+        With failed=True the writes made since the state was added are rolled back.
+        """
         if len(self._state) > 0:
             self._state.pop(-1)
 
+            savepoint = self._savepoints.pop(-1)
+            if savepoint is not None:
+                driver, savepoint = savepoint
+                if failed:
+                    driver.rollback_to_savepoint(savepoint)
+                driver.release_savepoint(savepoint)
+
     def _reset(self):
         self._state = []
+        self._savepoints = []
 
     @property
     def this(self):
@@ -58,78 +76,245 @@ class Context:
         return self._get_state()['submission_name']
 
 
-_context = Context({
+class CurrentContext:
+    """
+    The context of the transaction running in the current execution, see Runtime.use. Contracts get it as ctx, so a
+    module that was executed in one execution sees the context of the next one.
+    """
+
+    @property
+    def this(self):
+        return rt.context.this
+
+    @property
+    def caller(self):
+        return rt.context.caller
+
+    @property
+    def signer(self):
+        return rt.context.signer
+
+    @property
+    def owner(self):
+        return rt.context.owner
+
+    @property
+    def entry(self):
+        return rt.context.entry
+
+    @property
+    def submission_name(self):
+        return rt.context.submission_name
+
+
+def base_state():
+    return {
         'this': None,
         'caller': None,
         'owner': None,
         'signer': None,
         'entry': None,
         'submission_name': None
-    })
+    }
+
+
+_context = Context(base_state())
 
 WRITE_MAX = 1024 * 128
 
+# {name: tracer class} of the engines that can meter transactions. monitoring needs Python 3.12 or later.
+METERING_ENGINES = {
+    'tracer': Tracer,
+    'monitoring': MonitoringTracer,
+}
 
-class Runtime:
-    cu_path = contracting.__path__[0]
-    cu_path = os.path.join(cu_path, 'execution', 'metering', 'cu_costs.const')
+# The engine of states that are not given one
+METERING = os.environ.get('CONTRACTING_METERING', 'tracer')
 
-    os.environ['CU_COST_FNAME'] = cu_path
+# {name: mode} of the ways the memory of a transaction can be metered: by the growth of the resident set of the process,
+# or by the bytes the transaction allocates, which only the tracer engine can count
+MEMORY_METERING_MODES = {
+    'rss': MEMORY_RSS,
+    'allocations': MEMORY_ALLOCATIONS,
+}
 
-    loaded_modules = []
+MEMORY_METERING = os.environ.get('CONTRACTING_MEMORY_METERING', 'rss')
 
-    env = {}
-    stamps = 0
 
-    writes = 0
+def memory_metering_mode(name):
+    assert name in MEMORY_METERING_MODES, f'Unknown memory metering {name}! Use one of {list(MEMORY_METERING_MODES)}.'
+    return MEMORY_METERING_MODES[name]
 
-    tracer = Tracer()
 
-    signer = None
+def new_tracer(metering, memory_metering=MEMORY_METERING):
+    assert metering in METERING_ENGINES, f'Unknown metering engine {metering}! Use one of {list(METERING_ENGINES)}.'
+    tracer = METERING_ENGINES[metering]()
+    tracer.set_memory_metering(memory_metering_mode(memory_metering))
+    return tracer
 
-    context = _context
 
-    @classmethod
-    def set_up(cls, stmps, meter):
-        if meter:
-            cls.stamps = stmps
-            cls.tracer.set_stamp(stmps)
-            cls.tracer.start()
+class RuntimeState:
+    """
+    What the runtime keeps for the transactions of one execution: their env, metering, context and the contract
+    modules they loaded. Executors that are given states of their own do not see each other's.
+    """
+
+    def __init__(self, context=None, metering=None, memory_metering=None):
+        self.loaded_modules = []
+        self.env = {}
+        self.stamps = 0
+        self.writes = 0
+        self.metering = metering or METERING
+        self.memory_metering = memory_metering or MEMORY_METERING
+        self.tracer = new_tracer(self.metering, self.memory_metering)
+        self.signer = None
+        self.context = context if context is not None else Context(base_state())
+
+
+# The state used where no other one was made current with Runtime.use
+DEFAULT_STATE = RuntimeState(_context)
+
+_state = ContextVar('runtime_state', default=DEFAULT_STATE)
+
+
+def state_property(name):
+    def get(self):
+        return getattr(_state.get(), name)
+
+    def set(self, value):
+        setattr(_state.get(), name, value)
+
+    return property(get, set)
+
 
-        cls.context._reset()
+class Runtime:
+    """
+    The runtime of the current execution. Its attributes are those of the RuntimeState that is current, DEFAULT_STATE
+    unless Runtime.use made another one current in this thread or task.
+
+    The contract modules in sys.modules, the import hook and the database loader are still shared by the whole process,
+    so lock is held while a transaction or query runs.
+    """
+
+    cu_path = contracting.__path__[0]
+    cu_path = os.path.join(cu_path, 'execution', 'metering', 'cu_costs.const')
+
+    os.environ['CU_COST_FNAME'] = cu_path
 
-    @classmethod
-    def clean_up(cls):
-        cls.tracer.stop()
-        cls.tracer.reset()
-        cls.stamps = 0
-        cls.writes = 0
+    loaded_modules = state_property('loaded_modules')
+    env = state_property('env')
+    stamps = state_property('stamps')
+    writes = state_property('writes')
+    tracer = state_property('tracer')
+    signer = state_property('signer')
+    context = state_property('context')
 
-        cls.signer = None
+    # Held while a transaction or query uses the runtime, so queries from other threads run in between transactions
+    lock = RLock()
 
-        for mod in cls.loaded_modules:
+    @property
+    def state(self):
+        return _state.get()
+
+    @contextmanager
+    def use(self, state):
+        """
+        Makes state the current one until the block is left.
+        """
+        token = _state.set(state)
+        try:
+            yield state
+        finally:
+            _state.reset(token)
+
+    def set_metering(self, metering):
+        """
+        Meters the next transactions of the current state with another engine, one of METERING_ENGINES.
+        """
+        state = _state.get()
+        assert not state.tracer.is_started(), 'Cannot change the metering engine during a transaction!'
+        state.tracer = new_tracer(metering, state.memory_metering)
+        state.metering = metering
+
+    def set_memory_metering(self, memory_metering):
+        """
+        Meters the memory of the next transactions of the current state another way, one of MEMORY_METERING_MODES.
+        """
+        state = _state.get()
+        state.tracer.set_memory_metering(memory_metering_mode(memory_metering))
+        state.memory_metering = memory_metering
+
+    def set_up(self, stmps, meter):
+        state = _state.get()
+        if meter:
+            state.stamps = stmps
+            state.tracer.set_stamp(stmps)
+            state.tracer.start()
+
+        state.context._reset()
+
+    def reset(self):
+        """
+        Resets the metering and context of a transaction. Unlike clean_up, it keeps the loaded modules and the env.
+        """
+        state = _state.get()
+        state.tracer.stop()
+        state.tracer.reset()
+        state.stamps = 0
+        state.writes = 0
+
+        state.signer = None
+        state.context._reset()
+
+    def unload_stale(self, name):
+        """
+        Removes contract module name from sys.modules if it is still imported for an earlier transaction, see
+        Executor.execute_batch, and not for the current one, so importing it executes it again, as after clean_up.
+        """
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, '__instance__') and name not in self.loaded_modules:
+            del sys.modules[name]
+
+    def clean_up(self):
+        self.reset()
+
+        state = _state.get()
+        for mod in state.loaded_modules:
             if sys.modules.get(mod) is not None:
                 del sys.modules[mod]
 
-        cls.loaded_modules = []
-        cls.env = {}
+        state.loaded_modules = []
+        state.env = {}
+
+    def savepoint(self):
+        """
+        Opens a savepoint on the driver of the running transaction, see Driver.savepoint.
+        """
+        return self.env['__Driver'].savepoint()
+
+    def rollback_to_savepoint(self, savepoint):
+        self.env['__Driver'].rollback_to_savepoint(savepoint)
+
+    def release_savepoint(self, savepoint):
+        return self.env['__Driver'].release_savepoint(savepoint)
 
-    @classmethod
-    def deduct_read(cls, key, value):
-        if cls.tracer.is_started():
+    def deduct_read(self, key, value):
+        tracer = _state.get().tracer
+        if tracer.is_started():
             cost = len(key) + len(value)
             cost *= constants.READ_COST_PER_BYTE
-            cls.tracer.add_cost(cost)
+            tracer.add_cost(cost)
 
-    @classmethod
-    def deduct_write(cls, key, value):
-        if key is not None and cls.tracer.is_started():
+    def deduct_write(self, key, value):
+        state = _state.get()
+        if key is not None and state.tracer.is_started():
             cost = len(key) + len(value)
-            cls.writes += cost
-            assert cls.writes < WRITE_MAX, 'You have exceeded the maximum write capacity per transaction!'
+            state.writes += cost
+            assert state.writes < WRITE_MAX, 'You have exceeded the maximum write capacity per transaction!'
 
             stamp_cost = cost * constants.WRITE_COST_PER_BYTE
-            cls.tracer.add_cost(stamp_cost)
+            state.tracer.add_cost(stamp_cost)
 
 
 rt = Runtime()
+ctx = CurrentContext()
@@ -1,4 +1,4 @@
-from contracting.execution.runtime import rt
+from contracting.execution.runtime import rt, ctx
 from contextlib import ContextDecorator
 from contracting.storage.driver import Driver
 from typing import Any
@@ -10,9 +10,10 @@ class __export(ContextDecorator):
 
     def __enter__(self, *args, **kwargs):
         driver = rt.env.get('__Driver') or Driver()
+        context = rt.context
 
-        if rt.context._context_changed(self.contract):
-            current_state = rt.context._get_state()
+        if context._context_changed(self.contract):
+            current_state = context._get_state()
 
             state = {
                 'owner': driver.get_owner(self.contract),
@@ -23,18 +24,19 @@ class __export(ContextDecorator):
                 'submission_name': current_state['submission_name']
             }
 
-            rt.context._add_state(state)
+            # A call into another contract gets its own savepoint, so its writes are undone if it fails
+            context._add_state(state, driver)
 
             if state['owner'] is not None and state['owner'] != state['caller']:
                 raise Exception('Caller is not the owner!')
 
-    def __exit__(self, *args, **kwargs):
-        rt.context._pop_state()
+    def __exit__(self, exc_type=None, *args, **kwargs):
+        rt.context._pop_state(failed=exc_type is not None)
 
 
 exports = {
     '__export': __export,
-    'ctx': rt.context,
+    'ctx': ctx,
     'rt': rt,
     'Any': Any
 }
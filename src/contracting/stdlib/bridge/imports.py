@@ -62,6 +62,7 @@ def import_module(name):
     if _driver.get_contract(name) is None:
         raise ImportError
 
+    rt.unload_stale(name)
     return importlib.import_module(name, package=None)
 
 
@@ -0,0 +1,258 @@
+from contracting import constants
+from contracting.storage.encoder import encode, decode
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from itertools import islice
+from threading import RLock
+
+import heapq
+import weakref
+
+# Keys read at a time when all state is streamed
+ITER_BATCH = 1000
+
+
+def prefix_upper_bound(prefix):
+    """
+    Returns the smallest string that is greater than every string starting with prefix, or None if there is none.
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def merge_changes(scan, changed, prefix="", length=0, cursor=None):
+    """
+    Lists the keys of a view of the state that differs from a backend only in the keys of changed, [(key, whether it
+    is in the view)] for the keys with prefix after cursor in order, as iter_prefix does. scan is the iter_prefix of
+    the backend. It is asked for length keys plus one for every changed key that is not in the view, as that many of
+    the keys it lists may be dropped, so a page costs a page.
+    """
+    dropped = sum(1 for _, present in changed if not present)
+    keys = scan(prefix, length + dropped if length else 0, cursor)
+
+    changed_keys = {key for key, _ in changed}
+    keys = heapq.merge((key for key in keys if key not in changed_keys), (key for key, present in changed if present))
+    return list(keys) if length == 0 else list(islice(keys, length))
+
+
+def is_run_state_key(key):
+    """
+    Run state is everything that does not belong to a contract: keys without a contract name and keys under a
+    contract name starting with '__'.
+    """
+    if constants.INDEX_SEPARATOR not in key:
+        return True
+    return key.startswith("__")
+
+
+class StorageBackend:
+    """
+    The store that Driver keeps committed state in.
+
+    Values are passed in and out decoded. A value of None in set_many deletes the key. iter_prefix yields keys in
+    sorted order and returns a list, cut off after length keys if length is not 0 and starting after the key cursor if
+    it is given, so a long scan can be continued from the last key of the previous page. Backends implement get, write,
+    iter_prefix and flush; snapshots and the rest are built on top of them here and may be overridden when the engine
+    can do better.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.snapshots = weakref.WeakSet()
+        self.stats = Counter()
+        # Objects with an invalidate(keys) method, e.g. drivers that cache values read from this backend
+        self.listeners = weakref.WeakSet()
+        # A contracting.storage.merkle.StateTree of the state, if one is kept
+        self.state_tree = None
+        # The open lock file of the tree, if this is the backend of the process that writes it, see open_backend
+        self.writer_lock = None
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
+
+    def get_raw(self, key):
+        """
+        Returns the value of key as it is encoded in the store, or None.
+        """
+        value = self.get(key)
+        return encode(value) if value is not None else None
+
+    def get_raw_many(self, keys):
+        return {key: self.get_raw(key) for key in keys}
+
+    def write(self, values, block_num=None):
+        raise NotImplementedError
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Remove all state.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def sync(self):
+        """
+        Make everything written so far durable.
+        """
+        pass
+
+    def set_many(self, values, block_num=None, source=None):
+        """
+        Write {key: value}. Every listener but source is told which keys changed.
+        """
+        if not values:
+            return
+
+        with self.lock:
+            for snapshot in list(self.snapshots):
+                snapshot.preserve(values.keys())
+            self.begin_write()
+            self.write(values, block_num)
+
+        self.notify(values, source)
+
+    def begin_write(self):
+        """
+        Called before state is written. The state tree is stale until it is notified of the write, and is marked so.
+        """
+        if self.state_tree is not None:
+            self.state_tree.begin()
+
+    def load(self, values, block_num=None):
+        """
+        Write {key: encoded value}, e.g. values that were streamed out of another store with iter_items.
+        """
+        self.set_many({key: decode(value) for key, value in values.items()}, block_num)
+
+    def iter_items(self, prefix="", batch=ITER_BATCH):
+        """
+        Yields (key, encoded value) for every key with prefix in key order. Only batch keys are held at a time, so all
+        state can be streamed in bounded memory.
+        """
+        cursor = None
+        while True:
+            keys = self.iter_prefix(prefix, batch, cursor)
+            values = self.get_raw_many(keys)
+            for key in keys:
+                if values[key] is not None:
+                    yield key, values[key]
+
+            if len(keys) < batch:
+                return
+            cursor = keys[-1]
+
+    def delete_many(self, keys, source=None):
+        self.set_many({key: None for key in keys}, source=source)
+
+    def notify(self, keys, source=None):
+        """
+        Pass the {key: value} that were written, or only the keys if the values are not at hand, or None when all
+        state may have changed.
+        """
+        for listener in list(self.listeners):
+            if listener is not source:
+                listener.invalidate(keys)
+
+    def is_file(self, filename):
+        """
+        Whether a top level key or any key of the contract named filename exists.
+        """
+        if self.get(filename) is not None:
+            return True
+        return len(self.iter_prefix(filename + constants.INDEX_SEPARATOR, length=1)) > 0
+
+    def flush_file(self, filename):
+        keys = self.iter_prefix(filename + constants.INDEX_SEPARATOR)
+        if self.get(filename) is not None:
+            keys.append(filename)
+        self.delete_many(keys)
+
+    def get_contract_files(self):
+        contracts = set()
+        for key in self.iter_prefix():
+            if not is_run_state_key(key):
+                contracts.add(key.split(constants.INDEX_SEPARATOR, 1)[0])
+        return sorted(contracts)
+
+    def snapshot(self):
+        """
+        Returns a read-only view of the state as it is now, unaffected by later writes.
+        """
+        snapshot = BackendSnapshot(self)
+        with self.lock:
+            self.snapshots.add(snapshot)
+        return snapshot
+
+    def get_all_contract_state(self):
+        return {key: self.get(key) for key in self.iter_prefix() if not is_run_state_key(key)}
+
+    def get_run_state(self):
+        return {key: self.get(key) for key in self.iter_prefix() if is_run_state_key(key)}
+
+
+class BackendSnapshot:
+    """
+    Copy-on-write view of a backend. Before a key is overwritten, the backend hands its current value to every open
+    snapshot, so a snapshot only holds the keys written since it was taken.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.preimages = {}
+        # The keys of preimages in order
+        self.changed = []
+
+    def preserve(self, keys):
+        # Called by the backend with its lock held
+        for key in keys:
+            if key not in self.preimages:
+                self.preimages[key] = self.backend.get(key)
+                insort(self.changed, key)
+
+    def get(self, key):
+        with self.backend.lock:
+            if key in self.preimages:
+                return self.preimages[key]
+            return self.backend.get(key)
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        with self.backend.lock:
+            if cursor is not None and cursor >= prefix:
+                start = bisect_right(self.changed, cursor)
+            else:
+                start = bisect_left(self.changed, prefix)
+
+            changed = []
+            for key in self.changed[start:]:
+                if not key.startswith(prefix):
+                    break
+                changed.append((key, self.preimages[key] is not None))
+
+            return merge_changes(self.backend.iter_prefix, changed, prefix, length, cursor)
+
+    def close(self):
+        with self.backend.lock:
+            self.backend.snapshots.discard(self)
+        self.preimages = {}
+        self.changed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,75 @@
+import hashlib
+import math
+import os
+import struct
+
+BITS_PER_KEY = 10
+HASHES = 7
+MIN_CAPACITY = 1024
+
+# capacity, count, number of hashes
+HEADER = struct.Struct("<QQB")
+
+
+class BloomFilter:
+    """
+    A set of keys that can answer "definitely not present". With BITS_PER_KEY bits and HASHES hashes per key the false
+    positive rate stays around 1% until more than capacity keys have been added.
+    """
+
+    def __init__(self, capacity=MIN_CAPACITY, hashes=HASHES, bits=None, count=0):
+        self.capacity = max(capacity, MIN_CAPACITY)
+        self.hashes = hashes
+        self.size = self.capacity * BITS_PER_KEY
+        self.bits = bits if bits is not None else bytearray(math.ceil(self.size / 8))
+        self.count = count
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self.__positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+    def to_bytes(self):
+        return HEADER.pack(self.capacity, self.count, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        capacity, count, hashes = HEADER.unpack_from(data)
+        return cls(capacity, hashes, bytearray(data[HEADER.size:]), count)
+
+    @classmethod
+    def from_keys(cls, keys):
+        keys = list(keys)
+        bloom = cls(capacity=2 * len(keys))
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def save(self, path):
+        # Written to a temporary file and renamed so a crash never leaves a partial filter
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
@@ -0,0 +1,186 @@
+from contracting import constants
+from collections import OrderedDict, Counter
+from threading import RLock
+
+import sys
+
+MAX_BYTES = 64 * 1024 * 1024
+# The share of MAX_BYTES a single contract may use
+CONTRACT_SHARE = 0.25
+
+# Rough per-entry overhead of the dictionaries that hold an entry
+ENTRY_OVERHEAD = 100
+
+
+def sizeof(value):
+    """
+    Estimates the memory a state value takes. Faster than encoding it and close enough to budget a cache with.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return 32
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def contract_of(key):
+    return key.split(constants.INDEX_SEPARATOR, 1)[0]
+
+
+class StateCache:
+    """
+    A read cache of state values bounded by an estimate of the bytes it holds rather than by a number of entries.
+
+    Contracts share a budget of max_bytes, evicted least recently used first, and no contract may use more than
+    contract_share of it. Contracts that are given a quota, e.g. the system contracts, have a budget of that many bytes
+    of their own instead, so no amount of traffic to other contracts evicts them.
+
+    None is a valid value and means the key is known not to exist. Use get(key, default) to tell it apart from a key
+    that is not cached.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, contract_share=CONTRACT_SHARE, quotas=None):
+        self.max_bytes = max_bytes
+        self.contract_share = contract_share
+        self.quotas = dict(quotas or {})
+
+        self.lock = RLock()
+        # {contract: OrderedDict of {key: value}} in least recently used order
+        self.contracts = {}
+        # Keys of the contracts on the shared budget, in least recently used order
+        self.shared = OrderedDict()
+        self.sizes = {}
+        self.contract_bytes = Counter()
+        self.shared_bytes = 0
+        self.bytes = 0
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def quota(self, contract):
+        return self.quotas.get(contract, self.max_bytes * self.contract_share)
+
+    def __remove(self, contract, key):
+        entries = self.contracts[contract]
+        value = entries.pop(key)
+        if not entries:
+            del self.contracts[contract]
+
+        size = self.sizes.pop(key)
+        self.bytes -= size
+        self.contract_bytes[contract] -= size
+        if self.contract_bytes[contract] <= 0:
+            del self.contract_bytes[contract]
+
+        if contract not in self.quotas:
+            del self.shared[key]
+            self.shared_bytes -= size
+
+        return value
+
+    def get(self, key, default=None):
+        contract = contract_of(key)
+        with self.lock:
+            entries = self.contracts.get(contract)
+            if entries is None or key not in entries:
+                self.misses += 1
+                return default
+
+            entries.move_to_end(key)
+            if contract not in self.quotas:
+                self.shared.move_to_end(key)
+
+            value = entries[key]
+            self.hits += 1
+            if value is None:
+                self.negative_hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        contract = contract_of(key)
+        shared = contract not in self.quotas
+        size = len(key) + sizeof(value) + ENTRY_OVERHEAD
+
+        with self.lock:
+            if key in self.sizes:
+                self.__remove(contract, key)
+
+            entries = self.contracts.get(contract)
+            if entries is None:
+                entries = self.contracts[contract] = OrderedDict()
+
+            entries[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+            self.contract_bytes[contract] += size
+            if shared:
+                self.shared[key] = None
+                self.shared_bytes += size
+
+            # The entry itself is kept even if it alone is over the budget
+            quota = self.quota(contract)
+            while self.contract_bytes[contract] > quota and len(entries) > 1:
+                self.__remove(contract, next(iter(entries)))
+                self.evictions += 1
+
+            while shared and self.shared_bytes > self.max_bytes and len(self.shared) > 1:
+                oldest = next(iter(self.shared))
+                self.__remove(contract_of(oldest), oldest)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.sizes:
+                raise KeyError(key)
+            self.__remove(contract_of(key), key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.sizes:
+                return default
+            return self.__remove(contract_of(key), key)
+
+    def __contains__(self, key):
+        return key in self.sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def items(self):
+        with self.lock:
+            return [(key, value) for entries in self.contracts.values() for key, value in entries.items()]
+
+    def clear(self):
+        with self.lock:
+            self.contracts.clear()
+            self.shared.clear()
+            self.sizes.clear()
+            self.contract_bytes.clear()
+            self.shared_bytes = 0
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "cache_hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "cache_misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.sizes),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "contract_bytes": dict(self.contract_bytes),
+        }
@@ -4,14 +4,15 @@ from contracting.stdlib.bridge.time import Datetime
 from contracting.stdlib.bridge.decimal import ContractingDecimal
 from datetime import datetime
 from pathlib import Path
-from cachetools import TTLCache
-from contracting import constants
-from contracting.storage import hdf5
+from copy import deepcopy
+from contracting.storage.cache import StateCache
+from contracting.storage.versions import MVCCBackend
+from contracting.storage.hdf5 import (HDF5Backend, open_backend, LAYOUT_KEY, LAYOUT_CONTRACT, LAYOUT_FILENAME,
+                                      SHARD_DELIMITER, MISC_FILENAME, escape_group, unescape_group, read_layout,
+                                      write_layout)
 
 import marshal
 import decimal
-import os
-import shutil
 
 FILE_EXT = ".d"
 HASH_EXT = ".x"
@@ -28,48 +29,97 @@ TIME_KEY = "__submitted__"
 COMPILED_KEY = "__compiled__"
 DEVELOPER_KEY = "__developer__"
 
+# Marks a key that is not in a cache, as opposed to a key that is cached as not existing (None)
+MISSING = object()
+
+# Called with the name of a contract whenever a driver sets or deletes one, so what is cached of its code can be dropped
+CONTRACT_LISTENERS = []
+
+
+def copy_value(value):
+    # Values that can be changed in place are copied, so changing what was read does not change where it was read from
+    return deepcopy(value) if isinstance(value, (dict, list)) else value
+
 
 class Driver:
-    def __init__(self, bypass_cache=False):
+    def __init__(self, bypass_cache=False, storage_home=STORAGE_HOME, layout=None, shards=None, backend=None,
+                 cache=None, wal=None, versions=None, retain=None, merkle=None):
+        """
+        State is kept in backend, an HDF5 tree in storage_home with the given layout by default. Any other
+        contracting.storage.backend.StorageBackend can be passed instead. Drivers on the same backend drop the values
+        they cached for keys the others write. With wal=True the tree is written through a write-ahead log, so a commit
+        costs one appended record and one fsync. With versions=True every value a key had is kept by block height and
+        can be read with get(key, at_height=...) or a snapshot, for the last retain heights if that is set. The height
+        is the block_num passed to hard_apply or commit, or the one after the latest if none is. With merkle=True a
+        Merkle tree of the contract state is updated on every commit, see state_root. Options left None are those the
+        tree was last opened with; see contracting.storage.hdf5.open_backend for trees another process writes.
+
+        Values read from the backend are kept in cache, a contracting.storage.cache.StateCache with the default budget
+        unless one is passed. Keys found missing are cached too. Drivers hear only of writes made in their own
+        process, so a tree is written by one process: any other process that reads it while it is written should pass
+        bypass_cache=True, and then sees what the writer commits, Bloom filters included.
+
+        A driver of the default tree with the options it is open with, Driver(), opens it when it is first used, so the
+        drivers made when contracting is imported open no storage. Other drivers open their tree right away, so
+        options that do not match how it is open fail here.
+        """
         self.pending_deltas = {}
         self.pending_writes = {}
         self.pending_reads = {}
-        self.cache = TTLCache(maxsize=1000, ttl=6*3600)
+        # Open savepoints, innermost last. Each is ({key: pending value before the savepoint}, {key: value written})
+        # for the keys touched since it was opened.
+        self.journal = []
+        self.cache = cache if cache is not None else StateCache()
         self.bypass_cache = bypass_cache
-        self.contract_state = STORAGE_HOME.joinpath("contract_state")
-        self.run_state = STORAGE_HOME.joinpath("run_state")
-        self.__build_directories()
-
-    def __build_directories(self):
-        self.contract_state.mkdir(exist_ok=True, parents=True)
-        self.run_state.mkdir(exist_ok=True, parents=True)
-
-    def __parse_key(self, key):
-        try:
-            filename, variable = key.split(constants.INDEX_SEPARATOR, 1)
-            variable = variable.replace(constants.DELIMITER, constants.HDF5_GROUP_SEPARATOR)
-        except ValueError:
-            filename = "__misc"
-            variable = key.replace(constants.DELIMITER, constants.HDF5_GROUP_SEPARATOR)
-        return filename, variable
-
-    def __filename_to_path(self, filename):
-        if filename.startswith("__"):
-            return str(self.run_state.joinpath(filename))
+        if backend is None:
+            self.__options = (storage_home, layout, shards, wal, versions, retain, merkle)
+            if storage_home != STORAGE_HOME or any(option is not None for option in self.__options[1:]):
+                self.__open()
         else:
-            return str(self.contract_state.joinpath(filename))
+            self.backend = backend
+            self.backend.listeners.add(self)
+
+    def __open(self):
+        self.backend = open_backend(*self.__options)
+        self.backend.listeners.add(self)
+        return self.backend
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, i.e. the backend of a driver that did not open it yet
+        if name == 'backend' and '_Driver__options' in self.__dict__:
+            return self.__open()
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def invalidate(self, keys=None):
+        """
+        Called by the backend when keys were written by someone else. None means all keys.
+        """
+        if keys is None:
+            self.cache.clear()
+            return
+        for key in keys:
+            self.cache.pop(key, None)
 
-    def __get_files(self):
-        return sorted(os.listdir(self.contract_state) + os.listdir(self.run_state))
-    
     def is_file(self, filename):
-        file_path = Path(self.__filename_to_path(filename))
-        return file_path.is_file()
+        return self.backend.is_file(filename)
+
+    def get(self, key: str, save: bool = True, at_height: int = None):
+        if at_height is not None:
+            # The state as it was committed at that height, without anything pending
+            assert isinstance(self.backend, MVCCBackend), "Reading at a height needs a backend that keeps versions."
+            value = self.backend.get_at(key, at_height)
+            if value is not None:
+                rt.deduct_read(*encode_kv(key, value))
+            return value
 
-    def get(self, key: str, save: bool = True):
         value = self.find(key)
         if save and self.pending_reads.get(key) is None:
             self.pending_reads[key] = value
+        if self.journal and isinstance(value, (dict, list)) and key in self.pending_writes:
+            # A pending value that is handed out can be changed in place, keep it as it is now
+            undo = self.journal[-1][0]
+            if key not in undo:
+                undo[key] = deepcopy(value)
         if value is not None:
             rt.deduct_read(*encode_kv(key, value))
         return value
@@ -80,64 +130,159 @@ class Driver:
             self.get(key)
         if type(value) in [decimal.Decimal, float]:
             value = ContractingDecimal(str(value))
+        if self.journal:
+            undo, writes = self.journal[-1]
+            if key not in undo:
+                undo[key] = self.pending_writes.get(key, MISSING)
+            writes[key] = value
         self.pending_writes[key] = value
 
+    def savepoint(self):
+        """
+        Opens a savepoint and returns it. From then on the driver journals the pending value of every key before it is
+        first touched, so rolling back or releasing costs as much as the keys touched since, not as all pending writes.
+        """
+        self.journal.append(({}, {}))
+        return len(self.journal) - 1
+
+    def __undo(self, undo):
+        for key, value in undo.items():
+            if value is MISSING:
+                self.pending_writes.pop(key, None)
+            else:
+                self.pending_writes[key] = value
+
+    def rollback_to_savepoint(self, savepoint):
+        """
+        Reverts the pending writes made since savepoint was opened, including those of the savepoints opened after it,
+        which are closed. The savepoint itself stays open.
+        """
+        while len(self.journal) > savepoint:
+            undo, _ = self.journal.pop()
+            self.__undo(undo)
+        self.journal.append(({}, {}))
+
+    def release_savepoint(self, savepoint):
+        """
+        Closes savepoint, and those opened after it, keeping their writes. Returns {key: value} written since it was
+        opened.
+        """
+        while len(self.journal) > savepoint + 1:
+            self.__merge(self.journal.pop())
+
+        frame = self.journal.pop()
+        self.__merge(frame)
+        return frame[1]
+
+    def __merge(self, frame):
+        # The enclosing savepoint has to be able to undo what the closed one wrote
+        if not self.journal:
+            return
+        undo, writes = self.journal[-1]
+        for key, value in frame[0].items():
+            undo.setdefault(key, value)
+        writes.update(frame[1])
+
+    def apply_writes(self, writes, reads=None):
+        """
+        Makes writes, {key: value}, pending as if they were set here but without metering, e.g. those of an overlay
+        that is merged or of a transaction run in another process. reads, {key: value}, are added to the pending reads
+        of the keys that were not read yet. CONTRACT_LISTENERS are called for the contracts whose code is written, as
+        set_contract does.
+        """
+        if self.journal:
+            undo, journaled = self.journal[-1]
+            for key in writes:
+                if key not in undo:
+                    undo[key] = self.pending_writes.get(key, MISSING)
+            journaled.update(writes)
+        self.pending_writes.update(writes)
+
+        for key, value in (reads or {}).items():
+            if self.pending_reads.get(key) is None:
+                self.pending_reads[key] = value
+
+        for key in writes:
+            name, _, variable = key.partition(DELIMITER)
+            if variable == CODE_KEY:
+                for listener in CONTRACT_LISTENERS:
+                    listener(name)
+
+    def overlay(self):
+        """
+        Returns an OverlayDriver on top of this driver, to simulate transactions without changing it.
+        """
+        return OverlayDriver(self)
+
     def find(self, key: str):
         if self.bypass_cache:
-            value = hdf5.get_value_from_disk(self.__filename_to_path(key), key)
+            value = self.backend.get(key)
             return value
-            
-        value = self.pending_writes.get(key)
-        if value is None:
-            value = self.cache.get(key)
-        if value is None:
-            value = hdf5.get_value_from_disk(self.__filename_to_path(key), key)
-        return value
 
-    def __get_keys_from_file(self, filename):
-        return hdf5.get_groups(self.__filename_to_path(filename))
+        # A key that was deleted in the pending writes or is known not to exist is None, without a trip to disk
+        value = self.pending_writes.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        # The cache is shared by every transaction, so one that changes a value in place and fails can not change it
+        value = self.cache.get(key, MISSING)
+        if value is not MISSING:
+            return copy_value(value)
+
+        value = self.backend.get(key)
+        self.cache[key] = value
+        return copy_value(value)
 
-    def keys_from_disk(self, prefix=None, length=0):
+    def snapshot(self, at_height=None):
         """
-        Get all keys from disk with a given prefix
+        Returns a read-only view of the committed state that later commits do not change, as it was at a height if
+        one is given. Close it when done.
         """
-        keys = set()
-        try:
-            for filename in self.__get_files():
-                for key in self.__get_keys_from_file(filename):
-                    if prefix and key.startswith(prefix):
-                        keys.add(key)
-                    elif not prefix:
-                        keys.add(key)
-
-                    if 0 < length <= len(keys):
-                        raise AssertionError("Length threshold has been hit. Continuing.")
-        except AssertionError:
-            pass
+        if at_height is None:
+            return self.backend.snapshot()
+        assert isinstance(self.backend, MVCCBackend), "Reading at a height needs a backend that keeps versions."
+        return self.backend.snapshot(at_height)
 
-        keys = list(keys)
-        keys.sort()
-        return keys
+    def state_root(self):
+        """
+        Returns the root hash (hex) of the committed contract state. Commits only rehash the keys they write.
+        """
+        assert self.backend.state_tree is not None, "The backend keeps no state tree."
+        return self.backend.state_tree.root()
 
-    def iter_from_disk(self, prefix="", length=0):
-        try:
-            filename, _ = self.__parse_key(prefix)
-        except Exception:
-            return self.keys(prefix=prefix, length=length)
+    def state_proof(self, key):
+        """
+        Returns a proof of the committed value of key, or that it does not exist, against state_root. Check it with
+        contracting.storage.merkle.verify_proof.
+        """
+        assert self.backend.state_tree is not None, "The backend keeps no state tree."
+        return self.backend.state_tree.proof(key)
 
-        if not self.is_file(filename=filename):
-            return []
+    def get_stats(self):
+        """
+        Counters of the read path, to size the caches with: those of the driver cache (negative hits are hits on keys
+        cached as not existing) and whatever the backend counts, e.g. reads its Bloom filters answered.
+        """
+        return {**self.cache.stats(), **self.backend.stats}
 
-        keys_from_file = self.__get_keys_from_file(filename)
+    def keys_from_disk(self, prefix=None, length=0, cursor=None):
+        """
+        Get all keys from disk with a given prefix, in order. Pass the last key of a page as cursor to get the next one.
+        """
+        return self.backend.iter_prefix(prefix=prefix or "", length=length, cursor=cursor)
 
-        keys = [key for key in keys_from_file if key.startswith(prefix)]
-        keys.sort()
+    def iter_from_disk(self, prefix="", length=0, cursor=None):
+        return self.backend.iter_prefix(prefix=prefix, length=length, cursor=cursor)
 
-        return keys if length == 0 else keys[:length]
+    def iter_state(self, prefix=""):
+        """
+        Yields (key, encoded value) for all committed state with a given prefix in key order, in bounded memory. Use
+        contracting.storage.snapshot to write it to a snapshot file.
+        """
+        return self.backend.iter_items(prefix)
 
     def value_from_disk(self, key):
-        filename, variable = self.__parse_key(key)
-        return hdf5.get_value_from_disk(self.__filename_to_path(filename), variable)
+        return self.backend.get(key)
 
     def items(self, prefix=""):
         """
@@ -157,13 +302,18 @@ class Driver:
             if k.startswith(prefix) and v is not None:
                 _items[k] = v
                 keys.add(k)
+                # Read as the keys from disk are, so the reads do not depend on what happens to be cached
+                if self.pending_reads.get(k) is None:
+                    self.pending_reads[k] = v
 
         # Get remaining keys from disk
         db_keys = set(self.iter_from_disk(prefix=prefix))
 
         # Subtract the already gotten keys
         for k in db_keys - keys:
-            _items[k] = self.get(k)  # Cache get will add the keys to the cache
+            v = self.get(k)  # Cache get will add the keys to the cache
+            if v is not None:
+                _items[k] = v
 
         return _items
 
@@ -222,29 +372,32 @@ class Driver:
             self.set_var(name, TIME_KEY, value=timestamp)
             self.set_var(name, DEVELOPER_KEY, value=developer)
 
+            for listener in CONTRACT_LISTENERS:
+                listener(name)
+
     def delete_contract(self, name):
         """
         Fully delete a contract from the caches and disk
         """
         for key in self.keys(name):
-            if self.cache.get(key) is not None:
-                del self.cache[key]
+            self.cache.pop(key, None)
 
             if self.pending_writes.get(key) is not None:
                 del self.pending_writes[key]
 
             self.delete_key_from_disk(key)
 
+        for listener in CONTRACT_LISTENERS:
+            listener(name)
+
     def get_contract_files(self):
         """
         Get all contract files as a list of strings
         """
-        return sorted(os.listdir(self.contract_state))
+        return self.backend.get_contract_files()
 
     def delete_key_from_disk(self, key):
-        filename, variable = self.__parse_key(key)
-        if len(filename) < constants.FILENAME_LEN_MAX:
-            hdf5.delete_key_from_disk(self.__filename_to_path(filename), variable)
+        self.backend.delete_many([key])
 
     def flush_cache(self):
         self.pending_writes.clear()
@@ -253,14 +406,10 @@ class Driver:
         self.cache.clear()
 
     def flush_disk(self):
-        shutil.rmtree(self.run_state, ignore_errors=True)
-        shutil.rmtree(self.contract_state, ignore_errors=True)
-        self.__build_directories()
+        self.backend.flush()
 
     def flush_file(self, filename):
-        file_path = self.__filename_to_path(filename)
-        if os.path.isfile(file_path):
-            os.unlink(file_path)
+        self.backend.flush_file(filename)
 
     def flush_full(self):
         """
@@ -297,23 +446,21 @@ class Driver:
             for _nanos in to_delete:
                 self.pending_deltas.pop(_nanos, None)
 
-    def commit(self):
+    def commit(self, block_num=None):
         """
-        Save the current state to disk and clear the L1 and L2 caches.
+        Save the current state to disk at block height block_num and clear the L1 and L2 caches.
         """
-        for k, v in self.pending_writes.items():
-            if v is None:
-                hdf5.delete_key_from_disk(self.__filename_to_path(k), k)
-            else:
-                hdf5.set_value_to_disk(self.__filename_to_path(k), k, v, None)
+        self.backend.set_many(self.pending_writes, block_num, source=self)
 
         self.cache.clear()
         self.pending_writes.clear()
         self.pending_reads.clear()
 
-    def hard_apply(self, nanos):
+    def hard_apply(self, nanos, block_num=None):
         """
-        Save the current state to disk and L1 cache and clear the L2 cache
+        Save the current state to disk and L1 cache and clear the L2 cache. The writes are recorded at block height
+        block_num. Without one they are recorded at nanos, unless the backend keeps versions: those are kept by height,
+        so the writes go to the height after the latest instead.
         """
 
         deltas = {}
@@ -336,16 +483,21 @@ class Driver:
         # Run through the sorted HCLs from oldest to newest applying each one until the hcl committed is
 
         to_delete = []
+        writes = {}
         for _nanos, _deltas in sorted(self.pending_deltas.items()):
             # Run through all state changes, taking the second value, which is the post delta
             for key, delta in _deltas["writes"].items():
-                hdf5.set_value_to_disk(self.__filename_to_path(key), key, delta[1], nanos)
+                writes[key] = delta[1]
 
             # Add the key (
             to_delete.append(_nanos)
             if _nanos == nanos:
                 break
 
+        if block_num is None and not isinstance(self.backend, MVCCBackend):
+            block_num = nanos
+        self.backend.set_many(writes, block_num, source=self)
+
         # Remove the deltas from the set
         [self.pending_deltas.pop(key) for key in to_delete]
 
@@ -353,28 +505,116 @@ class Driver:
         """
         Queries the disk storage and returns a dictionary with all the state from the contract storage directory.
         """
-        all_contract_state = {}
-        for file_path in self.contract_state.iterdir():
-            filename = file_path.name
-            keys = self.__get_keys_from_file(self.__filename_to_path(filename))
-            for key in keys:
-                full_key = f"{key}"
-                value = hdf5.get_value_from_disk(self.__filename_to_path(filename), key)
-                all_contract_state[full_key] = value
-
-        return all_contract_state
+        return self.backend.get_all_contract_state()
 
     def get_run_state(self):
         """
         Retrieves the latest state information from the run state directory.
         """
-        run_state = {}
-        for file_path in self.run_state.iterdir():
-            filename = file_path.name
-            keys = self.__get_keys_from_file(self.__filename_to_path(filename))
-            for key in keys:
-                full_key = f"{filename}{DELIMITER}{key}"
-                value = hdf5.get_value_from_disk(self.__filename_to_path(filename), key)
-                run_state[full_key] = value
+        return self.backend.get_run_state()
+
+
+class ReadOnlyDriver(Driver):
+    """
+    Reads the committed state of the backend of driver, with a cache of its own that commits to the backend keep up to
+    date, and refuses to write. The pending writes of driver are not seen.
+    """
+
+    def __init__(self, driver, cache=None):
+        super().__init__(bypass_cache=driver.bypass_cache, backend=driver.backend, cache=cache)
+
+    def set(self, key, value):
+        raise AssertionError("State can not be written here, this driver is read-only.")
+
+    def apply_writes(self, writes, reads=None):
+        raise AssertionError("State can not be written here, this driver is read-only.")
+
+    def commit(self, block_num=None):
+        raise AssertionError("State can not be written here, this driver is read-only.")
+
+    def hard_apply(self, nanos, block_num=None):
+        raise AssertionError("State can not be written here, this driver is read-only.")
+
+    def delete_key_from_disk(self, key):
+        raise AssertionError("State can not be written here, this driver is read-only.")
+
+
+class OverlayDriver(Driver):
+    """
+    Pending writes of its own on top of parent, a driver or another overlay, so transactions can be simulated without
+    changing parent or dropping what it cached. Creating one copies nothing. Keys that are not written here are read
+    from parent as it is at the time of the read, as copies, and parent caches what it reads from the backend as usual.
+
+    merge, which commit and hard_apply call, makes the writes pending in parent; discard drops them. An overlay never
+    writes to the backend.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.backend = parent.backend
+        self.bypass_cache = False
+        self.cache = StateCache()
+        self.pending_deltas = {}
+        self.pending_writes = {}
+        self.pending_reads = {}
+        self.journal = []
+
+    def find(self, key: str):
+        value = self.pending_writes.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        return copy_value(self.parent.find(key))
+
+    def iter_from_disk(self, prefix="", length=0, cursor=None):
+        # The keys of parent, committed or pending
+        keys = set(self.parent.iter_from_disk(prefix))
+        for key, value in self.parent.pending_writes.items():
+            if key.startswith(prefix):
+                if value is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+
+        keys = sorted(key for key in keys if cursor is None or key > cursor)
+        return keys if length == 0 else keys[:length]
+
+    def keys_from_disk(self, prefix=None, length=0, cursor=None):
+        return self.iter_from_disk(prefix or "", length, cursor)
+
+    def merge(self):
+        """
+        Makes the pending writes and reads of the overlay pending in parent and clears them.
+        """
+        assert not self.journal, "The overlay has open savepoints."
+        self.parent.apply_writes(self.pending_writes, self.pending_reads)
+        self.discard()
+
+    def discard(self):
+        """
+        Drops the pending writes of the overlay. Outputs of transactions that ran on it keep theirs.
+        """
+        self.pending_writes = {}
+        self.pending_reads = {}
+        self.pending_deltas = {}
+        self.journal = []
+
+    def commit(self, block_num=None):
+        self.merge()
+
+    def hard_apply(self, nanos, block_num=None):
+        self.merge()
+
+    def rollback(self, nanos=None):
+        self.discard()
+
+    def delete_key_from_disk(self, key):
+        self.apply_writes({key: None})
+
+    def flush_disk(self):
+        raise AssertionError("An overlay can not write to the store, merge it into its parent instead.")
+
+    def flush_file(self, filename):
+        raise AssertionError("An overlay can not write to the store, merge it into its parent instead.")
 
-        return run_state
+    def get_stats(self):
+        return self.parent.get_stats()
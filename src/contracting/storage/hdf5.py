@@ -1,9 +1,30 @@
+import atexit
 import h5py
+import weakref
+import json
+import os
+import re
+import shutil
+import zlib
 
 from threading import Lock
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from contracting import constants
+from contracting.storage.backend import StorageBackend
+from contracting.storage.sqlite import KeyIndex
+from contracting.storage.bloom import BloomFilter
+from contracting.storage.wal import WALBackend, wal_path, replay, close_logs
+from contracting.storage.versions import MVCCBackend, versions_path
+from contracting.storage.merkle import StateTree, state_tree_path
 from contracting.storage.encoder import encode, decode
 
+try:
+    import fcntl
+except ImportError:  # Windows, where trees are not shared between processes
+    fcntl = None
+
 # A dictionary to maintain file-specific locks
 file_locks = defaultdict(Lock)
 
@@ -12,12 +33,180 @@ ATTR_LEN_MAX = 64000
 ATTR_VALUE = "value"
 ATTR_BLOCK = "block"
 
+# Pool of long-lived file handles, least recently used first. A handle is only used or closed while holding its file
+# lock. Set the size to 0 to open and close a file on every call, e.g. when other processes need the files too.
+MAX_OPEN_FILES = 128
+open_files = OrderedDict()
+pool_lock = Lock()
+
+# Reads open files read-only and never create them. SWMR lets them run while another process writes the file.
+SWMR_READ = True
+
+# Storage layouts. LAYOUT_KEY keeps one HDF5 file per state key, LAYOUT_CONTRACT keeps one file (or a fixed number of
+# shards) per contract with variables and hash keys stored as nested groups inside it.
+LAYOUT_KEY = "key"
+LAYOUT_CONTRACT = "contract"
+LAYOUT_FILENAME = "layout.json"
+INDEX_FILENAME = "key_index.db"
+BLOOM_DIRNAME = "bloom"
+SHARD_DELIMITER = "-"
+MISC_FILENAME = "__misc"
+
+# A migration to another layout, see contracting.storage.migration, builds the new tree in MIGRATION_DIRNAME and then
+# swaps it in. Until it is done, MIGRATION_FILENAME records its target and how far it got.
+MIGRATION_FILENAME = "migration.json"
+MIGRATION_DIRNAME = "migration"
+MIGRATION_BUILDING = "building"
+MIGRATION_SWAPPING = "swapping"
+BACKUP_SUFFIX = ".per_key"
+
+# The layers a tree was last opened with, taken when open_backend is not told, and the lock of the process that writes
+# it. Only that process may replay or remove the files of the layers.
+LAYERS_FILENAME = "layers.json"
+WRITER_LOCK_FILENAME = "writer.lock"
+NO_LAYERS = {"wal": False, "versions": False, "retain": None, "merkle": False}
+
+# Drivers of one process that use the same tree share its backend, so they see each other's writes through the key
+# index, the Bloom filters and the invalidation of their caches
+backends = weakref.WeakValueDictionary()
+backends_lock = Lock()
+
+# Hash keys may contain characters that HDF5 treats specially in group names
+_GROUP_ESCAPES = {"25": "%", "2F": "/", "2E": ".", "00": ""}
+_GROUP_UNESCAPE = re.compile(r"%(25|2F|2E|00)")
+
 
 def get_file_lock(file_path):
     """Retrieve a lock for a specific file path."""
     return file_locks[file_path]
 
 
+def set_pool_size(size):
+    """Change the number of pooled file handles. Handles over the new limit are closed."""
+    global MAX_OPEN_FILES
+    MAX_OPEN_FILES = size
+    with pool_lock:
+        _evict()
+
+
+def _evict(keep=None):
+    # Called with pool_lock held. Handles that are in use by another thread are skipped rather than waited on, so
+    # the pool may briefly hold more than MAX_OPEN_FILES handles.
+    for file_path in list(open_files.keys()):
+        if len(open_files) <= MAX_OPEN_FILES:
+            return
+        if file_path == keep:
+            continue
+
+        lock = get_file_lock(file_path)
+        if lock.acquire(blocking=False):
+            try:
+                open_files.pop(file_path).close()
+            finally:
+                lock.release()
+
+
+def _open_for_read(file_path):
+    if SWMR_READ:
+        try:
+            return h5py.File(file_path, 'r', swmr=True)
+        except (OSError, ValueError):
+            pass
+    return h5py.File(file_path, 'r')
+
+
+def _get_handle(file_path, write):
+    # Called with the file lock of file_path held
+    with pool_lock:
+        f = open_files.get(file_path)
+        if f is not None:
+            if not write or f.mode != 'r':
+                open_files.move_to_end(file_path)
+                return f
+
+            # A read-only handle has to be reopened before the file can be written
+            open_files.pop(file_path)
+
+    if f is not None:
+        f.close()
+
+    f = h5py.File(file_path, 'a') if write else _open_for_read(file_path)
+
+    with pool_lock:
+        open_files[file_path] = f
+        _evict(keep=file_path)
+
+    return f
+
+
+def _release_handle(file_path, f):
+    # Called with the file lock of file_path held
+    if MAX_OPEN_FILES > 0:
+        return
+
+    with pool_lock:
+        open_files.pop(file_path, None)
+    f.close()
+
+
+@contextmanager
+def open_file(file_path, timeout=20, write=True):
+    """
+    Borrow the pooled handle for a file while holding its lock. Writers get a handle that can modify the file and
+    create it if needed. Readers get None instead of a handle if the file does not exist.
+    """
+    if not write and file_path not in open_files and not os.path.isfile(file_path):
+        yield None
+        return
+
+    lock = get_file_lock(file_path)
+    if not lock.acquire(timeout=timeout):
+        raise TimeoutError("Lock acquisition timed out")
+    try:
+        f = _get_handle(file_path, write)
+        try:
+            yield f
+        finally:
+            _release_handle(file_path, f)
+    finally:
+        lock.release()
+
+
+def flush():
+    """Flush all pooled handles to disk. Batched writes already flush the files they touch."""
+    with pool_lock:
+        file_paths = list(open_files.keys())
+
+    for file_path in file_paths:
+        with get_file_lock(file_path):
+            f = open_files.get(file_path)
+            if f is not None:
+                f.flush()
+
+
+def close(file_path):
+    """Close the pooled handle of a file, if there is one. Must be done before the file is removed."""
+    with get_file_lock(file_path):
+        with pool_lock:
+            f = open_files.pop(file_path, None)
+        if f is not None:
+            f.close()
+
+
+def close_all():
+    with pool_lock:
+        file_paths = list(open_files.keys())
+
+    for file_path in file_paths:
+        close(file_path)
+
+
+atexit.register(close_all)
+# Registered after close_all so it runs before it: an apply thread that is still writing when the files are closed, or
+# when the interpreter shuts down, can hang the exit
+atexit.register(close_logs)
+
+
 def get_value(file_path, group_name):
     return get_attr(file_path, group_name, ATTR_VALUE)
 
@@ -27,7 +216,9 @@ def get_block(file_path, group_name):
 
 
 def get_attr(file_path, group_name, attr_name):
-    with h5py.File(file_path, 'a') as f:
+    with open_file(file_path, write=False) as f:
+        if f is None:
+            return None
         try:
             value = f[group_name].attrs[attr_name]
             return value.decode() if isinstance(value, bytes) else value
@@ -36,54 +227,60 @@ def get_attr(file_path, group_name, attr_name):
 
 
 def get_groups(file_path):
-    with h5py.File(file_path, 'a') as f:
+    with open_file(file_path, write=False) as f:
+        if f is None:
+            return []
         return list(f.keys())
 
 
+def get_value_groups(file_path):
+    """Return the paths of all nested groups in a file that hold a value."""
+    groups = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Group) and ATTR_VALUE in obj.attrs:
+            groups.append(name)
+
+    with open_file(file_path, write=False) as f:
+        if f is not None:
+            f.visititems(visit)
+
+    return groups
+
+
 def write_attr(file_or_path, group_name, attr_name, value, timeout=20):
     # Attempt to acquire lock with a timeout to prevent deadlock
     if isinstance(file_or_path, str):
-        with h5py.File(file_or_path, 'a') as f:
+        with open_file(file_or_path, timeout) as f:
             _write_attr_to_file(f, group_name, attr_name, value, timeout)
     else:
         _write_attr_to_file(file_or_path, group_name, attr_name, value, timeout)
 
 
-def _write_attr_to_file(file, group_name, attr_name, value, timeout):    
+def _write_attr_to_file(file, group_name, attr_name, value, timeout):
     grp = file.require_group(group_name)
     if attr_name in grp.attrs:
         del grp.attrs[attr_name]
     if value:
         grp.attrs[attr_name] = value
-    
+
 
 def set(file_path, group_name, value, blocknum, timeout=20):
-    lock = get_file_lock(file_path if isinstance(file_path, str) else file_path.filename)
-    if lock.acquire(timeout=timeout):
-        try:
-            with h5py.File(file_path, 'a') as f:
-                write_attr(f, group_name, ATTR_VALUE, value, timeout)
-                write_attr(f, group_name, ATTR_BLOCK, blocknum, timeout)
-        finally:
-            lock.release()
-    else:
-        raise TimeoutError("Lock acquisition timed out")
+    with open_file(file_path if isinstance(file_path, str) else file_path.filename, timeout) as f:
+        write_attr(f, group_name, ATTR_VALUE, value, timeout)
+        write_attr(f, group_name, ATTR_BLOCK, blocknum, timeout)
 
 
 def delete(file_path, group_name, timeout=20):
-    lock = get_file_lock(file_path if isinstance(file_path, str) else file_path.filename)
-    if lock.acquire(timeout=timeout):
+    if isinstance(file_path, str) and file_path not in open_files and not os.path.isfile(file_path):
+        return
+
+    with open_file(file_path if isinstance(file_path, str) else file_path.filename, timeout) as f:
         try:
-            with h5py.File(file_path, 'a') as f:
-                try:
-                    del f[group_name].attrs[ATTR_VALUE]
-                    del f[group_name].attrs[ATTR_BLOCK]
-                except KeyError:
-                    pass
-        finally:
-            lock.release()
-    else:
-        raise TimeoutError("Lock acquisition timed out")
+            del f[group_name].attrs[ATTR_VALUE]
+            del f[group_name].attrs[ATTR_BLOCK]
+        except KeyError:
+            pass
 
 
 def set_value_to_disk(file_path, group_name, value, block_num=None, timeout=20):
@@ -91,9 +288,666 @@ def set_value_to_disk(file_path, group_name, value, block_num=None, timeout=20):
     set(file_path, group_name, encoded_value, block_num if block_num is not None else -1, timeout)
 
 
+def write_values_to_disk(file_path, values, block_num=None, timeout=20, encoded=False):
+    """
+    Write a batch of {group_name: value} to one file, taking its lock and opening it once and flushing it once.
+    A value of None deletes the group's value. With encoded=True the values are stored as they are.
+    """
+    if file_path not in open_files and not os.path.isfile(file_path):
+        if all(value is None for value in values.values()):
+            return
+
+    block_num = block_num if block_num is not None else -1
+
+    with open_file(file_path, timeout) as f:
+        for group_name, value in values.items():
+            grp = f.get(group_name)
+
+            if value is None:
+                if grp is not None:
+                    grp.attrs.pop(ATTR_VALUE, None)
+                    grp.attrs.pop(ATTR_BLOCK, None)
+                continue
+
+            if grp is None:
+                grp = f.create_group(group_name)
+
+            # Assigning an attribute replaces it, there is no need to delete it first
+            attrs = grp.attrs
+            attrs[ATTR_VALUE] = value if encoded else encode(value)
+            attrs[ATTR_BLOCK] = block_num
+        f.flush()
+
+
 def delete_key_from_disk(file_path, group_name, timeout=20):
     delete(file_path, group_name, timeout)
 
 
 def get_value_from_disk(file_path, group_name):
     return decode(get_value(file_path, group_name))
+
+
+def escape_group(component):
+    escaped = component.replace("%", "%25").replace("/", "%2F")
+    if escaped == "":
+        return "%00"
+    if escaped == ".":
+        return "%2E"
+    return escaped
+
+
+def unescape_group(component):
+    return _GROUP_UNESCAPE.sub(lambda m: _GROUP_ESCAPES[m.group(1)], component)
+
+
+def read_layout(storage_home):
+    """
+    Returns the (layout, shards) recorded for a storage tree, or None if the tree has no layout file.
+    """
+    path = Path(storage_home).joinpath(LAYOUT_FILENAME)
+    if not path.is_file():
+        return None
+    with open(path) as f:
+        layout = json.load(f)
+    return layout["layout"], layout.get("shards", 1)
+
+
+def write_layout(layout, shards, storage_home):
+    path = Path(storage_home)
+    path.mkdir(exist_ok=True, parents=True)
+    with open(path.joinpath(LAYOUT_FILENAME), "w") as f:
+        json.dump({"layout": layout, "shards": shards}, f)
+
+
+def read_layers(storage_home):
+    """
+    Returns the layers recorded for a storage tree, see open_backend, or None if the tree has no layers file.
+    """
+    path = Path(storage_home).joinpath(LAYERS_FILENAME)
+    if not path.is_file():
+        return None
+    with open(path) as f:
+        return {**NO_LAYERS, **json.load(f)}
+
+
+def write_layers(storage_home, layers):
+    # Written next to the file and moved over it, so a crash leaves the old layers or the new ones
+    path = Path(storage_home).joinpath(LAYERS_FILENAME)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(layers, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def lock_writer(storage_home):
+    """
+    Takes the writer lock of a storage tree and returns the open lock file, which holds it until it is closed. Returns
+    None if another process holds it.
+    """
+    path = Path(storage_home)
+    path.mkdir(exist_ok=True, parents=True)
+    f = open(path.joinpath(WRITER_LOCK_FILENAME), "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+    return f
+
+
+def read_migration(storage_home):
+    """
+    Returns what a migration of a storage tree that has not finished recorded, or None.
+    """
+    path = Path(storage_home).joinpath(MIGRATION_FILENAME)
+    if not path.is_file():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_migration(storage_home, **migration):
+    # Written next to the marker and moved over it, so a crash leaves the old marker or the new one
+    path = Path(storage_home).joinpath(MIGRATION_FILENAME)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(migration, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def finish_migration(storage_home):
+    """
+    Swaps in the tree a migration built, once it is complete. Every step can be repeated, so a swap that was
+    interrupted is finished by calling this again. The layout file is written only after the swap, and the marker is
+    removed last.
+    """
+    storage_home = Path(storage_home)
+    migration = read_migration(storage_home)
+    assert migration is not None and migration["phase"] == MIGRATION_SWAPPING, (f"Storage at {storage_home} has no "
+                                                                                f"migration to finish.")
+    staging = storage_home.joinpath(MIGRATION_DIRNAME)
+
+    for name in ("contract_state", "run_state"):
+        built = staging.joinpath(name)
+        if not built.exists():
+            continue
+
+        source = storage_home.joinpath(name)
+        if source.exists():
+            if migration["keep_source"]:
+                source.rename(storage_home.joinpath(name + BACKUP_SUFFIX))
+            else:
+                shutil.rmtree(source)
+        built.rename(source)
+
+    # The key index and the Bloom filters are rebuilt for the new tree when it is opened
+    for suffix in ("", "-wal", "-shm"):
+        storage_home.joinpath(INDEX_FILENAME + suffix).unlink(missing_ok=True)
+    shutil.rmtree(storage_home.joinpath(BLOOM_DIRNAME), ignore_errors=True)
+
+    write_layout(migration["layout"], migration["shards"], storage_home)
+    shutil.rmtree(staging, ignore_errors=True)
+    storage_home.joinpath(MIGRATION_FILENAME).unlink()
+    return migration
+
+
+class HDF5Backend(StorageBackend):
+    """
+    Keeps state in a tree of HDF5 files, split into contract_state and run_state directories, using one of the layouts
+    above.
+
+    Prefix scans are answered from a sorted key index next to the tree, which is updated with every write. If the index
+    is missing or was left stale by a crash, it is rebuilt from the files when the backend is opened. The index does not
+    see writes made to the files by anything but this class, so pass index=False to processes that share a tree with
+    such writers.
+
+    With the index come Bloom filters, one per contract file (or shard, or per contract in the key layout), that let
+    reads of keys that were never written return without opening a file. Keys are added to a filter and the filter is
+    saved before they are written, so a filter on disk never misses a key that is in the tree. Filters are rebuilt from
+    the index when it is rebuilt and when they fill up. Another process may write the tree through this class: once
+    it changed the index, a filter that rules a key out is read from disk again before the miss is believed.
+    """
+
+    def __init__(self, storage_home, layout=None, shards=None, index=True, bloom=True):
+        super().__init__()
+        self.storage_home = Path(storage_home)
+        self.contract_state = self.storage_home.joinpath("contract_state")
+        self.run_state = self.storage_home.joinpath("run_state")
+        self.bloom_home = self.storage_home.joinpath(BLOOM_DIRNAME)
+        self.__finish_migration()
+        self.layout, self.shards = self.__resolve_layout(layout, shards)
+        self.__build_directories()
+
+        # Files written since the last sync. A dict, the builtin set is shadowed in this module.
+        self.unsynced = {}
+
+        self.index = None
+        self.blooms = None
+        if index:
+            self.index = KeyIndex(self.storage_home.joinpath(INDEX_FILENAME))
+            rebuild = not self.index.valid
+            if rebuild:
+                self.rebuild_index()
+
+            if bloom:
+                if rebuild or not self.bloom_home.is_dir():
+                    self.rebuild_blooms()
+                else:
+                    self.blooms = {path.name: BloomFilter.load(path) for path in self.bloom_home.iterdir()
+                                   if not path.name.endswith(".tmp")}
+                # The version of the index the filters are as new as, and the buckets read from disk since
+                self.bloom_version = self.index.version
+                self.fresh_blooms = dict.fromkeys(self.blooms)
+
+    def __finish_migration(self):
+        """
+        A tree whose migration was interrupted while its new files were written still holds only the old ones, but is
+        about to be replaced, so it is not opened. One interrupted while they were swapped in is finished.
+        """
+        migration = read_migration(self.storage_home)
+        if migration is None:
+            return
+
+        assert migration["phase"] == MIGRATION_SWAPPING, (f"Storage at {self.storage_home} was left half migrated to "
+                                                          f"the {migration['layout']} layout. Run "
+                                                          f"contracting.storage.migration on it again.")
+        finish_migration(self.storage_home)
+
+    def __resolve_layout(self, layout, shards):
+        """
+        The layout of an existing tree is read from its layout file. Asking for a different layout than the one on disk
+        is an error, since the keys would silently disappear. Use contracting.storage.migration to convert a tree.
+        """
+        recorded = read_layout(self.storage_home)
+
+        if recorded is None:
+            layout = layout or LAYOUT_KEY
+            shards = shards or 1
+            assert layout in (LAYOUT_KEY, LAYOUT_CONTRACT), f"Unknown storage layout {layout}."
+            assert shards >= 1, "Number of shards must be at least 1."
+            if layout != LAYOUT_KEY:
+                write_layout(layout, shards, self.storage_home)
+            return layout, shards
+
+        assert layout is None or layout == recorded[0], (f"Storage at {self.storage_home} uses the {recorded[0]} "
+                                                         f"layout, not {layout}.")
+        assert shards is None or shards == recorded[1], (f"Storage at {self.storage_home} uses {recorded[1]} "
+                                                         f"shards, not {shards}.")
+        return recorded
+
+    def __build_directories(self):
+        self.contract_state.mkdir(exist_ok=True, parents=True)
+        self.run_state.mkdir(exist_ok=True, parents=True)
+
+    def __filename_to_path(self, filename):
+        if filename.startswith("__"):
+            return str(self.run_state.joinpath(filename))
+        else:
+            return str(self.contract_state.joinpath(filename))
+
+    def __get_files(self):
+        return sorted(os.listdir(self.contract_state) + os.listdir(self.run_state))
+
+    def __shard_filename(self, filename, variable):
+        if self.shards == 1:
+            return filename
+        shard = zlib.crc32(variable.encode()) % self.shards
+        return f"{filename}{SHARD_DELIMITER}{shard}"
+
+    def __contract_filenames(self, filename):
+        if self.shards == 1:
+            return [filename]
+        return [f"{filename}{SHARD_DELIMITER}{shard}" for shard in range(self.shards)]
+
+    def location(self, key):
+        """
+        Returns the file path and the group inside of it that hold a key.
+        """
+        if self.layout == LAYOUT_KEY:
+            return self.__filename_to_path(key), key
+
+        try:
+            filename, variable = key.split(constants.INDEX_SEPARATOR, 1)
+        except ValueError:
+            filename, variable = MISC_FILENAME, key
+
+        group = constants.HDF5_GROUP_SEPARATOR.join(
+            escape_group(part) for part in variable.split(constants.DELIMITER)
+        )
+        return self.__filename_to_path(self.__shard_filename(filename, variable)), group
+
+    def __group_to_key(self, filename, group):
+        if self.layout == LAYOUT_KEY:
+            return group
+
+        variable = constants.DELIMITER.join(
+            unescape_group(part) for part in group.split(constants.HDF5_GROUP_SEPARATOR)
+        )
+
+        if self.shards > 1:
+            filename = filename.rsplit(SHARD_DELIMITER, 1)[0]
+
+        if filename == MISC_FILENAME:
+            return variable
+        return f"{filename}{constants.INDEX_SEPARATOR}{variable}"
+
+    def __get_keys_from_file(self, filename):
+        file_path = self.__filename_to_path(filename)
+        if self.layout == LAYOUT_KEY:
+            return get_groups(file_path)
+        return [self.__group_to_key(filename, group) for group in get_value_groups(file_path)]
+
+    def __bloom_bucket(self, key):
+        try:
+            filename, variable = key.split(constants.INDEX_SEPARATOR, 1)
+        except ValueError:
+            filename, variable = MISC_FILENAME, key
+
+        if self.layout == LAYOUT_KEY:
+            return filename
+        return self.__shard_filename(filename, variable)
+
+    def __bucket_keys(self, bucket):
+        if bucket == MISC_FILENAME:
+            keys = self.index.scan()
+        else:
+            filename = bucket.rsplit(SHARD_DELIMITER, 1)[0] if self.shards > 1 else bucket
+            keys = self.index.scan(filename + constants.INDEX_SEPARATOR)
+        return [key for key in keys if self.__bloom_bucket(key) == bucket]
+
+    def rebuild_blooms(self):
+        buckets = {}
+        for key in self.index.scan():
+            buckets.setdefault(self.__bloom_bucket(key), []).append(key)
+
+        shutil.rmtree(self.bloom_home, ignore_errors=True)
+        self.bloom_home.mkdir(parents=True)
+
+        self.blooms = {}
+        for bucket, keys in buckets.items():
+            self.blooms[bucket] = BloomFilter.from_keys(keys)
+            self.blooms[bucket].save(self.bloom_home.joinpath(bucket))
+        self.fresh_blooms = dict.fromkeys(self.blooms)
+
+    def __add_to_blooms(self, keys):
+        touched = {}
+        for key in keys:
+            bucket = self.__bloom_bucket(key)
+            bloom = self.blooms.get(bucket)
+            if bloom is None:
+                bloom = self.blooms[bucket] = BloomFilter()
+            elif key in bloom:
+                # Adding it again would count it twice and save the filter for nothing
+                continue
+            bloom.add(key)
+            touched[bucket] = bloom
+
+        for bucket, bloom in touched.items():
+            if bloom.full:
+                # The index already holds the new keys
+                bloom = self.blooms[bucket] = BloomFilter.from_keys(self.__bucket_keys(bucket))
+                self.stats["bloom_rebuilds"] += 1
+            bloom.save(self.bloom_home.joinpath(bucket))
+            self.fresh_blooms[bucket] = None
+
+    def __ruled_out(self, key):
+        bucket = self.__bloom_bucket(key)
+        bloom = self.blooms.get(bucket)
+        if bloom is not None and key in bloom:
+            return False
+
+        # Another process that wrote the tree saved its filters first, so they are read again once it changed the index
+        version = self.index.version
+        if version != self.bloom_version:
+            self.bloom_version = version
+            self.fresh_blooms = {}
+        if bucket in self.fresh_blooms:
+            return True
+
+        path = self.bloom_home.joinpath(bucket)
+        if not path.is_file():
+            # Not marked fresh, the filter may be about to be saved by a rebuild
+            return True
+        bloom = self.blooms[bucket] = BloomFilter.load(path)
+        self.fresh_blooms[bucket] = None
+        self.stats["bloom_reloads"] += 1
+        return key not in bloom
+
+    def get(self, key):
+        file_path, group = self.location(key)
+
+        if self.blooms is not None:
+            if self.__ruled_out(key):
+                self.stats["bloom_negatives"] += 1
+                return None
+
+            value = get_value_from_disk(file_path, group)
+            if value is None:
+                self.stats["bloom_false_positives"] += 1
+            return value
+
+        return get_value_from_disk(file_path, group)
+
+    def get_raw(self, key):
+        return get_value(*self.location(key))
+
+    def write(self, values, block_num=None, encoded=False):
+        """
+        Write {key: value} grouped by file, so each touched file is locked, opened and flushed once.
+        """
+        files = {}
+        for key, value in values.items():
+            file_path, group = self.location(key)
+            files.setdefault(file_path, {})[group] = value
+
+        if self.index is not None:
+            self.index.begin(values)
+
+        if self.blooms is not None:
+            # Deleted keys stay in the filters until they are rebuilt, which only costs a disk read
+            self.__add_to_blooms([key for key, value in values.items() if value is not None])
+
+        for file_path, file_values in files.items():
+            write_values_to_disk(file_path, file_values, block_num, encoded=encoded)
+        self.unsynced.update(dict.fromkeys(files))
+
+        if self.index is not None:
+            self.index.end()
+
+    def load(self, values, block_num=None):
+        # Encoded values are stored verbatim, they are not decoded and encoded again
+        if values:
+            with self.lock:
+                for snapshot in list(self.snapshots):
+                    snapshot.preserve(values.keys())
+                self.begin_write()
+                self.write(values, block_num, encoded=True)
+            self.notify(values.keys())
+
+    def sync(self):
+        # Writes flush the HDF5 buffers, fsync on any descriptor of a file then gets its pages to disk
+        with self.lock:
+            file_paths, self.unsynced = self.unsynced, {}
+
+        for file_path in file_paths:
+            try:
+                fd = os.open(file_path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def rebuild_index(self):
+        self.index.rebuild(self.keys())
+
+    def keys(self, prefix="", length=0):
+        """
+        Opens every file in the tree. Prefer iter_prefix, which only opens the files that can hold the prefix.
+        """
+        # Keys are unique across files, and the builtin set is shadowed in this module
+        keys = []
+        for filename in self.__get_files():
+            for key in self.__get_keys_from_file(filename):
+                if key.startswith(prefix):
+                    keys.append(key)
+
+                if 0 < length <= len(keys):
+                    return sorted(keys)
+
+        return sorted(keys)
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        if self.index is not None:
+            return self.index.scan(prefix, length, cursor)
+
+        if self.layout == LAYOUT_KEY:
+            # Every key has its own file, so the directory listing is the key listing
+            keys = [filename for filename in self.__get_files() if filename.startswith(prefix)]
+        elif constants.INDEX_SEPARATOR not in prefix:
+            keys = self.keys(prefix=prefix)
+        else:
+            filename, _ = prefix.split(constants.INDEX_SEPARATOR, 1)
+
+            keys = []
+            for shard_filename in self.__contract_filenames(filename):
+                if self.is_file(shard_filename):
+                    keys.extend(key for key in self.__get_keys_from_file(shard_filename) if key.startswith(prefix))
+            keys.sort()
+
+        if cursor is not None:
+            keys = [key for key in keys if key > cursor]
+
+        return keys if length == 0 else keys[:length]
+
+    def is_file(self, filename):
+        return Path(self.__filename_to_path(filename)).is_file()
+
+    def flush_file(self, filename):
+        file_path = self.__filename_to_path(filename)
+        if os.path.isfile(file_path):
+            close(file_path)
+            os.unlink(file_path)
+            if self.index is not None:
+                self.rebuild_index()
+            if self.blooms is not None:
+                self.rebuild_blooms()
+            self.notify(None)
+
+    def get_contract_files(self):
+        return sorted(os.listdir(self.contract_state))
+
+    def flush(self):
+        close_all()
+        shutil.rmtree(self.run_state, ignore_errors=True)
+        shutil.rmtree(self.contract_state, ignore_errors=True)
+        self.__build_directories()
+        if self.index is not None:
+            self.index.rebuild([])
+        if self.blooms is not None:
+            self.rebuild_blooms()
+        self.notify(None)
+
+    def close(self):
+        # Only the handles of this tree, other backends may share the pool
+        root = str(self.storage_home)
+        with pool_lock:
+            file_paths = [file_path for file_path in open_files.keys() if file_path.startswith(root)]
+
+        for file_path in file_paths:
+            close(file_path)
+
+        if self.index is not None:
+            self.index.close()
+
+    def get_all_contract_state(self):
+        all_contract_state = {}
+        for file_path in self.contract_state.iterdir():
+            for key in self.__get_keys_from_file(file_path.name):
+                all_contract_state[key] = self.get(key)
+
+        return all_contract_state
+
+    def get_run_state(self):
+        run_state = {}
+        for file_path in self.run_state.iterdir():
+            filename = file_path.name
+            for key in self.__get_keys_from_file(filename):
+                if self.layout == LAYOUT_KEY:
+                    run_state[f"{filename}{constants.INDEX_SEPARATOR}{key}"] = get_value_from_disk(str(file_path), key)
+                else:
+                    run_state[key] = self.get(key)
+
+        return run_state
+
+
+def open_backend(storage_home, layout=None, shards=None, wal=None, versions=None, retain=None, merkle=None):
+    """
+    Returns the backend of the tree in storage_home that is already open in this process, or opens it. With wal=True
+    the tree is opened behind a write-ahead log, see contracting.storage.wal, and with versions=True every version of
+    every key is kept, see contracting.storage.versions, pruned to the last retain heights if that is set. With
+    merkle=True a Merkle tree of the state is kept up to date, see contracting.storage.merkle. None takes the tree as
+    it is open in this process, or else as it was last opened by a process that wrote it.
+
+    The process that opens a tree first takes its writer lock. It replays a log that is left over, drops a state tree
+    that is no longer kept and records the layers it asked for. If it keeps a log or a state tree it holds the lock
+    until the backend is closed. Any other process opens the tree with the recorded layers, but reads the files of the
+    tree directly: the writes of the writer are seen once they have been applied from its log, and it has no state
+    tree. It can not ask for other layers, a log or a state tree.
+    """
+    path = str(Path(storage_home).resolve())
+    with backends_lock:
+        backend = backends.get(path)
+
+        layers = []
+        tree = backend
+        while isinstance(tree, (WALBackend, MVCCBackend)):
+            layers.append(type(tree))
+            tree = tree.backend
+
+        # The tree may have been removed from under an open backend
+        if backend is not None and tree.contract_state.is_dir():
+            assert layout is None or layout == tree.layout, (f"Storage at {storage_home} uses the "
+                                                             f"{tree.layout} layout, not {layout}.")
+            assert shards is None or shards == tree.shards, (f"Storage at {storage_home} uses {tree.shards} "
+                                                             f"shards, not {shards}.")
+            assert wal is None or wal == (WALBackend in layers), (f"Storage at {storage_home} is already "
+                                                                  f"open {'with' if not wal else 'without'} "
+                                                                  f"a write-ahead log.")
+            assert versions is None or versions == (MVCCBackend in layers), (f"Storage at {storage_home} is already "
+                                                                             f"open with{'' if not versions else 'out'}"
+                                                                             f" versions.")
+            assert retain is None or retain == getattr(backend, "retain", None), (f"Storage at {storage_home} is "
+                                                                                  f"already open with other "
+                                                                                  f"retention.")
+            assert merkle is None or merkle == (backend.state_tree is not None), (f"Storage at {storage_home} is "
+                                                                                  f"already open with"
+                                                                                  f"{'' if not merkle else 'out'} a "
+                                                                                  f"state tree.")
+            return backend
+
+        if backend is not None and backend.writer_lock is not None:
+            # The tree was removed, and the lock of this process with it
+            backend.writer_lock.close()
+        lock = lock_writer(storage_home)
+        recorded = read_layers(storage_home) or NO_LAYERS
+        requested = {"wal": wal, "versions": versions, "retain": retain, "merkle": merkle}
+        options = {name: recorded[name] if value is None else value for name, value in requested.items()}
+
+        if lock is None:
+            assert options == recorded and not wal and not merkle, (f"Storage at {storage_home} is written by another "
+                                                                   f"process, it can only be opened with the layers "
+                                                                   f"{recorded} and without a log or state tree.")
+            backend = HDF5Backend(storage_home, layout, shards)
+            if options["versions"]:
+                backend = MVCCBackend(backend, versions_path(storage_home), options["retain"])
+            backends[path] = backend
+            return backend
+
+        try:
+            backend = HDF5Backend(storage_home, layout, shards)
+            if options["wal"]:
+                backend = WALBackend(backend, wal_path(storage_home))
+            else:
+                # A log left by an earlier process still holds writes the tree has to see
+                replay(backend, wal_path(storage_home))
+            if options["versions"]:
+                backend = MVCCBackend(backend, versions_path(storage_home), options["retain"])
+            if options["merkle"]:
+                StateTree(state_tree_path(storage_home), backend)
+            else:
+                # A state tree that misses writes is wrong, it is built from scratch when it is kept again
+                for suffix in ("", "-wal", "-shm"):
+                    Path(str(state_tree_path(storage_home)) + suffix).unlink(missing_ok=True)
+            if options != recorded:
+                write_layers(storage_home, options)
+        except BaseException:
+            lock.close()
+            raise
+
+        if options["wal"] or options["merkle"]:
+            backend.writer_lock = lock
+        else:
+            lock.close()
+        backends[path] = backend
+        return backend
+
+
+def close_backend(storage_home):
+    """
+    Closes the open backend of a tree, if there is one, e.g. before the tree is replaced.
+    """
+    with backends_lock:
+        backend = backends.pop(str(Path(storage_home).resolve()), None)
+    if backend is not None:
+        if backend.state_tree is not None:
+            backend.state_tree.close()
+        backend.close()
+        if backend.writer_lock is not None:
+            backend.writer_lock.close()
@@ -0,0 +1,253 @@
+from contracting.storage.backend import is_run_state_key
+from contracting.storage.encoder import encode
+from pathlib import Path
+from threading import RLock
+
+import hashlib
+import sqlite3
+
+STATE_TREE_FILENAME = "state_tree.db"
+
+# Keys are hashed into 2 ** DEPTH buckets, the leaves of a binary tree of hashes
+DEPTH = 16
+BUCKETS = 2 ** DEPTH
+
+LEAF_PREFIX = b"\x00"
+BUCKET_PREFIX = b"\x01"
+NODE_PREFIX = b"\x02"
+
+
+def bucket_of(key):
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:2], "big")
+
+
+def leaf_hash(key, encoded_value):
+    key = key.encode()
+    return hashlib.sha256(LEAF_PREFIX + len(key).to_bytes(4, "big") + key + encoded_value.encode()).digest()
+
+
+def bucket_hash(leaf_hashes):
+    """
+    The hash of a bucket, from the hashes of its leaves in key order.
+    """
+    if not leaf_hashes:
+        return EMPTY[0]
+    return hashlib.sha256(BUCKET_PREFIX + b"".join(leaf_hashes)).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+# The hash of an empty subtree at every level, so only the nodes above state are stored
+EMPTY = [hashlib.sha256(BUCKET_PREFIX).digest()]
+for _ in range(DEPTH):
+    EMPTY.append(node_hash(EMPTY[-1], EMPTY[-1]))
+
+
+def verify_proof(root, key, value, proof):
+    """
+    Checks a proof from StateTree.proof against a state root (hex): that key holds value, or, if value is None, that
+    key does not exist.
+    """
+    leaves = dict(proof["leaves"])
+    if value is None:
+        if key in leaves:
+            return False
+    elif leaves.get(key) != leaf_hash(key, encode(value)).hex():
+        return False
+
+    bucket = bucket_of(key)
+    node = bucket_hash([bytes.fromhex(leaves[k]) for k in sorted(leaves)])
+    if len(proof["path"]) != DEPTH:
+        return False
+
+    for sibling in proof["path"]:
+        sibling = bytes.fromhex(sibling)
+        node = node_hash(node, sibling) if bucket % 2 == 0 else node_hash(sibling, node)
+        bucket //= 2
+
+    return node.hex() == root
+
+
+class StateTree:
+    """
+    A Merkle tree of all contract state, kept up to date as the backend is written. Keys are hashed into BUCKETS
+    buckets. A bucket hashes the leaves of its keys in key order, and a binary tree of DEPTH levels hashes the buckets
+    into the root. A write only rehashes the buckets it touched and their paths to the root, so its cost is linear in
+    the number of keys written, not in the size of the state.
+
+    Leaves and non-empty nodes are kept in a SQLite database. The tree listens to the backend; writes that do not come
+    with their values are read back from it, and when all state may have changed the tree is rebuilt. The backend calls
+    begin before it writes state, which marks the tree dirty until the update for the write has been committed, so a
+    tree that missed a write, e.g. after a crash in between, is rebuilt when it is opened again.
+    """
+
+    def __init__(self, path, backend):
+        self.lock = RLock()
+        self.backend = backend
+        self.connection = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS leaves (bucket INTEGER, key TEXT, hash BLOB, PRIMARY KEY (bucket, key)) "
+            "WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS nodes (level INTEGER, position INTEGER, hash BLOB, "
+            "PRIMARY KEY (level, position)) WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (dirty INTEGER)")
+        if self.connection.execute("SELECT COUNT(*) FROM meta").fetchone()[0] == 0:
+            # A new tree has to be built from the state that is already there
+            self.connection.execute("INSERT INTO meta VALUES (1)")
+
+        # Writes that have begun and that the tree has not been updated with yet
+        self.pending = 0
+
+        backend.state_tree = self
+        backend.listeners.add(self)
+        if self.connection.execute("SELECT dirty FROM meta").fetchone()[0]:
+            self.rebuild()
+
+    def begin(self):
+        """
+        Called by the backend before it writes state.
+        """
+        with self.lock:
+            if self.pending == 0:
+                self.connection.execute("UPDATE meta SET dirty = 1")
+            self.pending += 1
+
+    def __node(self, level, position):
+        row = self.connection.execute(
+            "SELECT hash FROM nodes WHERE level = ? AND position = ?", (level, position)
+        ).fetchone()
+        return row[0] if row is not None else EMPTY[level]
+
+    def __set_node(self, level, position, value):
+        if value == EMPTY[level]:
+            self.connection.execute("DELETE FROM nodes WHERE level = ? AND position = ?", (level, position))
+        else:
+            self.connection.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)", (level, position, value))
+
+    def __bucket_leaves(self, bucket):
+        return self.connection.execute("SELECT key, hash FROM leaves WHERE bucket = ? ORDER BY key", (bucket,))
+
+    def __rehash(self, buckets):
+        positions = sorted(buckets)
+        for bucket in positions:
+            self.__set_node(0, bucket, bucket_hash([row[1] for row in self.__bucket_leaves(bucket)]))
+
+        for level in range(1, DEPTH + 1):
+            positions = sorted({position // 2 for position in positions})
+            for position in positions:
+                self.__set_node(level, position, node_hash(self.__node(level - 1, position * 2),
+                                                           self.__node(level - 1, position * 2 + 1)))
+
+    def update(self, values):
+        """
+        Applies {key: encoded value} to the tree. None deletes a key.
+        """
+        buckets = {}
+        leaves = []
+        deletes = []
+        for key, value in values.items():
+            if is_run_state_key(key):
+                continue
+            bucket = bucket_of(key)
+            buckets[bucket] = None
+            if value is None:
+                deletes.append((bucket, key))
+            else:
+                leaves.append((bucket, key, leaf_hash(key, value)))
+
+        with self.lock:
+            # The tree is clean once it has been updated with every write that began
+            pending = max(self.pending - 1, 0)
+            if not buckets and pending == self.pending:
+                return
+
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO leaves VALUES (?, ?, ?)", leaves)
+                self.connection.executemany("DELETE FROM leaves WHERE bucket = ? AND key = ?", deletes)
+                self.__rehash(buckets)
+                if pending == 0:
+                    self.connection.execute("UPDATE meta SET dirty = 0")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            self.pending = pending
+
+    def invalidate(self, keys=None):
+        """
+        Called by the backend after a write, with {key: value} if the values are known, the keys otherwise, or None if
+        all state may have changed.
+        """
+        if keys is None:
+            self.rebuild()
+        elif isinstance(keys, dict):
+            self.update({key: encode(value) if value is not None else None for key, value in keys.items()})
+        else:
+            self.update(self.backend.get_raw_many([key for key in keys if not is_run_state_key(key)]))
+
+    def rebuild(self):
+        """
+        Builds the tree from all state in the backend.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("UPDATE meta SET dirty = 1")
+                self.connection.execute("DELETE FROM leaves")
+                self.connection.execute("DELETE FROM nodes")
+                self.connection.executemany(
+                    "INSERT INTO leaves VALUES (?, ?, ?)",
+                    ((bucket_of(key), key, leaf_hash(key, value)) for key, value in self.backend.iter_items()
+                     if not is_run_state_key(key))
+                )
+                buckets = [row[0] for row in self.connection.execute("SELECT DISTINCT bucket FROM leaves")]
+                self.__rehash(buckets)
+                # Writes that began before and are not hashed in yet keep the tree dirty
+                if self.pending == 0:
+                    self.connection.execute("UPDATE meta SET dirty = 0")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def root(self):
+        """
+        Returns the state root as hex.
+        """
+        with self.lock:
+            return self.__node(DEPTH, 0).hex()
+
+    def proof(self, key):
+        """
+        Returns a proof that key holds its current value, or that it does not exist. It holds the leaves of the bucket
+        of key and the hashes of the siblings on its path to the root, see verify_proof.
+        """
+        bucket = bucket_of(key)
+        with self.lock:
+            leaves = [(k, h.hex()) for k, h in self.__bucket_leaves(bucket)]
+            path = []
+            position = bucket
+            for level in range(DEPTH):
+                path.append(self.__node(level, position ^ 1).hex())
+                position //= 2
+
+        return {"key": key, "leaves": leaves, "path": path}
+
+    def close(self):
+        with self.lock:
+            self.backend.listeners.discard(self)
+            if self.backend.state_tree is self:
+                self.backend.state_tree = None
+            self.connection.close()
+
+
+def state_tree_path(storage_home):
+    return Path(storage_home).joinpath(STATE_TREE_FILENAME)
@@ -0,0 +1,122 @@
+from contracting.storage.driver import STORAGE_HOME
+from contracting.storage.hdf5 import (HDF5Backend, LAYOUT_KEY, LAYOUT_CONTRACT, MIGRATION_FILENAME, MIGRATION_BUILDING,
+                                      MIGRATION_SWAPPING, read_layout, read_migration, write_migration,
+                                      finish_migration)
+from contracting.storage.wal import replay, wal_path
+from contracting.storage import hdf5
+from pathlib import Path
+
+import argparse
+import h5py
+import os
+import shutil
+
+STAGING_DIRNAME = hdf5.MIGRATION_DIRNAME
+BACKUP_SUFFIX = hdf5.BACKUP_SUFFIX
+
+
+def iter_key_layout(storage_home=STORAGE_HOME):
+    """
+    Yields (key, encoded value, block) for every value stored in a per-key tree. Values are not decoded.
+    """
+    storage_home = Path(storage_home)
+    for directory in (storage_home.joinpath("contract_state"), storage_home.joinpath("run_state")):
+        if not directory.is_dir():
+            continue
+
+        for filename in sorted(os.listdir(directory)):
+            file_path = str(directory.joinpath(filename))
+            with h5py.File(file_path, 'r') as f:
+                for group in f.keys():
+                    attrs = f[group].attrs
+                    if hdf5.ATTR_VALUE not in attrs:
+                        continue
+
+                    value = attrs[hdf5.ATTR_VALUE]
+                    value = value.decode() if isinstance(value, bytes) else value
+                    block = attrs.get(hdf5.ATTR_BLOCK, -1)
+                    yield group, value, block
+
+
+def _write_batch(batch):
+    for file_path, entries in batch.items():
+        with h5py.File(file_path, 'a') as f:
+            for group, value, block in entries:
+                hdf5.write_attr(f, group, hdf5.ATTR_VALUE, value)
+                hdf5.write_attr(f, group, hdf5.ATTR_BLOCK, block)
+    batch.clear()
+
+
+def migrate_to_contract_layout(storage_home=STORAGE_HOME, shards=1, keep_source=False, batch_size=100000):
+    """
+    Converts a per-key storage tree into the per-contract layout in place.
+
+    The new tree is built next to the old one and swapped in once it is complete. A marker file records the migration
+    until it is done: a tree whose migration was interrupted while building is not opened until it is migrated again,
+    which starts over, and one interrupted while swapping is finished when it is opened or migrated again. Encoded
+    values and block numbers are copied verbatim. Returns the number of keys migrated.
+    """
+    storage_home = Path(storage_home)
+
+    # The source files are read and replaced directly, so they must not be held open by the handle pool or a backend
+    hdf5.close_backend(storage_home)
+    hdf5.close_all()
+
+    staging = storage_home.joinpath(STAGING_DIRNAME)
+
+    migration = read_migration(storage_home)
+    if migration is not None:
+        if migration["phase"] == MIGRATION_SWAPPING:
+            return finish_migration(storage_home)["count"]
+        # The source tree is untouched until the swap
+        shutil.rmtree(staging, ignore_errors=True)
+        storage_home.joinpath(MIGRATION_FILENAME).unlink()
+
+    recorded = read_layout(storage_home)
+    assert recorded is None or recorded[0] == LAYOUT_KEY, f"Storage at {storage_home} is not using the per-key layout."
+
+    # Writes still waiting in a write-ahead log belong to the source tree
+    source = HDF5Backend(storage_home, index=False)
+    replay(source, wal_path(storage_home))
+    source.close()
+
+    write_migration(storage_home, phase=MIGRATION_BUILDING, layout=LAYOUT_CONTRACT, shards=shards,
+                    keep_source=keep_source)
+
+    shutil.rmtree(staging, ignore_errors=True)
+    # Files are written directly below, the key index of the tree is rebuilt when it is next opened
+    target = HDF5Backend(staging, layout=LAYOUT_CONTRACT, shards=shards, index=False)
+
+    count = 0
+    batch = {}
+    for key, value, block in iter_key_layout(storage_home):
+        file_path, group = target.location(key)
+        batch.setdefault(file_path, []).append((group, value, block))
+        count += 1
+
+        if count % batch_size == 0:
+            _write_batch(batch)
+
+    _write_batch(batch)
+    hdf5.close_all()
+
+    write_migration(storage_home, phase=MIGRATION_SWAPPING, layout=LAYOUT_CONTRACT, shards=shards,
+                    keep_source=keep_source, count=count)
+    finish_migration(storage_home)
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a per-key contracting storage tree to the per-contract layout.")
+    parser.add_argument("--storage-home", default=str(STORAGE_HOME))
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--keep-source", action="store_true", help="Keep the old tree next to the new one.")
+    args = parser.parse_args()
+
+    count = migrate_to_contract_layout(args.storage_home, shards=args.shards, keep_source=args.keep_source)
+    print(f"Migrated {count} keys in {args.storage_home}.")
+
+
+if __name__ == "__main__":
+    main()
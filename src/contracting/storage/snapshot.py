@@ -0,0 +1,194 @@
+from contracting.storage.backend import ITER_BATCH
+from contracting.storage.driver import STORAGE_HOME
+from contracting.storage.encoder import encode
+from contracting.storage.versions import MVCCBackend
+from contracting.storage import hdf5
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import argparse
+import json
+import os
+import struct
+import zlib
+
+MAGIC = b"CSNAP\x00\x00\x01"
+
+# Compressed length, CRC32 of the uncompressed payload and number of keys of a chunk. A chunk of length 0 ends the
+# file and carries the CRC32 of the chunk checksums and the number of keys in the file.
+CHUNK_HEADER = struct.Struct("<IIQ")
+
+# Keys per chunk
+CHUNK_KEYS = 10000
+
+# Chunks that are decompressed and loaded at the same time
+WORKERS = 4
+
+
+def iter_view_items(view, prefix="", batch=ITER_BATCH):
+    """
+    Yields (key, encoded value) for every key with prefix in key order from a read-only view of the state, see
+    StorageBackend.snapshot, as StorageBackend.iter_items does from the backend itself.
+    """
+    cursor = None
+    while True:
+        keys = view.iter_prefix(prefix, batch, cursor)
+        values = view.get_many(keys)
+        for key in keys:
+            if values[key] is not None:
+                yield key, encode(values[key])
+
+        if len(keys) < batch:
+            return
+        cursor = keys[-1]
+
+
+def write_snapshot(items, path, chunk_keys=CHUNK_KEYS, level=6):
+    """
+    Writes (key, encoded value) pairs, e.g. from StorageBackend.iter_items or iter_view_items, to a snapshot file at
+    path. Only one chunk is held in memory. The file is written next to path and moved there once it is complete.
+    Returns the number of keys written.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    count = 0
+    checksum = 0
+    chunk = []
+
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+
+        def write_chunk():
+            nonlocal checksum
+            payload = json.dumps(chunk, separators=(",", ":")).encode()
+            crc = zlib.crc32(payload)
+            data = zlib.compress(payload, level)
+            f.write(CHUNK_HEADER.pack(len(data), crc, len(chunk)) + data)
+            checksum = zlib.crc32(struct.pack("<I", crc), checksum)
+            chunk.clear()
+
+        for key, value in items:
+            chunk.append((key, value))
+            count += 1
+            if len(chunk) >= chunk_keys:
+                write_chunk()
+
+        if chunk:
+            write_chunk()
+
+        f.write(CHUNK_HEADER.pack(0, checksum, count))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return count
+
+
+def iter_chunks(path):
+    """
+    Yields (compressed payload, CRC32, number of keys) for every chunk of a snapshot file and checks that the file is
+    complete.
+    """
+    checksum = 0
+    count = 0
+
+    with open(path, "rb") as f:
+        assert f.read(len(MAGIC)) == MAGIC, f"{path} is not a state snapshot."
+
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            assert len(header) == CHUNK_HEADER.size, f"Snapshot {path} is truncated."
+            length, crc, keys = CHUNK_HEADER.unpack(header)
+
+            if length == 0:
+                assert crc == checksum and keys == count, f"Snapshot {path} is missing chunks."
+                return
+
+            data = f.read(length)
+            assert len(data) == length, f"Snapshot {path} is truncated."
+            checksum = zlib.crc32(struct.pack("<I", crc), checksum)
+            count += keys
+            yield data, crc, keys
+
+
+def read_chunk(data, crc, keys):
+    """
+    Returns the {key: encoded value} of a chunk.
+    """
+    try:
+        payload = zlib.decompress(data)
+    except zlib.error:
+        payload = None
+    assert payload is not None and zlib.crc32(payload) == crc, "Snapshot chunk is corrupt."
+
+    values = dict(json.loads(payload))
+    assert len(values) == keys, "Snapshot chunk is corrupt."
+    return values
+
+
+def iter_snapshot(path):
+    """
+    Yields the (key, encoded value) pairs of a snapshot file in key order.
+    """
+    for chunk in iter_chunks(path):
+        yield from read_chunk(*chunk).items()
+
+
+def load_snapshot(backend, path, workers=WORKERS):
+    """
+    Bulk loads a snapshot file into an empty backend. Chunks are decompressed, checked and written by workers threads,
+    with at most twice as many chunks in memory at a time. Returns the number of keys loaded.
+    """
+    assert len(backend.iter_prefix(length=1)) == 0, "Snapshots can only be loaded into an empty store."
+
+    def load(chunk):
+        values = read_chunk(*chunk)
+        backend.load(values)
+        return len(values)
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for chunk in iter_chunks(path):
+            futures.append(pool.submit(load, chunk))
+            if len(futures) >= workers * 2:
+                count += futures.pop(0).result()
+
+        for future in futures:
+            count += future.result()
+
+    backend.sync()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the state of a contracting storage tree to a snapshot file, "
+                                                 "or load a snapshot file into an empty one.")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path")
+    parser.add_argument("--storage-home", default=str(STORAGE_HOME))
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--height", type=int, help="Export the state as it was at a block height. The tree has to "
+                                                   "keep versions.")
+    args = parser.parse_args()
+
+    backend = hdf5.open_backend(args.storage_home)
+    if args.command == "export":
+        # From a view of the state as it is when the export starts, so blocks written meanwhile are not half in it
+        if args.height is None:
+            view = backend.snapshot()
+        else:
+            assert isinstance(backend, MVCCBackend), "Exporting at a height needs a tree that keeps versions."
+            view = backend.snapshot(args.height)
+        with view:
+            count = write_snapshot(iter_view_items(view), args.path)
+        print(f"Exported {count} keys from {args.storage_home} to {args.path}.")
+    else:
+        count = load_snapshot(backend, args.path, args.workers)
+        print(f"Imported {count} keys from {args.path} into {args.storage_home}.")
+    hdf5.close_backend(args.storage_home)
+
+
+if __name__ == "__main__":
+    main()
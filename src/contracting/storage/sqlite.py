@@ -0,0 +1,251 @@
+from contracting import constants
+from contracting.storage.backend import StorageBackend, prefix_upper_bound
+from contracting.storage.encoder import encode, decode
+from pathlib import Path
+from threading import RLock
+
+import sqlite3
+
+DB_FILENAME = "state.db"
+
+# SQLite limits the number of parameters of a statement
+MAX_VARIABLES = 900
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Keeps all state in a single SQLite database in WAL mode. The primary key index keeps keys ordered, so prefix scans
+    are range queries. Readers are never blocked by the writer and snapshots are SQLite read transactions.
+    """
+
+    def __init__(self, storage_home, filename=DB_FILENAME, synchronous="NORMAL"):
+        super().__init__()
+        self.storage_home = Path(storage_home)
+        self.storage_home.mkdir(exist_ok=True, parents=True)
+        self.path = str(self.storage_home.joinpath(filename))
+        self.synchronous = synchronous
+        self.connection = self.connect()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, block INTEGER) WITHOUT ROWID"
+        )
+
+    def connect(self):
+        # Autocommit mode, transactions are opened explicitly. Access is serialized by self.lock.
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={self.synchronous}")
+        return connection
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return decode(row[0]) if row is not None else None
+
+    def get_many(self, keys):
+        return {key: decode(value) if value is not None else None for key, value in self.get_raw_many(keys).items()}
+
+    def get_raw(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_raw_many(self, keys):
+        keys = list(keys)
+        values = dict.fromkeys(keys)
+        with self.lock:
+            for i in range(0, len(keys), MAX_VARIABLES):
+                chunk = keys[i:i + MAX_VARIABLES]
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM state WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                for key, value in rows:
+                    values[key] = value
+        return values
+
+    def write(self, values, block_num=None, encoded=False):
+        block_num = block_num if block_num is not None else constants.BLOCK_NUM_DEFAULT
+        upserts = [(key, value if encoded else encode(value), block_num)
+                   for key, value in values.items() if value is not None]
+        deletes = [(key,) for key, value in values.items() if value is None]
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", upserts)
+                self.connection.executemany("DELETE FROM state WHERE key = ?", deletes)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        with self.lock:
+            return scan(self.connection, "state", prefix, length, cursor)
+
+    def get_block(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT block FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_many(self, values, block_num=None, source=None):
+        # Snapshots are read transactions and need no copies of the values that are overwritten
+        if values:
+            self.begin_write()
+            self.write(values, block_num)
+            self.notify(values, source)
+
+    def load(self, values, block_num=None):
+        if values:
+            self.begin_write()
+            self.write(values, block_num, encoded=True)
+            self.notify(values.keys())
+
+    def snapshot(self):
+        return SQLiteSnapshot(self)
+
+    def sync(self):
+        # With synchronous=NORMAL commits are durable once the WAL is checkpointed
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def flush(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM state")
+        self.notify(None)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def scan(connection, table, prefix="", length=0, cursor=None):
+    """
+    Returns the keys of table that start with prefix in order, starting after cursor if it is given. This is a range
+    query on the primary key, so it costs O(log n + length).
+    """
+    query = f"SELECT key FROM {table} WHERE key >= ?"
+    params = [prefix]
+
+    if cursor is not None and cursor >= prefix:
+        query = f"SELECT key FROM {table} WHERE key > ?"
+        params = [cursor]
+
+    upper = prefix_upper_bound(prefix)
+    if upper is not None:
+        query += " AND key < ?"
+        params.append(upper)
+
+    query += " ORDER BY key"
+    if length > 0:
+        query += " LIMIT ?"
+        params.append(length)
+
+    return [row[0] for row in connection.execute(query, params)]
+
+
+class KeyIndex:
+    """
+    A sorted, persistent list of the keys of a backend that has no ordered key space of its own. The dirty flag is
+    set in the same transaction as the key changes and cleared once the backend has written them, so an index that
+    was left dirty by a crash is known to be stale.
+    """
+
+    def __init__(self, path, synchronous="NORMAL"):
+        self.lock = RLock()
+        self.connection = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={synchronous}")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID")
+
+    @property
+    def valid(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE name = 'dirty'").fetchone()
+        return row is not None and row[0] == 0
+
+    @property
+    def version(self):
+        """
+        Changes whenever another connection, e.g. of another process, has changed the index. Writes made through this
+        one leave it as it is.
+        """
+        with self.lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def begin(self, values):
+        """
+        Records a batch of {key: value} that is about to be written. A value of None removes the key.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO keys VALUES (?)", [(k,) for k, v in values.items() if v is not None]
+                )
+                self.connection.executemany(
+                    "DELETE FROM keys WHERE key = ?", [(k,) for k, v in values.items() if v is None]
+                )
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('dirty', 1)")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def end(self):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('dirty', 0)")
+
+    def rebuild(self, keys):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("DELETE FROM keys")
+                self.connection.executemany("INSERT OR IGNORE INTO keys VALUES (?)", ((k,) for k in keys))
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('dirty', 0)")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def scan(self, prefix="", length=0, cursor=None):
+        with self.lock:
+            return scan(self.connection, "keys", prefix, length, cursor)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SQLiteSnapshot:
+    """
+    A read transaction on its own connection. In WAL mode it keeps seeing the database as it was when it started.
+    """
+
+    def __init__(self, backend):
+        self.connection = backend.connect()
+        self.connection.execute("BEGIN")
+        # The snapshot is taken by the first read of the transaction
+        self.connection.execute("SELECT 1 FROM state LIMIT 1").fetchall()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return decode(row[0]) if row is not None else None
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        return scan(self.connection, "state", prefix, length, cursor)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.execute("ROLLBACK")
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,300 @@
+from contracting.storage.backend import StorageBackend, merge_changes, prefix_upper_bound
+from contracting.storage.encoder import encode, decode
+from contracting.storage.sqlite import MAX_VARIABLES
+from pathlib import Path
+from threading import RLock
+
+import sqlite3
+import weakref
+
+VERSIONS_FILENAME = "versions.db"
+
+# Height of the version that holds the value a key had before its first versioned write
+BASE_HEIGHT = -1
+
+# Writes between two automatic prunes
+PRUNE_INTERVAL = 100
+
+
+class VersionStore:
+    """
+    Every value every key had, by block height, in a SQLite table ordered by key and height. A NULL value means the key
+    did not exist from that height on.
+    """
+
+    def __init__(self, path, synchronous="NORMAL"):
+        self.lock = RLock()
+        self.connection = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={synchronous}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS versions (key TEXT, height INTEGER, value TEXT, PRIMARY KEY (key, height)) "
+            "WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID")
+
+    def __meta(self, name, default):
+        row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else default
+
+    @property
+    def latest(self):
+        with self.lock:
+            return self.__meta("latest", BASE_HEIGHT)
+
+    @property
+    def pruned(self):
+        """
+        Versions below this height have been pruned and can not be read anymore.
+        """
+        with self.lock:
+            return self.__meta("pruned", BASE_HEIGHT)
+
+    def versioned(self, keys):
+        """
+        Returns the keys that have at least one version.
+        """
+        keys = list(keys)
+        found = []
+        with self.lock:
+            for i in range(0, len(keys), MAX_VARIABLES):
+                chunk = keys[i:i + MAX_VARIABLES]
+                found.extend(row[0] for row in self.connection.execute(
+                    f"SELECT DISTINCT key FROM versions WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+                ))
+        return found
+
+    def add(self, values, height, bases):
+        """
+        Records {key: value} at height, and {key: value} of bases as what the keys held before they were versioned.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO versions VALUES (?, ?, ?)",
+                    [(key, BASE_HEIGHT, encode(value)) for key, value in bases.items()]
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO versions VALUES (?, ?, ?)",
+                    [(key, height, encode(value) if value is not None else None) for key, value in values.items()]
+                )
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('latest', ?)", (height,))
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def get(self, key, height):
+        """
+        Returns (True, value) with the value key had at height, or (False, None) if the key has not changed since
+        before its first versioned write and its current value is the one it had at height.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM versions WHERE key = ? AND height <= ? ORDER BY height DESC LIMIT 1", (key, height)
+            ).fetchone()
+            if row is not None:
+                return True, decode(row[0]) if row[0] is not None else None
+
+            changed = self.connection.execute("SELECT 1 FROM versions WHERE key = ? LIMIT 1", (key,)).fetchone()
+        # Written after height for the first time, and there was nothing before that
+        if changed is not None:
+            return True, None
+        return False, None
+
+    def changed_since(self, prefix, height, cursor=None):
+        """
+        Returns the keys with prefix that were written after height in order, starting after cursor if it is given.
+        """
+        query = "SELECT DISTINCT key FROM versions WHERE key >= ? AND height > ?"
+        params = [prefix, height]
+        if cursor is not None and cursor >= prefix:
+            query = "SELECT DISTINCT key FROM versions WHERE key > ? AND height > ?"
+            params = [cursor, height]
+        upper = prefix_upper_bound(prefix)
+        if upper is not None:
+            query += " AND key < ?"
+            params.append(upper)
+        query += " ORDER BY key"
+
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query, params)]
+
+    def prune(self, height):
+        """
+        Drops the versions that no read at height or above needs: all but the newest version at or below height.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "DELETE FROM versions WHERE height < ? AND height < "
+                    "(SELECT MAX(v.height) FROM versions v WHERE v.key = versions.key AND v.height <= ?)",
+                    (height, height)
+                )
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('pruned', MAX(?, "
+                                        "COALESCE((SELECT value FROM meta WHERE name = 'pruned'), ?)))",
+                                        (height, BASE_HEIGHT))
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM versions").fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM versions")
+            self.connection.execute("DELETE FROM meta")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MVCCBackend(StorageBackend):
+    """
+    Keeps the versions of every key by block height next to another backend, which keeps holding the latest values and
+    answers all reads that are not for a past height.
+
+    Writes must come with non-decreasing block numbers, heights rather than timestamps, as retain counts heights. A
+    write without one is put at the height after the latest. With retain set, versions that are not needed for reads
+    at latest - retain or above are pruned every PRUNE_INTERVAL writes; otherwise call prune(height) to do so.
+
+    Reads at a height hold the lock writes hold, as a write records the versions before it changes the backend. The
+    latest height can be written again, but not while a snapshot of it is open.
+    """
+
+    def __init__(self, backend, path, retain=None):
+        super().__init__()
+        self.backend = backend
+        self.versions = VersionStore(path)
+        self.retain = retain
+        self.writes = 0
+        # The open VersionSnapshots
+        self.views = weakref.WeakSet()
+
+    @property
+    def latest(self):
+        return self.versions.latest
+
+    def write(self, values, block_num=None):
+        # Called with self.lock held
+        latest = self.versions.latest
+        height = int(block_num) if block_num is not None else latest + 1
+        assert height >= latest, f"Can not write height {height}, the latest height is {latest}."
+        assert height > latest or all(view.height != height for view in self.views), \
+            f"Can not write height {height} again while a snapshot of it is open."
+
+        # The value a key held before its first versioned write is its version for all heights before that
+        versioned = set(self.versions.versioned(values.keys()))
+        new = [key for key in values if key not in versioned]
+        bases = {key: value for key, value in self.backend.get_many(new).items() if value is not None}
+
+        self.versions.add(values, height, bases)
+        self.backend.set_many(values, height)
+
+        self.writes += 1
+        if self.retain is not None and self.writes % PRUNE_INTERVAL == 0:
+            self.prune(height - self.retain)
+
+    def prune(self, height):
+        self.versions.prune(height)
+        self.stats["version_prunes"] += 1
+
+    def get_at(self, key, height):
+        assert height >= self.versions.pruned, (f"Versions below height {self.versions.pruned} have been pruned, "
+                                                f"{height} can not be read.")
+        with self.lock:
+            versioned, value = self.versions.get(key, height)
+            if versioned:
+                return value
+            return self.backend.get(key)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_many(self, keys):
+        return self.backend.get_many(keys)
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        return self.backend.iter_prefix(prefix, length, cursor)
+
+    def iter_prefix_at(self, height, prefix="", length=0, cursor=None):
+        with self.lock:
+            changed = [(key, self.get_at(key, height) is not None)
+                       for key in self.versions.changed_since(prefix, height, cursor)]
+            return merge_changes(self.backend.iter_prefix, changed, prefix, length, cursor)
+
+    def snapshot(self, height=None):
+        """
+        Returns a read-only view of the state at height, the latest height by default.
+        """
+        view = VersionSnapshot(self, height if height is not None else self.versions.latest)
+        with self.lock:
+            self.views.add(view)
+        return view
+
+    def is_file(self, filename):
+        return self.backend.is_file(filename)
+
+    def flush_file(self, filename):
+        self.backend.flush_file(filename)
+        self.notify(None)
+
+    def get_contract_files(self):
+        return self.backend.get_contract_files()
+
+    def get_all_contract_state(self):
+        return self.backend.get_all_contract_state()
+
+    def get_run_state(self):
+        return self.backend.get_run_state()
+
+    def sync(self):
+        self.backend.sync()
+
+    def flush(self):
+        self.backend.flush()
+        self.versions.clear()
+        self.notify(None)
+
+    def close(self):
+        self.backend.close()
+        self.versions.close()
+
+
+class VersionSnapshot:
+    """
+    The state as it was at a block height. Later writes do not change what it reads.
+    """
+
+    def __init__(self, backend, height):
+        self.backend = backend
+        self.height = height
+
+    def get(self, key):
+        return self.backend.get_at(key, self.height)
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        return self.backend.iter_prefix_at(self.height, prefix, length, cursor)
+
+    def close(self):
+        with self.backend.lock:
+            self.backend.views.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def versions_path(storage_home):
+    return Path(storage_home).joinpath(VERSIONS_FILENAME)
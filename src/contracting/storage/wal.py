@@ -0,0 +1,304 @@
+from contracting import constants
+from contracting.storage.backend import StorageBackend
+from contracting.storage.encoder import encode, decode
+from pathlib import Path
+from threading import Condition, Thread
+
+import os
+import struct
+import weakref
+import zlib
+
+WAL_FILENAME = "state.wal"
+
+# Payload length and CRC32 of the payload
+RECORD_HEADER = struct.Struct("<II")
+
+# Records that are applied together when the log is applied lazily
+MAX_PENDING = 64
+
+# The logs of this process that are not closed yet
+open_logs = weakref.WeakSet()
+
+
+def read_records(path):
+    """
+    Returns the (block_num, writes) records of a log and the offset where the intact part of it ends. A record that was
+    torn by a crash, and anything after it, is not returned.
+    """
+    records = []
+    offset = 0
+
+    if not os.path.isfile(path):
+        return records, offset
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+
+        record = decode(payload.decode())
+        records.append((record["block"], record["writes"]))
+        offset = start + length
+
+    return records, offset
+
+
+def replay(backend, path):
+    """
+    Applies the records of a log to a backend and empties the log. Returns the number of records applied.
+    """
+    records, end = read_records(path)
+    for block_num, writes in records:
+        backend.set_many(writes, block_num)
+
+    if records:
+        backend.sync()
+
+    if os.path.isfile(path) and (records or end < os.path.getsize(path)):
+        # The records are applied and a torn tail is useless
+        with open(path, "r+b") as f:
+            f.truncate(0)
+            os.fsync(f.fileno())
+
+    return len(records)
+
+
+class WALBackend(StorageBackend):
+    """
+    Puts an append-only write-ahead log in front of another backend. A batch of writes is appended to the log and
+    fsynced once, which makes it durable, and is applied to the backend later: by a background thread, or, with
+    background=False, every max_pending batches. Batches that wait to be applied are merged and written in one go.
+
+    Until then reads are answered from an overlay of the unapplied writes. Once the backend has applied and synced
+    everything in the log, the log is truncated. Opening a log that still holds records, e.g. after a crash, replays
+    them into the backend.
+
+    If the backend fails to apply some records, they stay in the log and wait to be applied again. The background
+    thread keeps the error and stops applying until it has been raised from the next write, drain or close.
+    """
+
+    def __init__(self, backend, path, background=True, max_pending=MAX_PENDING):
+        super().__init__()
+        self.backend = backend
+        self.path = str(path)
+        self.background = background
+        self.max_pending = max_pending
+
+        # {key: (sequence number of the batch that wrote it, value)}
+        self.overlay = {}
+        self.pending = []
+        self.sequence = 0
+        self.applied = 0
+        self.condition = Condition(self.lock)
+        self.closed = False
+        self.error = None
+
+        self.stats["wal_replayed"] += replay(self.backend, self.path)
+        self.file = open(self.path, "ab")
+
+        self.thread = None
+        if background:
+            self.thread = Thread(target=self.__run, name="wal-apply", daemon=True)
+            self.thread.start()
+        open_logs.add(self)
+
+    def __append(self, values, block_num):
+        payload = encode({"block": block_num, "writes": values}).encode()
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __raise_error(self):
+        # Called with self.lock held
+        if self.error is not None:
+            error, self.error = self.error, None
+            self.condition.notify_all()
+            raise error
+
+    def write(self, values, block_num=None):
+        # Called with self.lock held
+        self.__raise_error()
+        block_num = block_num if block_num is not None else constants.BLOCK_NUM_DEFAULT
+        self.__append(values, block_num)
+
+        self.sequence += 1
+        for key, value in values.items():
+            self.overlay[key] = (self.sequence, value)
+        self.pending.append((self.sequence, block_num, dict(values)))
+        self.stats["wal_records"] += 1
+
+        if self.background:
+            self.condition.notify_all()
+        elif len(self.pending) >= self.max_pending:
+            self.apply()
+
+    def apply(self):
+        """
+        Applies every record that is waiting in the log to the backend and truncates the log.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, []
+
+        # Applied outside the lock, so reads are answered from the overlay meanwhile. Only the last write of a key is
+        # applied, with the block number of the batch it came from.
+        latest = {}
+        for _, block_num, values in pending:
+            for key, value in values.items():
+                latest[key] = (block_num, value)
+
+        blocks = {}
+        for key, (block_num, value) in latest.items():
+            blocks.setdefault(block_num, {})[key] = value
+
+        try:
+            for block_num, writes in blocks.items():
+                self.backend.set_many(writes, block_num)
+            self.backend.sync()
+        except Exception:
+            with self.lock:
+                # Applying them again writes the same values, so the records go back in front of the later ones
+                self.pending[:0] = pending
+                self.stats["wal_apply_errors"] += 1
+            raise
+
+        with self.lock:
+            last = pending[-1][0]
+            for key in list(self.overlay):
+                if self.overlay[key][0] <= last:
+                    del self.overlay[key]
+            self.applied = last
+
+            if not self.pending:
+                self.file.truncate(0)
+                self.file.seek(0)
+
+            self.stats["wal_applies"] += 1
+            self.condition.notify_all()
+
+    def __run(self):
+        while True:
+            with self.lock:
+                while (not self.pending or self.error is not None) and not self.closed:
+                    self.condition.wait()
+                if self.closed and (not self.pending or self.error is not None):
+                    return
+            try:
+                self.apply()
+            except Exception as e:
+                with self.lock:
+                    self.error = e
+                    self.condition.notify_all()
+
+    def drain(self):
+        """
+        Waits until everything in the log has been applied to the backend.
+        """
+        if not self.background:
+            self.apply()
+            return
+
+        with self.lock:
+            while self.applied < self.sequence:
+                self.__raise_error()
+                self.condition.wait()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.overlay.get(key)
+        if entry is not None:
+            return entry[1]
+        return self.backend.get(key)
+
+    def get_many(self, keys):
+        values = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                entry = self.overlay.get(key)
+                if entry is None:
+                    missing.append(key)
+                else:
+                    values[key] = entry[1]
+        values.update(self.backend.get_many(missing))
+        return values
+
+    def iter_prefix(self, prefix="", length=0, cursor=None):
+        with self.lock:
+            overlay = {key: entry[1] for key, entry in self.overlay.items()
+                       if key.startswith(prefix) and (cursor is None or key > cursor)}
+
+        if not overlay:
+            return self.backend.iter_prefix(prefix, length, cursor)
+
+        keys = set(self.backend.iter_prefix(prefix, cursor=cursor))
+        for key, value in overlay.items():
+            if value is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+
+        keys = sorted(keys)
+        return keys if length == 0 else keys[:length]
+
+    def is_file(self, filename):
+        self.drain()
+        return self.backend.is_file(filename)
+
+    def flush_file(self, filename):
+        self.drain()
+        self.backend.flush_file(filename)
+        self.notify(None)
+
+    def get_contract_files(self):
+        self.drain()
+        return self.backend.get_contract_files()
+
+    def get_all_contract_state(self):
+        self.drain()
+        return self.backend.get_all_contract_state()
+
+    def get_run_state(self):
+        self.drain()
+        return self.backend.get_run_state()
+
+    def sync(self):
+        self.drain()
+
+    def flush(self):
+        self.drain()
+        self.backend.flush()
+        self.notify(None)
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            # Records that could not be applied stay in the log and are replayed when it is opened again
+            with self.lock:
+                self.closed = True
+                self.condition.notify_all()
+            if self.thread is not None:
+                self.thread.join()
+            self.file.close()
+            self.backend.close()
+            open_logs.discard(self)
+
+
+def close_logs():
+    """
+    Closes every log of this process that is still open, so no apply thread is left writing to a backend.
+    """
+    for log in list(open_logs):
+        log.close()
+
+
+def wal_path(storage_home):
+    return Path(storage_home).joinpath(WAL_FILENAME)
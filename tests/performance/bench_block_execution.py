@@ -0,0 +1,42 @@
+import argparse
+import secrets
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+
+CONTRACT = Path(__file__).parent.parent.joinpath('integration', 'test_contracts', 'erc20_clone.s.py')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txs', type=int, default=10000)
+    parser.add_argument('--window', type=int, default=2000)
+    args = parser.parse_args()
+
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        client = ContractingClient(driver=Driver(storage_home=storage_home))
+        with open(CONTRACT) as f:
+            client.submit(f.read(), name='con_erc20_clone')
+
+        # One block: nothing is committed, so the pending writes grow with every transaction
+        print(f'{"txs in block":>14}{"tx/s":>10}')
+        start = time.perf_counter()
+        for i in range(1, args.txs + 1):
+            client.executor.execute('stu', 'con_erc20_clone', 'transfer',
+                                    {'amount': 1, 'to': secrets.token_hex(16)})
+            if i % args.window == 0:
+                now = time.perf_counter()
+                print(f'{i:>14}{args.window / (now - start):>10.0f}')
+                start = now
+    finally:
+        hdf5.close_backend(storage_home)
+        rmtree(storage_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
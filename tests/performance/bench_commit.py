@@ -0,0 +1,58 @@
+import argparse
+import secrets
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver, LAYOUT_KEY, LAYOUT_CONTRACT
+from contracting.storage import hdf5
+
+
+def block(writes, contracts):
+    return {f'con_token_{i % contracts}.balances:{secrets.token_hex(32)}': i for i in range(writes)}
+
+
+def commit_per_key(d, writes):
+    # The commit loop before writes were grouped by file
+    for k, v in writes.items():
+        hdf5.set_value_to_disk(*d.backend.location(k), v, None)
+    hdf5.flush()
+
+
+def commit_batched(d, writes):
+    d.pending_writes.update(writes)
+    d.commit()
+
+
+def bench(layout, writes, commit, wal=False):
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        d = Driver(storage_home=storage_home, layout=layout, wal=wal)
+        start = time.perf_counter()
+        commit(d, writes)
+        return time.perf_counter() - start
+    finally:
+        hdf5.close_backend(storage_home)
+        hdf5.close_all()
+        rmtree(storage_home, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writes', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f'commit latency for a {args.writes}-write block')
+    print(f'{"layout":<10}{"contracts":>10}{"per key ms":>14}{"batched ms":>14}{"wal ms":>14}')
+    for layout in (LAYOUT_KEY, LAYOUT_CONTRACT):
+        for contracts in (1, 10, 100):
+            writes = block(args.writes, contracts)
+            per_key = bench(layout, writes, commit_per_key)
+            batched = bench(layout, writes, commit_batched)
+            # Until the record is appended and fsynced, applying it to the tree happens in the background
+            wal = bench(layout, writes, commit_batched, wal=True)
+            print(f'{layout:<10}{contracts:>10}{per_key * 1000:>14.0f}{batched * 1000:>14.0f}{wal * 1000:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
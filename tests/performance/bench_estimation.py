@@ -0,0 +1,62 @@
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.estimation import StampEstimator
+
+CONTRACT = Path(__file__).parent.parent.joinpath('integration', 'test_contracts', 'erc20_clone.s.py')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--estimates', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=16)
+    args = parser.parse_args()
+
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        with open(CONTRACT) as f:
+            client.submit(f.read(), name='con_erc20_clone')
+        driver.commit()
+
+        # Every estimate has different arguments, so none is served from the cache
+        txs = [('stu', 'con_erc20_clone', 'transfer', {'amount': 1, 'to': f'account_{i}'})
+               for i in range(args.estimates)]
+
+        executor = Executor(driver=driver, metering=True, currency_contract='con_erc20_clone',
+                            balances_hash='balances', bypass_balance_amount=True)
+        start = time.perf_counter()
+        for tx in txs:
+            executor.execute(*tx)
+            driver.rollback()
+        serial = time.perf_counter() - start
+
+        with StampEstimator(executor, workers=args.workers) as estimator:
+            with ThreadPoolExecutor(args.clients) as clients:
+                start = time.perf_counter()
+                list(clients.map(lambda tx: estimator.estimate(*tx), txs))
+                pooled = time.perf_counter() - start
+
+                start = time.perf_counter()
+                list(clients.map(lambda tx: estimator.estimate(*tx), txs))
+                cached = time.perf_counter() - start
+
+        print(f'serial: {args.estimates / serial:>10.0f} estimates/s')
+        print(f'pool:   {args.estimates / pooled:>10.0f} estimates/s')
+        print(f'cached: {args.estimates / cached:>10.0f} estimates/s')
+    finally:
+        hdf5.close_backend(storage_home)
+        rmtree(storage_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
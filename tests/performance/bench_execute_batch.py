@@ -0,0 +1,50 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+
+CONTRACT = Path(__file__).parent.parent.joinpath('integration', 'test_contracts', 'erc20_clone.s.py')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txs', type=int, default=5000)
+    args = parser.parse_args()
+
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        with open(CONTRACT) as f:
+            client.submit(f.read(), name='con_erc20_clone')
+        driver.commit()
+
+        executor = Executor(driver=driver, metering=False)
+        txs = [{'sender': 'stu', 'contract_name': 'con_erc20_clone', 'function_name': 'transfer',
+                'kwargs': {'amount': 1, 'to': f'account_{i}'}} for i in range(args.txs)]
+
+        start = time.perf_counter()
+        for tx in txs:
+            executor.execute(**tx)
+        serial = time.perf_counter() - start
+        driver.rollback()
+
+        start = time.perf_counter()
+        executor.execute_batch(txs)
+        batch = time.perf_counter() - start
+        driver.rollback()
+
+        print(f'execute:       {args.txs / serial:>10.0f} tx/s')
+        print(f'execute_batch: {args.txs / batch:>10.0f} tx/s')
+    finally:
+        hdf5.close_backend(storage_home)
+        rmtree(storage_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.runtime import RuntimeState
+from contracting.execution.metering import monitoring
+
+CONTRACT = Path(__file__).parent.parent.joinpath('integration', 'test_contracts', 'erc20_clone.s.py')
+
+
+def run(executor, txs, metering):
+    start = time.perf_counter()
+    for tx in txs:
+        output = executor.execute(*tx, metering=metering)
+        assert output['status_code'] == 0, output['result']
+    executor.driver.rollback()
+    return (time.perf_counter() - start) / len(txs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=5000)
+    args = parser.parse_args()
+
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        with open(CONTRACT) as f:
+            client.submit(f.read(), name='con_erc20_clone')
+        driver.commit()
+
+        txs = [('stu', 'con_erc20_clone', 'transfer', {'amount': 1, 'to': f'account_{i}'})
+               for i in range(args.transactions)]
+
+        engines = {
+            'tracer': RuntimeState(metering='tracer'),
+            'allocs': RuntimeState(metering='tracer', memory_metering='allocations'),
+        }
+        if monitoring.AVAILABLE:
+            engines['monitoring'] = RuntimeState(metering='monitoring')
+
+        timings = {}
+        for engine, state in engines.items():
+            executor = Executor(driver=driver, metering=True, currency_contract='con_erc20_clone',
+                                balances_hash='balances', runtime_state=state)
+            run(executor, txs[:100], True)
+            timings[engine] = run(executor, txs, True)
+            if engine == 'tracer':
+                timings['none'] = run(executor, txs, False)
+
+        for engine, per_tx in timings.items():
+            overhead = per_tx - timings['none']
+            print(f'{engine:<10} {per_tx * 1e6:>8.1f} us/tx {overhead * 1e6:>8.1f} us/tx of metering')
+        if not monitoring.AVAILABLE:
+            print('monitoring needs Python 3.12 or later')
+    finally:
+        hdf5.close_backend(storage_home)
+        rmtree(storage_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.parallel import ParallelExecutor
+
+TOKEN = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 12
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txs', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    # Accounts the transfers are between: fewer accounts means more transactions touch the same balances
+    parser.add_argument('--contention', type=int, nargs='+', default=[2, 10, 100, 10000])
+    args = parser.parse_args()
+
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        client.submit(TOKEN, name='con_token')
+
+        accounts = [f'account_{i}' for i in range(max(args.contention))]
+        for account in accounts:
+            client.executor.execute('stu', 'con_token', 'transfer', {'amount': 10 ** 6, 'to': account})
+        driver.commit()
+
+        executor = Executor(driver=driver, metering=True, currency_contract='con_token', balances_hash='balances')
+
+        print(f'{"accounts":>10}{"serial tx/s":>14}{"parallel tx/s":>16}{"retries":>10}')
+        with ParallelExecutor(executor, workers=args.workers) as parallel:
+            for contention in args.contention:
+                rng = random.Random(contention)
+                txs = []
+                for _ in range(args.txs):
+                    sender, to = rng.sample(accounts[:contention], 2)
+                    txs.append({'sender': sender, 'contract_name': 'con_token', 'function_name': 'transfer',
+                                'kwargs': {'amount': 1, 'to': to}})
+
+                start = time.perf_counter()
+                for tx in txs:
+                    executor.execute(**tx)
+                serial = time.perf_counter() - start
+                driver.rollback()
+
+                parallel.stats.clear()
+                start = time.perf_counter()
+                parallel.execute_block(txs)
+                elapsed = time.perf_counter() - start
+                driver.rollback()
+
+                print(f'{contention:>10}{args.txs / serial:>14.0f}{args.txs / elapsed:>16.0f}'
+                      f'{parallel.stats["retries"]:>10}')
+    finally:
+        hdf5.close_backend(storage_home)
+        rmtree(storage_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+
+CONTRACT = Path(__file__).parent.parent.joinpath('integration', 'test_contracts', 'erc20_clone.s.py')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=10000)
+    args = parser.parse_args()
+
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        with open(CONTRACT) as f:
+            client.submit(f.read(), name='con_erc20_clone')
+        driver.commit()
+
+        # Transactions pay their stamps from the balances of the token itself
+        executor = Executor(driver=driver, metering=True, currency_contract='con_erc20_clone', balances_hash='balances')
+
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            executor.execute('stu', 'con_erc20_clone', 'balance_of', {'account': 'stu'})
+        execute = time.perf_counter() - start
+        driver.rollback()
+
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            executor.query('con_erc20_clone', 'balance_of', {'account': 'stu'})
+        query = time.perf_counter() - start
+
+        # Queries hold Runtime.lock, so while another thread executes transactions they wait for each of them
+        stop = threading.Event()
+        transactions = []
+
+        def execute_transfers():
+            while not stop.is_set():
+                executor.execute('stu', 'con_erc20_clone', 'transfer', {'amount': 1, 'to': 'someone'})
+                transactions.append(1)
+
+        thread = threading.Thread(target=execute_transfers)
+        thread.start()
+        waits = []
+        try:
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                call = time.perf_counter()
+                executor.query('con_erc20_clone', 'balance_of', {'account': 'stu'})
+                waits.append(time.perf_counter() - call)
+            contended = time.perf_counter() - start
+        finally:
+            stop.set()
+            thread.join()
+        driver.rollback()
+
+        waits.sort()
+        print(f'execute: {args.calls / execute:>10.0f} calls/s')
+        print(f'query:   {args.calls / query:>10.0f} calls/s')
+        print(f'query while transactions run: {args.calls / contended:>10.0f} calls/s, '
+              f'{len(transactions) / contended:.0f} tx/s, '
+              f'p50 {waits[len(waits) // 2] * 1e6:.0f} us, p99 {waits[len(waits) * 99 // 100] * 1e6:.0f} us')
+    finally:
+        hdf5.close_backend(storage_home)
+        rmtree(storage_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
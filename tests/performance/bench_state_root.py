@@ -0,0 +1,69 @@
+import argparse
+import hashlib
+import secrets
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver
+from contracting.storage.encoder import encode
+from contracting.storage.sqlite import SQLiteBackend
+from contracting.storage.merkle import StateTree, STATE_TREE_FILENAME
+
+
+def full_hash(d):
+    # What an app hash cost before: hash all contract state after every block
+    h = hashlib.sha256()
+    for k, v in sorted(d.get_all_contract_state().items()):
+        h.update(k.encode())
+        h.update(encode(v).encode())
+    return h.hexdigest()
+
+
+def bench(keys, writes, blocks):
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        backend = SQLiteBackend(storage_home)
+        state = {f'con_token_{i % 10}.balances:{secrets.token_hex(32)}': i for i in range(keys)}
+        backend.set_many(state)
+
+        start = time.perf_counter()
+        tree = StateTree(storage_home.joinpath(STATE_TREE_FILENAME), backend)
+        build = time.perf_counter() - start
+
+        d = Driver(backend=backend)
+        existing = list(state)
+        start = time.perf_counter()
+        for b in range(blocks):
+            for i in range(writes):
+                d.set(existing[(b * writes + i) % keys], b)
+            d.hard_apply(b)
+            tree.root()
+        incremental = (time.perf_counter() - start) / blocks
+
+        start = time.perf_counter()
+        full_hash(d)
+        full = time.perf_counter() - start
+
+        tree.close()
+        backend.close()
+        return build, incremental, full
+    finally:
+        rmtree(storage_home, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writes', type=int, default=100)
+    parser.add_argument('--blocks', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'state root per block of {args.writes} writes')
+    print(f'{"keys":>10}{"build s":>12}{"commit+root ms":>18}{"full hash ms":>16}')
+    for keys in (10000, 100000, 1000000):
+        build, incremental, full = bench(keys, args.writes, args.blocks)
+        print(f'{keys:>10}{build:>12.2f}{incremental * 1000:>18.1f}{full * 1000:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import secrets
+import tempfile
+import time
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver, LAYOUT_KEY, LAYOUT_CONTRACT
+from contracting.storage.sqlite import SQLiteBackend
+
+
+def bench(layout, keys, shards=1):
+    storage_home = Path(tempfile.mkdtemp())
+    try:
+        if layout == 'sqlite':
+            d = Driver(backend=SQLiteBackend(storage_home))
+        else:
+            d = Driver(storage_home=storage_home, layout=layout, shards=shards)
+
+        for i, k in enumerate(keys):
+            d.set(k, i)
+
+        start = time.perf_counter()
+        d.commit()
+        commit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for k in keys:
+            d.get(k)
+        read_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        d.iter_from_disk(prefix='con_token_0.balances:')
+        scan_time = time.perf_counter() - start
+
+        # Keys that were never written, read through a fresh driver so its cache does not answer
+        d = Driver(backend=d.backend)
+        start = time.perf_counter()
+        for k in keys:
+            d.get(k + '0')
+        miss_time = time.perf_counter() - start
+
+        return commit_time, read_time, scan_time, miss_time
+    finally:
+        rmtree(storage_home, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--contracts', type=int, default=5)
+    args = parser.parse_args()
+
+    keys = [f'con_token_{i % args.contracts}.balances:{secrets.token_hex(32)}' for i in range(args.keys)]
+
+    print(f'{args.keys} keys over {args.contracts} contracts')
+    print(f'{"layout":<16}{"commit keys/s":>16}{"read keys/s":>16}{"prefix scan s":>16}{"misses/s":>16}')
+    for name, layout, shards in (('key', LAYOUT_KEY, 1),
+                                 ('contract', LAYOUT_CONTRACT, 1),
+                                 ('contract x4', LAYOUT_CONTRACT, 4),
+                                 ('sqlite', 'sqlite', 1)):
+        commit_time, read_time, scan_time, miss_time = bench(layout, keys, shards)
+        print(f'{name:<16}{len(keys) / commit_time:>16.0f}{len(keys) / read_time:>16.0f}{scan_time:>16.3f}'
+              f'{len(keys) / miss_time:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
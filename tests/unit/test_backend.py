@@ -0,0 +1,510 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver, LAYOUT_CONTRACT
+from contracting.storage import hdf5
+from contracting.storage.hdf5 import HDF5Backend, INDEX_FILENAME, BLOOM_DIRNAME
+from contracting.storage.bloom import BloomFilter
+from contracting.storage.wal import WALBackend, WAL_FILENAME
+from contracting.storage.sqlite import SQLiteBackend
+from contracting.storage.versions import MVCCBackend, VERSIONS_FILENAME
+from contracting.storage.merkle import STATE_TREE_FILENAME
+from contracting.storage.backend import prefix_upper_bound
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+
+
+class BackendTests:
+    def make_backend(self, storage_home):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.backend = self.make_backend(self.storage_home)
+
+    def tearDown(self):
+        self.backend.close()
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_set_many_and_get(self):
+        self.backend.set_many({'currency.balances:a': 1, 'currency.balances:b': ContractingDecimal('1.5'),
+                               'con_thing.owner': 'stu'})
+
+        self.assertEqual(self.backend.get('currency.balances:a'), 1)
+        self.assertEqual(self.backend.get('currency.balances:b'), ContractingDecimal('1.5'))
+        self.assertIsNone(self.backend.get('currency.balances:c'))
+        self.assertEqual(self.backend.get_many(['con_thing.owner', 'con_thing.x']),
+                         {'con_thing.owner': 'stu', 'con_thing.x': None})
+
+    def test_none_deletes(self):
+        self.backend.set_many({'currency.balances:a': 1, 'currency.balances:b': 2})
+        self.backend.set_many({'currency.balances:a': None})
+        self.backend.delete_many(['currency.balances:b'])
+
+        self.assertIsNone(self.backend.get('currency.balances:a'))
+        self.assertEqual(self.backend.iter_prefix('currency.'), [])
+
+    def test_iter_prefix_is_sorted(self):
+        self.backend.set_many({f'currency.balances:{i}': i for i in (3, 1, 2)})
+        self.backend.set_many({'currency.supply': 6, 'currencyx.balances:a': 1})
+
+        self.assertEqual(self.backend.iter_prefix('currency.balances:'),
+                         ['currency.balances:1', 'currency.balances:2', 'currency.balances:3'])
+        self.assertEqual(self.backend.iter_prefix('currency.balances:', length=2),
+                         ['currency.balances:1', 'currency.balances:2'])
+
+    def test_cursor_pagination(self):
+        keys = [f'currency.balances:{i:03}' for i in range(25)]
+        self.backend.set_many({key: 1 for key in keys})
+        self.backend.set_many({'currency.supply': 1, 'con_thing.owner': 'stu'})
+
+        pages = []
+        cursor = None
+        while True:
+            page = self.backend.iter_prefix('currency.balances:', length=10, cursor=cursor)
+            if not page:
+                break
+            pages.append(page)
+            cursor = page[-1]
+
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), keys)
+
+    def test_snapshot_does_not_see_later_writes(self):
+        self.backend.set_many({'currency.balances:a': 1, 'currency.balances:b': 2})
+
+        with self.backend.snapshot() as snapshot:
+            self.backend.set_many({'currency.balances:a': 10, 'currency.balances:b': None, 'currency.balances:c': 3})
+
+            self.assertEqual(snapshot.get('currency.balances:a'), 1)
+            self.assertEqual(snapshot.get('currency.balances:b'), 2)
+            self.assertIsNone(snapshot.get('currency.balances:c'))
+            self.assertEqual(snapshot.iter_prefix('currency.'), ['currency.balances:a', 'currency.balances:b'])
+
+        self.assertEqual(self.backend.get('currency.balances:a'), 10)
+
+    def test_snapshot_pages(self):
+        self.backend.set_many({f'currency.balances:{i:03}': i for i in range(100)})
+
+        with self.backend.snapshot() as snapshot:
+            # Changed, deleted and new keys, in every page
+            self.backend.set_many({f'currency.balances:{i:03}': -i for i in range(0, 100, 7)})
+            self.backend.set_many({f'currency.balances:{i:03}': None for i in range(3, 100, 11)})
+            self.backend.set_many({f'currency.balances:{i:03}x': i for i in range(0, 100, 5)})
+
+            pages = []
+            cursor = None
+            while True:
+                page = snapshot.iter_prefix('currency.', 10, cursor)
+                pages.append(page)
+                if len(page) < 10:
+                    break
+                cursor = page[-1]
+
+        self.assertEqual(sum(pages, []), [f'currency.balances:{i:03}' for i in range(100)])
+
+    def test_flush(self):
+        self.backend.set_many({'currency.balances:a': 1})
+        self.backend.flush()
+
+        self.assertIsNone(self.backend.get('currency.balances:a'))
+
+    def test_driver_on_backend(self):
+        driver = Driver(backend=self.backend)
+        driver.set('currency.balances:a', 1)
+        driver.set('currency.balances:b', 2)
+        driver.commit()
+
+        self.assertEqual(driver.items('currency.balances:'), {'currency.balances:a': 1, 'currency.balances:b': 2})
+        self.assertEqual(driver.get_contract_files(), ['currency'])
+
+        driver.delete('currency.balances:a')
+        driver.hard_apply('1')
+
+        self.assertIsNone(Driver(backend=self.backend).get('currency.balances:a'))
+
+
+class TestHDF5Backend(BackendTests, unittest.TestCase):
+    def make_backend(self, storage_home):
+        return HDF5Backend(storage_home, layout=LAYOUT_CONTRACT)
+
+    def test_snapshot_page_lists_a_page(self):
+        self.backend.set_many({f'currency.balances:{i:04}': i for i in range(1000)})
+
+        with self.backend.snapshot() as snapshot:
+            self.backend.set_many({'currency.balances:0500x': 1, 'currency.balances:0501': None})
+
+            listed = []
+            scan = self.backend.iter_prefix
+
+            def iter_prefix(*args, **kwargs):
+                keys = scan(*args, **kwargs)
+                listed.append(len(keys))
+                return keys
+
+            self.backend.iter_prefix = iter_prefix
+            keys = []
+            cursor = None
+            while True:
+                page = snapshot.iter_prefix('currency.', 100, cursor)
+                keys.extend(page)
+                if len(page) < 100:
+                    break
+                cursor = page[-1]
+
+        self.assertEqual(keys, [f'currency.balances:{i:04}' for i in range(1000)])
+        # A page and the one new key that may be dropped from it
+        self.assertLessEqual(max(listed), 101)
+        self.assertLessEqual(sum(listed), 1000 + len(listed))
+
+
+class TestHDF5BackendWithoutIndex(BackendTests, unittest.TestCase):
+    def make_backend(self, storage_home):
+        return HDF5Backend(storage_home, layout=LAYOUT_CONTRACT, index=False)
+
+
+class TestWALBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, storage_home):
+        return WALBackend(HDF5Backend(storage_home, layout=LAYOUT_CONTRACT), storage_home.joinpath(WAL_FILENAME))
+
+
+class TestLazyWALBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, storage_home):
+        return WALBackend(SQLiteBackend(storage_home), storage_home.joinpath(WAL_FILENAME), background=False)
+
+
+class TestVersionedSQLiteBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, storage_home):
+        return MVCCBackend(SQLiteBackend(storage_home), storage_home.joinpath(VERSIONS_FILENAME))
+
+
+class TestKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_index_is_built_for_existing_tree(self):
+        backend = HDF5Backend(self.storage_home, index=False)
+        backend.set_many({'currency.balances:a': 1, 'currency.balances:b': 2})
+        backend.close()
+
+        backend = HDF5Backend(self.storage_home)
+        self.assertEqual(backend.index.scan('currency.'), ['currency.balances:a', 'currency.balances:b'])
+        backend.close()
+
+    def test_stale_index_is_rebuilt(self):
+        backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+        backend.set_many({'currency.balances:a': 1})
+
+        # As if the process died between recording the keys and writing the files
+        backend.index.begin({'currency.balances:b': 2})
+        self.assertFalse(backend.index.valid)
+        backend.close()
+
+        backend = HDF5Backend(self.storage_home)
+        self.assertTrue(backend.index.valid)
+        self.assertEqual(backend.iter_prefix('currency.'), ['currency.balances:a'])
+        backend.close()
+
+    def test_index_follows_flush(self):
+        backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+        backend.set_many({'currency.balances:a': 1, 'con_thing.owner': 'stu'})
+
+        backend.flush_file('currency')
+        self.assertEqual(backend.iter_prefix(), ['con_thing.owner'])
+
+        backend.flush()
+        self.assertEqual(backend.iter_prefix(), [])
+        self.assertTrue(self.storage_home.joinpath(INDEX_FILENAME).is_file())
+        backend.close()
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        keys = [f'currency.balances:{i}' for i in range(5000)]
+        bloom = BloomFilter.from_keys(keys)
+
+        for key in keys:
+            self.assertIn(key, bloom)
+
+        false_positives = sum(f'currency.balances:x{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_round_trip(self):
+        bloom = BloomFilter.from_keys(['a', 'b'])
+        loaded = BloomFilter.from_bytes(bloom.to_bytes())
+
+        self.assertEqual((loaded.capacity, loaded.count), (bloom.capacity, bloom.count))
+        self.assertIn('a', loaded)
+        self.assertNotIn('c', loaded)
+
+    def test_full(self):
+        bloom = BloomFilter(capacity=10)
+        for i in range(bloom.capacity + 1):
+            bloom.add(str(i))
+        self.assertTrue(bloom.full)
+
+
+class TestBloomFilters(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        hdf5.close_all()
+
+    def tearDown(self):
+        hdf5.close_all()
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_misses_do_not_open_files(self):
+        backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+        backend.set_many({'currency.balances:a': 1})
+        hdf5.close_all()
+
+        for i in range(100):
+            self.assertIsNone(backend.get(f'currency.balances:{i}'))
+
+        self.assertEqual(len(hdf5.open_files), 0)
+        self.assertEqual(backend.stats['bloom_negatives'], 100)
+        self.assertEqual(backend.get('currency.balances:a'), 1)
+        backend.close()
+
+    def test_filters_are_persisted(self):
+        backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT, shards=2)
+        backend.set_many({f'currency.balances:{i}': i for i in range(10)})
+        backend.close()
+
+        self.assertEqual(sorted(p.name for p in self.storage_home.joinpath(BLOOM_DIRNAME).iterdir()),
+                         ['currency-0', 'currency-1'])
+
+        backend = HDF5Backend(self.storage_home)
+        for i in range(10):
+            self.assertEqual(backend.get(f'currency.balances:{i}'), i)
+        backend.close()
+
+    def test_full_filter_is_rebuilt(self):
+        backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+        backend.set_many({f'currency.balances:{i}': i for i in range(1000)})
+        backend.set_many({f'currency.balances:{i}': i for i in range(1000, 1100)})
+
+        self.assertEqual(backend.stats['bloom_rebuilds'], 1)
+        self.assertEqual(backend.blooms['currency'].count, 1100)
+        self.assertEqual(backend.get('currency.balances:1050'), 1050)
+        backend.close()
+
+    def test_rewritten_keys_are_not_added_again(self):
+        backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+        backend.set_many({f'currency.balances:{i}': i for i in range(100)})
+        # A filter that is saved again shows up
+        path = self.storage_home.joinpath(BLOOM_DIRNAME, 'currency')
+        path.unlink()
+
+        for value in range(20):
+            backend.set_many({f'currency.balances:{i}': value for i in range(100)})
+
+        self.assertEqual(backend.blooms['currency'].count, 100)
+        self.assertEqual(backend.stats['bloom_rebuilds'], 0)
+        self.assertFalse(path.exists())
+        backend.close()
+
+    def test_writes_of_other_processes_are_seen(self):
+        writer = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+        writer.set_many({'currency.balances:a': 1})
+        # A second backend has its own connection to the index, as one in another process would
+        reader = HDF5Backend(self.storage_home)
+        self.assertIsNone(reader.get('currency.balances:b'))
+        self.assertIsNone(reader.get('con_new.balances:a'))
+
+        writer.set_many({'currency.balances:b': 2, 'con_new.balances:a': 3})
+
+        self.assertEqual(reader.get('currency.balances:b'), 2)
+        self.assertEqual(reader.get('con_new.balances:a'), 3)
+        for i in range(10):
+            self.assertIsNone(reader.get(f'currency.balances:{i}'))
+        self.assertEqual(reader.stats['bloom_reloads'], 2)
+        reader.close()
+        writer.close()
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_misses_are_cached(self):
+        driver = Driver(storage_home=self.storage_home)
+
+        for _ in range(10):
+            self.assertIsNone(driver.get('currency.balances:nobody'))
+
+        stats = driver.get_stats()
+        self.assertEqual(stats['cache_misses'], 1)
+        self.assertEqual(stats['negative_hits'], 9)
+
+    def test_pending_delete_is_not_read_from_disk(self):
+        driver = Driver(storage_home=self.storage_home)
+        driver.set('currency.balances:a', 1)
+        driver.commit()
+
+        driver.delete('currency.balances:a')
+        self.assertIsNone(driver.get('currency.balances:a'))
+
+    def test_writes_of_other_drivers_invalidate(self):
+        reader = Driver(storage_home=self.storage_home)
+        writer = Driver(storage_home=self.storage_home)
+
+        self.assertIsNone(reader.get('currency.balances:a'))
+
+        writer.set('currency.balances:a', 1)
+        writer.commit()
+
+        self.assertEqual(reader.get('currency.balances:a'), 1)
+
+
+class TestDefaultTree(unittest.TestCase):
+    def test_import_opens_no_storage(self):
+        home = tempfile.mkdtemp()
+        code = (
+            "import contracting.client, contracting.execution.executor\n"
+            "from contracting.storage.driver import Driver, STORAGE_HOME\n"
+            "assert not STORAGE_HOME.exists()\n"
+            "driver = Driver(wal=True, versions=True, merkle=True)\n"
+            "driver.set('a', 1)\n"
+            "driver.commit()\n"
+            "assert Driver().get('a') == 1\n"
+        )
+        try:
+            result = subprocess.run([sys.executable, '-c', code], env={**os.environ, 'HOME': home},
+                                    stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=120)
+            self.assertEqual(result.returncode, 0, result.stderr)
+        finally:
+            rmtree(home, ignore_errors=True)
+
+    def test_exit_applies_the_log(self):
+        home = tempfile.mkdtemp()
+        # Applying is slowed down, so the process always exits while the apply thread is writing
+        code = (
+            "import time\n"
+            "from contracting.storage.driver import Driver\n"
+            "from contracting.storage.hdf5 import HDF5Backend\n"
+            "set_many = HDF5Backend.set_many\n"
+            "def slow_set_many(*args, **kwargs):\n"
+            "    time.sleep(0.5)\n"
+            "    return set_many(*args, **kwargs)\n"
+            "HDF5Backend.set_many = slow_set_many\n"
+            "driver = Driver(wal=True)\n"
+            "driver.set('currency.balances:a', 1)\n"
+            "driver.commit()\n"
+        )
+        try:
+            result = subprocess.run([sys.executable, '-c', code], env={**os.environ, 'HOME': home},
+                                    stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+            storage_home = Path(home).joinpath('.cometbft/xian')
+            self.assertEqual(storage_home.joinpath(WAL_FILENAME).stat().st_size, 0)
+            backend = HDF5Backend(storage_home)
+            try:
+                self.assertEqual(backend.get('currency.balances:a'), 1)
+            finally:
+                backend.close()
+        finally:
+            rmtree(home, ignore_errors=True)
+
+
+class TestLayers(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_layers_are_recorded(self):
+        driver = Driver(storage_home=self.storage_home, wal=True, versions=True, merkle=True)
+        driver.set('currency.balances:a', 1)
+        driver.commit()
+        hdf5.close_backend(self.storage_home)
+
+        backend = Driver(storage_home=self.storage_home).backend
+        self.assertIsInstance(backend, MVCCBackend)
+        self.assertIsInstance(backend.backend, WALBackend)
+        self.assertIsNotNone(backend.state_tree)
+
+    def test_other_process_leaves_files_of_writer(self):
+        writer = Driver(storage_home=self.storage_home, wal=True, merkle=True)
+        writer.set('currency.balances:a', 1)
+        writer.commit()
+        writer.backend.drain()
+        root = writer.state_root()
+        # HDF5 locks the files the writer holds open
+        hdf5.close_all()
+
+        code = (
+            "import sys\n"
+            "from contracting.storage import hdf5\n"
+            "from contracting.storage.wal import WALBackend\n"
+            "backend = hdf5.open_backend(sys.argv[1])\n"
+            "assert not isinstance(backend, WALBackend) and backend.state_tree is None\n"
+            "assert backend.get('currency.balances:a') == 1\n"
+            "hdf5.close_backend(sys.argv[1])\n"
+            "for options in ({'wal': False}, {'merkle': True}):\n"
+            "    try:\n"
+            "        hdf5.open_backend(sys.argv[1], **options)\n"
+            "    except AssertionError:\n"
+            "        continue\n"
+            "    sys.exit(f'Opened with {options}')\n"
+        )
+        result = subprocess.run([sys.executable, '-c', code, str(self.storage_home)], stdin=subprocess.DEVNULL,
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        self.assertTrue(self.storage_home.joinpath(STATE_TREE_FILENAME).is_file())
+        self.assertEqual(writer.state_root(), root)
+        writer.set('currency.balances:b', 2)
+        writer.commit()
+        self.assertTrue(self.storage_home.joinpath(WAL_FILENAME).is_file())
+        self.assertEqual(writer.get('currency.balances:b'), 2)
+
+
+class TestSQLiteBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, storage_home):
+        return SQLiteBackend(storage_home)
+
+    def test_single_file(self):
+        self.backend.set_many({'currency.balances:a': 1, 'con_thing.owner': 'stu'})
+        self.assertIn('state.db', [p.name for p in self.storage_home.iterdir()])
+
+    def test_block_number(self):
+        self.backend.set_many({'currency.balances:a': 1}, block_num=5)
+        self.assertEqual(self.backend.get_block('currency.balances:a'), 5)
+
+    def test_state_survives_reopen(self):
+        self.backend.set_many({'currency.balances:a': 1})
+        self.backend.close()
+
+        self.backend = SQLiteBackend(self.storage_home)
+        self.assertEqual(self.backend.get('currency.balances:a'), 1)
+
+    def test_run_state(self):
+        self.backend.set_many({'__n_votes': 1, 'misc': 2, 'currency.balances:a': 3})
+
+        self.assertEqual(self.backend.get_run_state(), {'__n_votes': 1, 'misc': 2})
+        self.assertEqual(self.backend.get_all_contract_state(), {'currency.balances:a': 3})
+
+
+class TestPrefixUpperBound(unittest.TestCase):
+    def test_upper_bound(self):
+        self.assertEqual(prefix_upper_bound('currency.'), 'currency/')
+        self.assertEqual(prefix_upper_bound('a\U0010FFFF'), 'b')
+        self.assertIsNone(prefix_upper_bound(''))
+
+
+if __name__ == '__main__':
+    unittest.main()
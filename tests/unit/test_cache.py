@@ -0,0 +1,164 @@
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.cache import StateCache, ENTRY_OVERHEAD, sizeof
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.module import uninstall_database_loader
+from contracting.client import ContractingClient
+
+
+def entry_size(key, value):
+    return len(key) + sizeof(value) + ENTRY_OVERHEAD
+
+
+class TestStateCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = StateCache()
+        cache['currency.balances:a'] = 1
+        cache['currency.balances:b'] = None
+
+        self.assertEqual(cache.get('currency.balances:a'), 1)
+        self.assertIsNone(cache.get('currency.balances:b', 'missing'))
+        self.assertEqual(cache.get('currency.balances:c', 'missing'), 'missing')
+        self.assertIn('currency.balances:b', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_bytes_are_tracked(self):
+        cache = StateCache()
+        cache['currency.balances:a'] = 'x' * 100
+        cache['currency.balances:a'] = 'x' * 10
+        cache['con_thing.owner'] = 'stu'
+
+        expected = entry_size('currency.balances:a', 'x' * 10) + entry_size('con_thing.owner', 'stu')
+        self.assertEqual(cache.bytes, expected)
+
+        cache.pop('con_thing.owner')
+        del cache['currency.balances:a']
+        self.assertEqual(cache.bytes, 0)
+        self.assertEqual(cache.stats()['contract_bytes'], {})
+
+    def test_least_recently_used_is_evicted(self):
+        size = entry_size('con_a.x:0', 0)
+        cache = StateCache(max_bytes=size * 3, contract_share=1)
+
+        for i in range(3):
+            cache[f'con_a.x:{i}'] = i
+        cache.get('con_a.x:0')
+        cache['con_a.x:3'] = 3
+
+        self.assertIn('con_a.x:0', cache)
+        self.assertNotIn('con_a.x:1', cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_contract_share(self):
+        size = entry_size('con_a.x:0', 0)
+        cache = StateCache(max_bytes=size * 10, contract_share=0.5)
+
+        cache['con_b.x:0'] = 0
+        for i in range(10):
+            cache[f'con_a.x:{i}'] = i
+
+        self.assertIn('con_b.x:0', cache)
+        self.assertLessEqual(cache.stats()['contract_bytes']['con_a'], size * 5)
+
+    def test_quota_protects_contract(self):
+        size = entry_size('con_a.x:0', 0)
+        cache = StateCache(max_bytes=size * 10, contract_share=1, quotas={'currency': 1000})
+
+        cache['currency.balances:a'] = 1
+        for i in range(100):
+            cache[f'con_a.x:{i}'] = i
+
+        self.assertEqual(cache.get('currency.balances:a'), 1)
+        self.assertLessEqual(cache.bytes, size * 10 + 1000)
+
+    def test_stats(self):
+        cache = StateCache()
+        cache['currency.balances:a'] = None
+
+        cache.get('currency.balances:a')
+        cache.get('currency.balances:b')
+
+        stats = cache.stats()
+        self.assertEqual((stats['cache_hits'], stats['negative_hits'], stats['cache_misses']), (1, 1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+
+class TestCachePlumbing(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_driver(self):
+        cache = StateCache(max_bytes=1024)
+        driver = Driver(storage_home=self.storage_home, cache=cache)
+        driver.get('currency.balances:a')
+
+        self.assertIs(driver.cache, cache)
+        self.assertEqual(driver.get_stats()['cache_misses'], 1)
+
+    def test_executor(self):
+        cache = StateCache(max_bytes=1024)
+
+        self.assertIs(Executor(cache=cache).driver.cache, cache)
+        self.assertIs(Executor(driver=Driver(storage_home=self.storage_home), cache=cache).driver.cache, cache)
+
+    def test_client(self):
+        cache = StateCache(max_bytes=1024)
+        client = ContractingClient(driver=Driver(storage_home=self.storage_home), cache=cache,
+                                   submission_filename=None)
+
+        self.assertIs(client.raw_driver.cache, cache)
+
+
+CHANGER = '''
+h = Hash()
+
+@construct
+def seed():
+    h['x'] = {'a': 1}
+
+@export
+def change(fail: bool):
+    v = h['x']
+    v['a'] = 99
+    h['x'] = v
+    assert not fail, 'Failed on purpose.'
+
+@export
+def read():
+    return h['x']
+'''
+
+
+class TestCachedValues(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.client = ContractingClient(driver=Driver(storage_home=self.storage_home))
+        self.client.submit(CHANGER, name='con_changer')
+        self.client.raw_driver.commit()
+        self.executor = self.client.executor
+
+    def tearDown(self):
+        uninstall_database_loader()
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_failed_transaction_does_not_change_cached_value(self):
+        self.assertEqual(self.executor.execute('stu', 'con_changer', 'read', {})['result'], {'a': 1})
+
+        output = self.executor.execute('stu', 'con_changer', 'change', {'fail': True})
+        self.assertEqual(output['status_code'], 1)
+
+        self.assertEqual(self.executor.execute('stu', 'con_changer', 'read', {})['result'], {'a': 1})
+        self.assertEqual(self.client.raw_driver.backend.get('con_changer.h:x'), {'a': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
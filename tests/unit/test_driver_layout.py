@@ -0,0 +1,250 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from unittest import mock
+from contracting.storage.driver import Driver, LAYOUT_KEY, LAYOUT_CONTRACT, read_layout
+from contracting.storage.migration import migrate_to_contract_layout
+from contracting.storage import hdf5, migration
+
+
+class TestContractLayout(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home, layout=LAYOUT_CONTRACT)
+
+    def tearDown(self):
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_one_file_per_contract(self):
+        for i in range(20):
+            self.driver.set(f'currency.balances:{i}', i)
+        self.driver.set('currency.total_supply', 100)
+        self.driver.set('con_other.owner', 'stu')
+        self.driver.commit()
+
+        self.assertEqual(sorted(os.listdir(self.driver.backend.contract_state)), ['con_other', 'currency'])
+        self.assertEqual(self.driver.get('currency.balances:7'), 7)
+        self.assertEqual(self.driver.get('currency.total_supply'), 100)
+
+    def test_multi_dimensional_hash_keys(self):
+        self.driver.set('currency.allowances:alice:bob', 10)
+        self.driver.set('currency.allowances:alice', 5)
+        self.driver.commit()
+
+        self.assertEqual(self.driver.get('currency.allowances:alice:bob'), 10)
+        self.assertEqual(self.driver.get('currency.allowances:alice'), 5)
+        self.assertEqual(self.driver.keys_from_disk(prefix='currency.allowances:'),
+                         ['currency.allowances:alice', 'currency.allowances:alice:bob'])
+
+    def test_special_characters_round_trip(self):
+        keys = ['nft.urls:https://x.io/a', 'nft.urls:100%', 'nft.urls::empty', 'nft.urls:.']
+        for i, key in enumerate(keys):
+            self.driver.set(key, i)
+        self.driver.commit()
+
+        for i, key in enumerate(keys):
+            self.assertEqual(self.driver.get(key), i)
+        self.assertEqual(self.driver.keys_from_disk(prefix='nft.'), sorted(keys))
+
+    def test_keys_without_contract_go_to_run_state(self):
+        self.driver.set('test_key', 'value')
+        self.driver.commit()
+
+        self.assertEqual(os.listdir(self.driver.backend.run_state), ['__misc'])
+        self.assertEqual(self.driver.get('test_key'), 'value')
+        self.assertEqual(self.driver.get_run_state(), {'test_key': 'value'})
+
+    def test_iter_from_disk_and_items(self):
+        self.driver.set('currency.balances:a', 1)
+        self.driver.set('currency.balances:b', 2)
+        self.driver.set('currency.supply', 3)
+        self.driver.commit()
+
+        self.assertEqual(self.driver.iter_from_disk(prefix='currency.balances:'),
+                         ['currency.balances:a', 'currency.balances:b'])
+        self.assertEqual(self.driver.iter_from_disk(prefix='currency.balances:', length=1), ['currency.balances:a'])
+        self.assertEqual(self.driver.items(prefix='currency.balances:'),
+                         {'currency.balances:a': 1, 'currency.balances:b': 2})
+
+    def test_delete(self):
+        self.driver.set('currency.balances:a', 1)
+        self.driver.commit()
+        self.driver.delete('currency.balances:a')
+        self.driver.commit()
+
+        self.assertIsNone(self.driver.get('currency.balances:a'))
+        self.assertEqual(self.driver.keys_from_disk(prefix='currency.'), [])
+
+    def test_get_all_contract_state(self):
+        self.driver.set('currency.balances:a', 1)
+        self.driver.set('con_thing.x', 'y')
+        self.driver.commit()
+
+        self.assertEqual(self.driver.get_all_contract_state(), {'currency.balances:a': 1, 'con_thing.x': 'y'})
+
+    def test_sharded_layout(self):
+        self.driver.backend.close()
+        rmtree(self.storage_home)
+        driver = Driver(storage_home=self.storage_home, layout=LAYOUT_CONTRACT, shards=4)
+
+        for i in range(50):
+            driver.set(f'currency.balances:{i}', i)
+        driver.commit()
+
+        files = os.listdir(driver.backend.contract_state)
+        self.assertTrue(1 < len(files) <= 4)
+        self.assertTrue(all(f.startswith('currency-') for f in files))
+        self.assertEqual(len(driver.iter_from_disk(prefix='currency.balances:')), 50)
+        self.assertEqual(driver.get('currency.balances:42'), 42)
+
+    def test_layout_is_recorded(self):
+        self.assertEqual(read_layout(self.storage_home), (LAYOUT_CONTRACT, 1))
+
+        driver = Driver(storage_home=self.storage_home)
+        self.assertEqual(driver.backend.layout, LAYOUT_CONTRACT)
+
+        with self.assertRaises(AssertionError):
+            Driver(storage_home=self.storage_home, layout=LAYOUT_KEY)
+
+
+class TestMisses(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def snapshot(self):
+        tree = {}
+        for root, dirs, files in os.walk(self.storage_home):
+            for name in dirs + files:
+                stat = os.stat(os.path.join(root, name))
+                tree[os.path.join(root, name)] = (stat.st_size, stat.st_mtime_ns)
+        return tree
+
+    def test_million_misses_leave_tree_unchanged(self):
+        driver = Driver(storage_home=self.storage_home, layout=LAYOUT_CONTRACT)
+        driver.set('currency.balances:stu', 100)
+        driver.set('test_key', 'value')
+        driver.commit()
+
+        before = self.snapshot()
+
+        for i in range(500000):
+            # Contract files that do not exist
+            self.assertIsNone(driver.find(f'con_{i}.balances:stu'))
+            # Keys that do not exist in a file that does
+            self.assertIsNone(driver.find(f'currency.balances:{i}'))
+
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(driver.get('currency.balances:stu'), 100)
+
+    def test_misses_in_key_layout_leave_tree_unchanged(self):
+        driver = Driver(storage_home=self.storage_home)
+        driver.set('currency.balances:stu', 100)
+        driver.commit()
+
+        before = self.snapshot()
+
+        for i in range(10000):
+            self.assertIsNone(driver.find(f'currency.balances:{i}'))
+
+        self.assertEqual(self.snapshot(), before)
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_migrate_key_layout(self):
+        driver = Driver(storage_home=self.storage_home)
+        self.assertEqual(driver.backend.layout, LAYOUT_KEY)
+
+        state = {f'currency.balances:{i}': i for i in range(25)}
+        state['con_thing.owner'] = 'stu'
+        state['misc_key'] = 'misc'
+        for k, v in state.items():
+            driver.set(k, v)
+        driver.hard_apply('1')
+
+        count = migrate_to_contract_layout(self.storage_home, shards=2)
+        self.assertEqual(count, len(state))
+
+        migrated = Driver(storage_home=self.storage_home)
+        self.assertEqual(migrated.backend.layout, LAYOUT_CONTRACT)
+        self.assertEqual(migrated.backend.shards, 2)
+
+        for k, v in state.items():
+            self.assertEqual(migrated.get(k), v)
+
+        self.assertEqual(len(migrated.keys_from_disk()), len(state))
+
+    def test_keep_source(self):
+        driver = Driver(storage_home=self.storage_home)
+        driver.set('currency.balances:a', 1)
+        driver.commit()
+
+        migrate_to_contract_layout(self.storage_home, keep_source=True)
+
+        self.assertTrue(self.storage_home.joinpath('contract_state.per_key', 'currency.balances:a').is_file())
+        self.assertEqual(Driver(storage_home=self.storage_home).get('currency.balances:a'), 1)
+
+    def write_state(self):
+        driver = Driver(storage_home=self.storage_home)
+        state = {f'currency.balances:{i}': i for i in range(10)}
+        state['__misc'] = 'misc'
+        for k, v in state.items():
+            driver.set(k, v)
+        driver.commit()
+        return state
+
+    def test_interrupted_while_building(self):
+        state = self.write_state()
+
+        with mock.patch.object(migration, '_write_batch', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                migrate_to_contract_layout(self.storage_home)
+
+        with self.assertRaises(AssertionError):
+            Driver(storage_home=self.storage_home)
+
+        self.assertEqual(migrate_to_contract_layout(self.storage_home), len(state))
+        migrated = Driver(storage_home=self.storage_home)
+        self.assertEqual(migrated.backend.layout, LAYOUT_CONTRACT)
+        for k, v in state.items():
+            self.assertEqual(migrated.get(k), v)
+
+    def test_interrupted_while_swapping(self):
+        state = self.write_state()
+        rename = Path.rename
+        renames = []
+
+        def crash_after_first(path, target):
+            if renames:
+                raise OSError('crash')
+            renames.append(path)
+            return rename(path, target)
+
+        with mock.patch.object(Path, 'rename', crash_after_first):
+            with self.assertRaises(OSError):
+                migrate_to_contract_layout(self.storage_home)
+
+        # Half of the tree is swapped in and no layout is recorded yet
+        self.assertIsNone(read_layout(self.storage_home))
+        self.assertIsNotNone(hdf5.read_migration(self.storage_home))
+
+        migrated = Driver(storage_home=self.storage_home)
+        self.assertEqual(migrated.backend.layout, LAYOUT_CONTRACT)
+        self.assertIsNone(hdf5.read_migration(self.storage_home))
+        self.assertFalse(self.storage_home.joinpath(hdf5.MIGRATION_DIRNAME).exists())
+        for k, v in state.items():
+            self.assertEqual(migrated.get(k), v)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.estimation import StampEstimator
+
+TOKEN = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def balance_of(account: str):
+    return balances[account]
+'''
+
+
+class TestStampEstimator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.storage_home = Path(tempfile.mkdtemp())
+        cls.driver = Driver(storage_home=cls.storage_home)
+        client = ContractingClient(driver=cls.driver)
+        client.submit(TOKEN, name='con_token')
+        client.executor.execute('stu', 'con_token', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        cls.driver.commit()
+
+        cls.executor = Executor(driver=cls.driver, metering=True, currency_contract='con_token',
+                                balances_hash='balances')
+        cls.estimator = StampEstimator(cls.executor, workers=2)
+        cls.estimator.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.estimator.close()
+        hdf5.close_backend(cls.storage_home)
+        rmtree(cls.storage_home, ignore_errors=True)
+
+    def setUp(self):
+        self.driver.rollback()
+
+    def test_same_as_execute(self):
+        estimate = self.estimator.estimate('alice', 'con_token', 'transfer', {'amount': 10, 'to': 'bob'})
+
+        executor = Executor(driver=self.driver, metering=True, currency_contract='con_token',
+                            balances_hash='balances', bypass_balance_amount=True)
+        output = executor.execute('alice', 'con_token', 'transfer', {'amount': 10, 'to': 'bob'})
+        self.driver.rollback()
+
+        self.assertEqual(estimate['status_code'], 0)
+        self.assertEqual(estimate['stamps_used'], output['stamps_used'])
+        self.assertEqual(estimate['writes'], output['writes'])
+        self.assertEqual(estimate['reads']['con_token.balances:alice'], self.driver.get('con_token.balances:alice'))
+        self.assertIn('con_token.balances:bob', estimate['reads'])
+        self.assertEqual(self.driver.pending_writes, {})
+
+    def test_failure(self):
+        estimate = self.estimator.estimate('nobody', 'con_token', 'transfer', {'amount': 10, 'to': 'bob'})
+        self.assertEqual(estimate['status_code'], 1)
+        self.assertIsInstance(estimate['result'], AssertionError)
+        self.assertGreater(estimate['stamps_used'], 0)
+
+        estimate = self.estimator.estimate('alice', 'con_missing', 'transfer', {})
+        self.assertEqual(estimate['status_code'], 1)
+
+    def test_cached_until_state_changes(self):
+        kwargs = {'account': 'carol'}
+        first = self.estimator.estimate('alice', 'con_token', 'balance_of', kwargs)
+        hits = self.estimator.stats['hits']
+        self.assertEqual(self.estimator.estimate('alice', 'con_token', 'balance_of', kwargs), first)
+        self.assertEqual(self.estimator.stats['hits'], hits + 1)
+        self.assertEqual(first['result'], 0)
+
+        self.executor.execute('alice', 'con_token', 'transfer', {'amount': 7, 'to': 'carol'})
+        self.assertEqual(self.estimator.estimate('alice', 'con_token', 'balance_of', kwargs)['result'], 0)
+
+        self.driver.commit()
+        self.assertEqual(self.estimator.estimate('alice', 'con_token', 'balance_of', kwargs)['result'], 7)
+        self.assertEqual(self.estimator.stats['hits'], hits + 2)
+
+    def test_concurrent(self):
+        results = {}
+
+        def estimate(i):
+            results[i] = self.estimator.estimate('alice', 'con_token', 'transfer', {'amount': i, 'to': 'dave'})
+
+        threads = [threading.Thread(target=estimate, args=(i % 5,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), list(range(5)))
+        self.assertEqual({estimate['status_code'] for estimate in results.values()}, {0})
+        self.assertEqual(len({estimate['stamps_used'] for estimate in results.values()}), 1)
+
+    def test_pending_estimates_are_capped(self):
+        estimator = StampEstimator(self.executor, workers=1, max_pending=1)
+        estimator.start()
+        try:
+            estimator.slots.acquire()
+            with self.assertRaises(AssertionError):
+                estimator.estimate('alice', 'con_token', 'balance_of', {'account': 'erin'}, timeout=0.1)
+            estimator.slots.release()
+
+            self.assertEqual(estimator.estimate('alice', 'con_token', 'balance_of', {'account': 'erin'})['result'], 0)
+        finally:
+            estimator.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
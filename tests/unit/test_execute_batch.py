@@ -0,0 +1,201 @@
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.module import is_reusable
+from contracting.execution.runtime import rt, Runtime
+from unittest import mock
+import sys
+
+TOKEN = '''
+balances = Hash(default_value=0)
+marks = Hash()
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def mark():
+    marks[ctx.caller] = block_num
+    return block_num
+'''
+
+PAYER = '''
+import con_token
+
+@export
+def pay(amount: int, to: str):
+    con_token.transfer(amount=amount, to=to)
+    return ctx.caller
+'''
+
+LEAKY = '''
+seen = []
+
+@export
+def add(x: int):
+    seen.append(x)
+    return len(seen)
+'''
+
+DYNAMIC = '''
+@export
+def mark():
+    return importlib.import_module('con_token').mark()
+'''
+
+LEAKY_MARKER = '''
+import con_token
+
+seen = []
+
+@export
+def mark():
+    seen.append(1)
+    return con_token.mark()
+'''
+
+
+def comparable(output):
+    return (output['status_code'], repr(output['result']), output['stamps_used'], output['writes'])
+
+
+class TestExecuteBatch(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+        client = ContractingClient(driver=self.driver)
+        client.submit(TOKEN, name='con_token')
+        client.submit(PAYER, name='con_payer')
+        client.submit(LEAKY, name='con_leaky')
+        client.submit(DYNAMIC, name='con_dynamic')
+        client.submit(LEAKY_MARKER, name='con_leaky_marker')
+        client.executor.execute('stu', 'con_token', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        client.executor.execute('stu', 'con_token', 'transfer', {'amount': 1000, 'to': 'con_payer'})
+        self.driver.commit()
+
+        self.executor = Executor(driver=self.driver, metering=True, currency_contract='con_token',
+                                 balances_hash='balances')
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def assert_same_as_serial(self, txs, environment={}):
+        serial = []
+        for tx in txs:
+            tx = dict(tx)
+            tx_environment = {**environment, **tx.pop('environment', {})}
+            serial.append(self.executor.execute(**tx, environment=tx_environment))
+        serial_writes = dict(self.driver.pending_writes)
+        self.driver.rollback()
+
+        batch = self.executor.execute_batch(txs, environment)
+
+        self.assertEqual([comparable(o) for o in batch], [comparable(o) for o in serial])
+        self.assertEqual(self.driver.pending_writes, serial_writes)
+        return batch
+
+    def test_same_outputs_as_execute(self):
+        txs = []
+        for i in range(20):
+            txs.append({'sender': 'stu', 'contract_name': 'con_token', 'function_name': 'transfer',
+                        'kwargs': {'amount': i, 'to': f'account_{i}'}})
+            txs.append({'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'transfer',
+                        'kwargs': {'amount': 10 ** 9, 'to': 'bob'}})
+        self.assert_same_as_serial(txs)
+
+    def test_failures_are_isolated(self):
+        txs = [
+            {'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'transfer',
+             'kwargs': {'amount': 10 ** 9, 'to': 'bob'}},
+            {'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'transfer',
+             'kwargs': {'amount': 'x', 'to': 'bob'}},
+            {'sender': 'alice', 'contract_name': 'con_missing', 'function_name': 'transfer', 'kwargs': {}},
+            {'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'transfer',
+             'kwargs': {'amount': 10, 'to': 'bob'}},
+        ]
+        outputs = self.assert_same_as_serial(txs)
+        self.assertEqual([o['status_code'] for o in outputs], [1, 1, 1, 0])
+        self.assertEqual(self.driver.get('con_token.balances:bob'), 10)
+
+    def test_imported_contracts_are_metered_every_time(self):
+        txs = [{'sender': 'alice', 'contract_name': 'con_payer', 'function_name': 'pay',
+                'kwargs': {'amount': 1, 'to': 'bob'}} for _ in range(5)]
+        txs.insert(2, {'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'transfer',
+                       'kwargs': {'amount': 1, 'to': 'bob'}})
+        outputs = self.assert_same_as_serial(txs)
+        self.assertEqual(outputs[0]['result'], 'alice')
+
+    def test_module_state_does_not_leak(self):
+        txs = [{'sender': 'alice', 'contract_name': 'con_leaky', 'function_name': 'add', 'kwargs': {'x': i}}
+               for i in range(3)]
+        outputs = self.assert_same_as_serial(txs)
+        self.assertEqual([o['result'] for o in outputs], [1, 1, 1])
+
+    def test_environment_of_a_transaction(self):
+        txs = [{'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'mark', 'kwargs': {},
+                'environment': {'block_num': i}} for i in range(3)]
+        txs.append({'sender': 'stu', 'contract_name': 'con_token', 'function_name': 'mark', 'kwargs': {}})
+        outputs = self.assert_same_as_serial(txs, {'block_num': 100})
+        self.assertEqual([o['result'] for o in outputs], [0, 1, 2, 100])
+
+    def test_modules_stay_imported(self):
+        imported = []
+
+        def reset(runtime):
+            imported.append('con_token' in sys.modules)
+            runtime.state.tracer.reset()
+
+        txs = [{'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'transfer',
+                'kwargs': {'amount': 1, 'to': 'bob'}} for _ in range(3)]
+        with mock.patch.object(Runtime, 'reset', autospec=True, side_effect=reset):
+            self.executor.execute_batch(txs)
+
+        # Reset when the batch starts, after every transaction and when it is cleaned up
+        self.assertEqual(imported, [False, True, True, True, True])
+        self.assertNotIn('con_token', sys.modules)
+
+    def test_stale_modules_are_executed_again(self):
+        txs = []
+        for contract_name in ('con_dynamic', 'con_leaky_marker', 'con_dynamic'):
+            txs.append({'sender': 'alice', 'contract_name': 'con_token', 'function_name': 'mark', 'kwargs': {},
+                        'environment': {'block_num': len(txs)}})
+            txs.append({'sender': 'alice', 'contract_name': contract_name, 'function_name': 'mark', 'kwargs': {},
+                        'environment': {'block_num': len(txs)}})
+        outputs = self.assert_same_as_serial(txs)
+        self.assertEqual([o['result'] for o in outputs], list(range(6)))
+
+    def test_runtime_is_cleaned_up(self):
+        self.executor.execute_batch([{'sender': 'alice', 'contract_name': 'con_payer', 'function_name': 'pay',
+                                      'kwargs': {'amount': 1, 'to': 'bob'}}])
+        self.assertEqual(rt.loaded_modules, [])
+        self.assertEqual(rt.env, {'__Driver': self.driver})
+        self.assertEqual(rt.context._state, [])
+
+    def test_is_reusable(self):
+        self.executor.execute_batch([])
+        import importlib
+        from contracting.execution.module import install_database_loader
+        install_database_loader(driver=self.driver)
+        try:
+            self.assertTrue(is_reusable(importlib.import_module('con_token')))
+            self.assertTrue(is_reusable(importlib.import_module('con_payer')))
+            self.assertFalse(is_reusable(importlib.import_module('con_leaky')))
+        finally:
+            rt.clean_up()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import h5py
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+from contracting.storage import hdf5
+
+
+class TestHandlePool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        hdf5.close_all()
+        self.pool_size = hdf5.MAX_OPEN_FILES
+
+    def tearDown(self):
+        hdf5.set_pool_size(self.pool_size)
+        hdf5.close_all()
+        rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_handle_is_reused(self):
+        hdf5.set_value_to_disk(self.path('a'), 'x', 1)
+        handle = hdf5.open_files[self.path('a')]
+
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'x'), 1)
+        hdf5.set_value_to_disk(self.path('a'), 'y', 2)
+
+        self.assertIs(hdf5.open_files[self.path('a')], handle)
+
+    def test_pool_is_bounded(self):
+        hdf5.set_pool_size(3)
+
+        for i in range(10):
+            hdf5.set_value_to_disk(self.path(str(i)), 'x', i)
+
+        self.assertEqual(len(hdf5.open_files), 3)
+        self.assertEqual(list(hdf5.open_files.keys()), [self.path('7'), self.path('8'), self.path('9')])
+
+        for i in range(10):
+            self.assertEqual(hdf5.get_value_from_disk(self.path(str(i)), 'x'), i)
+
+    def test_handles_in_use_are_not_evicted(self):
+        hdf5.set_pool_size(1)
+
+        with hdf5.open_file(self.path('a')) as f:
+            hdf5.set_value_to_disk(self.path('b'), 'x', 1)
+            self.assertIn(self.path('a'), hdf5.open_files)
+            self.assertTrue(f.id.valid)
+
+    def test_pool_size_zero_closes_after_every_call(self):
+        hdf5.set_pool_size(0)
+
+        hdf5.set_value_to_disk(self.path('a'), 'x', 1)
+
+        self.assertEqual(len(hdf5.open_files), 0)
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'x'), 1)
+
+    def test_close_removes_handle(self):
+        hdf5.set_value_to_disk(self.path('a'), 'x', 1)
+        hdf5.close(self.path('a'))
+
+        self.assertNotIn(self.path('a'), hdf5.open_files)
+        os.unlink(self.path('a'))
+        self.assertIsNone(hdf5.get_value_from_disk(self.path('a'), 'x'))
+
+    def test_flush_persists_open_handles(self):
+        hdf5.set_value_to_disk(self.path('a'), 'x', 'value')
+        hdf5.flush()
+
+        # A second, independent handle sees the data before the pooled one is closed
+        with h5py.File(self.path('a'), 'r') as f:
+            self.assertEqual(f['x'].attrs[hdf5.ATTR_VALUE], '"value"')
+
+
+class TestReadPath(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        hdf5.close_all()
+
+    def tearDown(self):
+        hdf5.close_all()
+        rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_reading_missing_file_does_not_create_it(self):
+        self.assertIsNone(hdf5.get_value_from_disk(self.path('a'), 'x'))
+        self.assertEqual(hdf5.get_groups(self.path('a')), [])
+        self.assertEqual(hdf5.get_value_groups(self.path('a')), [])
+
+        self.assertFalse(os.path.exists(self.path('a')))
+        self.assertNotIn(self.path('a'), hdf5.open_files)
+
+    def test_deleting_from_missing_file_does_not_create_it(self):
+        hdf5.delete_key_from_disk(self.path('a'), 'x')
+        self.assertFalse(os.path.exists(self.path('a')))
+
+    def test_reads_open_files_read_only(self):
+        hdf5.set_value_to_disk(self.path('a'), 'x', 1)
+        hdf5.close_all()
+
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'x'), 1)
+        self.assertEqual(hdf5.open_files[self.path('a')].mode, 'r')
+
+    def test_write_reopens_read_only_handle(self):
+        hdf5.set_value_to_disk(self.path('a'), 'x', 1)
+        hdf5.close_all()
+        hdf5.get_value_from_disk(self.path('a'), 'x')
+
+        hdf5.set_value_to_disk(self.path('a'), 'x', 2)
+
+        self.assertEqual(hdf5.open_files[self.path('a')].mode, 'r+')
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'x'), 2)
+
+
+class TestBatchedWrites(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        hdf5.close_all()
+
+    def tearDown(self):
+        hdf5.close_all()
+        rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_write_values(self):
+        hdf5.write_values_to_disk(self.path('a'), {'x': 1, 'y/z': 'two', 'y': {'three': 3}}, 10)
+
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'x'), 1)
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'y/z'), 'two')
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'y'), {'three': 3})
+        self.assertEqual(hdf5.get_block(self.path('a'), 'x'), 10)
+
+    def test_overwrite_and_delete(self):
+        hdf5.write_values_to_disk(self.path('a'), {'x': 1, 'y': 2})
+        hdf5.write_values_to_disk(self.path('a'), {'x': 3, 'y': None})
+
+        self.assertEqual(hdf5.get_value_from_disk(self.path('a'), 'x'), 3)
+        self.assertIsNone(hdf5.get_value_from_disk(self.path('a'), 'y'))
+        self.assertEqual(hdf5.get_value_groups(self.path('a')), ['x'])
+
+    def test_only_deletes_do_not_create_file(self):
+        hdf5.write_values_to_disk(self.path('a'), {'x': None, 'y': None})
+        self.assertFalse(os.path.exists(self.path('a')))
+
+
+if __name__ == '__main__':
+    unittest.main()
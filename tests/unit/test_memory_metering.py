@@ -0,0 +1,112 @@
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.runtime import rt, RuntimeState
+from contracting.execution.metering.tracer import Tracer, MEMORY_ALLOCATIONS
+
+ALLOCATE = '''
+def allocate(n: int, keep: bool):
+    kept = []
+    for i in range(n):
+        block = 'a' * 10000
+        if keep:
+            kept.append(block)
+    return len(kept)
+'''
+
+CONTRACT = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+''' + ALLOCATE.lstrip()
+
+
+class TestAllocationMetering(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+        client = ContractingClient(driver=self.driver)
+        client.submit(CONTRACT, name='con_memory')
+        self.driver.commit()
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def execute(self, memory_metering, n, keep):
+        executor = Executor(driver=self.driver, metering=True, currency_contract='con_memory',
+                            balances_hash='balances', runtime_state=RuntimeState(memory_metering=memory_metering))
+        output = executor.execute('stu', 'con_memory', 'allocate', {'n': n, 'keep': keep})
+        self.driver.rollback()
+        return output
+
+    def test_peak_and_total(self):
+        tracer = Tracer()
+        tracer.set_memory_metering(MEMORY_ALLOCATIONS)
+        tracer.set_stamp(10 ** 6)
+        globals_ = {'__contract__': True}
+        exec(ALLOCATE, globals_)
+
+        tracer.start()
+        globals_['allocate'](100, True)
+        tracer.stop()
+        kept_peak, kept_total = tracer.get_peak_mem_allocated(), tracer.get_total_mem_allocated()
+
+        tracer.start()
+        globals_['allocate'](100, False)
+        tracer.stop()
+        peak, total = tracer.get_peak_mem_allocated(), tracer.get_total_mem_allocated()
+
+        self.assertGreater(kept_peak, 100 * 10000)
+        self.assertGreaterEqual(kept_total, kept_peak)
+        self.assertLess(peak, 5 * 10000)
+        self.assertGreater(total, 100 * 10000)
+        self.assertEqual(tracer.get_total_mem_usage(), 0)
+
+        globals_['allocate'](100, True)
+        self.assertEqual(tracer.get_peak_mem_allocated(), peak)
+
+    def test_same_stamps_as_rss(self):
+        output = self.execute('allocations', 50, True)
+        expected = self.execute('rss', 50, True)
+        self.assertEqual(output['status_code'], 0)
+        self.assertEqual(output['result'], 50)
+        self.assertEqual(output['stamps_used'], expected['stamps_used'])
+
+    def test_modes(self):
+        with self.assertRaises(AssertionError):
+            RuntimeState(memory_metering='heap')
+
+        tracer = Tracer()
+        with self.assertRaises(AssertionError):
+            tracer.set_memory_metering(2)
+
+        tracer.set_stamp(1000)
+        tracer.start()
+        with self.assertRaises(AssertionError):
+            tracer.set_memory_metering(MEMORY_ALLOCATIONS)
+        tracer.stop()
+
+        with rt.use(RuntimeState()):
+            rt.set_memory_metering('allocations')
+            self.assertEqual(rt.state.memory_metering, 'allocations')
+            rt.set_metering('tracer')
+            self.assertEqual(rt.state.memory_metering, 'allocations')
+            rt.set_memory_metering('rss')
+
+    def test_monitoring_engine_meters_rss_only(self):
+        with self.assertRaises(AssertionError):
+            RuntimeState(metering='monitoring', memory_metering='allocations')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver
+from contracting.storage.sqlite import SQLiteBackend
+from contracting.storage.merkle import StateTree, EMPTY, DEPTH, STATE_TREE_FILENAME, verify_proof
+from contracting.storage import hdf5
+
+
+class TestStateTree(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.backend = SQLiteBackend(self.storage_home)
+        self.path = self.storage_home.joinpath(STATE_TREE_FILENAME)
+        self.tree = StateTree(self.path, self.backend)
+
+    def tearDown(self):
+        self.tree.close()
+        self.backend.close()
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_empty_root(self):
+        self.assertEqual(self.tree.root(), EMPTY[DEPTH].hex())
+
+    def test_root_depends_on_state_only(self):
+        self.backend.set_many({'currency.balances:a': 1, 'currency.balances:b': 2})
+        self.backend.set_many({'currency.balances:c': 3})
+        root = self.tree.root()
+
+        other = SQLiteBackend(self.storage_home.joinpath('other'))
+        other.set_many({'currency.balances:c': 3, 'currency.balances:b': 2, 'currency.balances:a': 1})
+        other_tree = StateTree(self.storage_home.joinpath('other', STATE_TREE_FILENAME), other)
+
+        self.assertEqual(other_tree.root(), root)
+
+        other.set_many({'currency.balances:c': 4})
+        self.assertNotEqual(other_tree.root(), root)
+        other.set_many({'currency.balances:c': 3})
+        self.assertEqual(other_tree.root(), root)
+
+        other_tree.close()
+        other.close()
+
+    def test_delete_restores_root(self):
+        self.backend.set_many({'currency.balances:a': 1})
+        root = self.tree.root()
+
+        self.backend.set_many({'currency.balances:b': 2})
+        self.backend.delete_many(['currency.balances:b'])
+        self.assertEqual(self.tree.root(), root)
+
+    def test_run_state_is_not_hashed(self):
+        self.backend.set_many({'__run_state__': 1, '__block_hash__.x': 2})
+        self.assertEqual(self.tree.root(), EMPTY[DEPTH].hex())
+
+    def test_incremental_matches_rebuild(self):
+        for i in range(20):
+            self.backend.set_many({f'con_{i % 3}.x:{j}': i * j for j in range(i, i + 30)})
+        root = self.tree.root()
+
+        self.tree.rebuild()
+        self.assertEqual(self.tree.root(), root)
+
+    def test_load_is_hashed(self):
+        self.backend.load({'currency.balances:a': '1'})
+        self.assertTrue(verify_proof(self.tree.root(), 'currency.balances:a', 1,
+                                     self.tree.proof('currency.balances:a')))
+
+    def test_proofs(self):
+        self.backend.set_many({f'currency.balances:{i}': i for i in range(100)})
+        root = self.tree.root()
+
+        proof = self.tree.proof('currency.balances:7')
+        self.assertTrue(verify_proof(root, 'currency.balances:7', 7, proof))
+        self.assertFalse(verify_proof(root, 'currency.balances:7', 8, proof))
+        self.assertTrue(verify_proof(root, 'currency.balances:missing', None,
+                                     self.tree.proof('currency.balances:missing')))
+        self.assertFalse(verify_proof(root, 'currency.balances:7', None, proof))
+
+    def test_tree_is_built_from_existing_state(self):
+        self.backend.set_many({'currency.balances:a': 1})
+        root = self.tree.root()
+        self.tree.close()
+        self.path.unlink()
+
+        self.tree = StateTree(self.path, self.backend)
+        self.assertEqual(self.tree.root(), root)
+
+    def test_tree_that_missed_a_write_is_rebuilt(self):
+        self.backend.set_many({'currency.balances:a': 1})
+
+        # As if the process died after the state was written and before the tree was updated
+        with mock.patch.object(StateTree, 'update', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.backend.set_many({'currency.balances:b': 2})
+        self.tree.close()
+
+        self.tree = StateTree(self.path, self.backend)
+        self.assertTrue(verify_proof(self.tree.root(), 'currency.balances:b', 2,
+                                     self.tree.proof('currency.balances:b')))
+
+    def test_tree_is_clean_after_writes(self):
+        self.backend.set_many({'currency.balances:a': 1})
+        self.backend.set_many({'__run_state__': 1})
+        self.tree.close()
+
+        with mock.patch.object(StateTree, 'rebuild') as rebuild:
+            self.tree = StateTree(self.path, self.backend)
+        rebuild.assert_not_called()
+
+
+class TestDriverStateRoot(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_state_root(self):
+        driver = Driver(storage_home=self.storage_home, merkle=True)
+        empty = driver.state_root()
+
+        driver.set('currency.balances:a', 1)
+        driver.commit()
+        committed = driver.state_root()
+        self.assertNotEqual(committed, empty)
+
+        driver.set('currency.balances:b', 2)
+        self.assertEqual(driver.state_root(), committed)
+        driver.hard_apply(1)
+        self.assertTrue(verify_proof(driver.state_root(), 'currency.balances:b', 2,
+                                     driver.state_proof('currency.balances:b')))
+
+    def test_state_root_needs_tree(self):
+        driver = Driver(storage_home=self.storage_home)
+        with self.assertRaises(AssertionError):
+            driver.state_root()
+
+
+if __name__ == '__main__':
+    unittest.main()
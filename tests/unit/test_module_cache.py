@@ -0,0 +1,115 @@
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.module_cache import CodeCache, CODE_CACHE, USAGE_FILENAME
+
+
+class TestCodeCache(unittest.TestCase):
+    def setUp(self):
+        self.storage_homes = []
+        self.driver = self.new_driver()
+        self.cache = CodeCache(size=2)
+
+    def tearDown(self):
+        for storage_home in self.storage_homes:
+            hdf5.close_backend(storage_home)
+            rmtree(storage_home, ignore_errors=True)
+
+    def new_driver(self):
+        storage_home = Path(tempfile.mkdtemp())
+        self.storage_homes.append(storage_home)
+        return Driver(storage_home=storage_home)
+
+    def test_get(self):
+        self.driver.set_contract('con_a', 'a = 1')
+        code = self.cache.get('con_a', self.driver)
+
+        scope = {}
+        exec(code, scope)
+        self.assertEqual(scope['a'], 1)
+
+        self.assertIs(self.cache.get('con_a', self.driver), code)
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_missing_contract(self):
+        self.assertIsNone(self.cache.get('con_missing', self.driver))
+
+    def test_same_name_different_code(self):
+        other = self.new_driver()
+        self.driver.set_contract('con_a', 'a = 1')
+        other.set_contract('con_a', 'a = 2')
+
+        self.assertIsNot(self.cache.get('con_a', self.driver), self.cache.get('con_a', other))
+
+        scope = {}
+        exec(self.cache.get('con_a', other), scope)
+        self.assertEqual(scope['a'], 2)
+
+    def test_bounded(self):
+        for name in ('con_a', 'con_b', 'con_c'):
+            self.driver.set_contract(name, 'a = 1')
+            self.cache.get(name, self.driver)
+
+        self.assertEqual(len(self.cache.entries), 2)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.assertEqual([key[0] for key in self.cache.entries], ['con_b', 'con_c'])
+
+    def test_invalidate(self):
+        self.driver.set_contract('con_a', 'a = 1')
+        self.driver.set_contract('con_b', 'a = 1')
+        self.cache.get('con_a', self.driver)
+        self.cache.get('con_b', self.driver)
+
+        self.cache.invalidate('con_a')
+        self.assertEqual([key[0] for key in self.cache.entries], ['con_b'])
+
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_set_and_delete_contract_invalidate(self):
+        self.driver.set_contract('con_a', 'a = 1')
+        CODE_CACHE.get('con_a', self.driver)
+        self.assertIn('con_a', [key[0] for key in CODE_CACHE.entries])
+
+        self.driver.delete_contract('con_a')
+        self.assertNotIn('con_a', [key[0] for key in CODE_CACHE.entries])
+        self.assertIsNone(CODE_CACHE.get('con_a', self.driver))
+
+        self.driver.set_contract('con_a', 'a = 2')
+        scope = {}
+        exec(CODE_CACHE.get('con_a', self.driver), scope)
+        self.assertEqual(scope['a'], 2)
+
+    def test_lookup_is_a_read(self):
+        self.driver.set_contract('con_a', 'a = 1')
+        self.driver.commit()
+
+        self.cache.get('con_a', self.driver)
+        self.assertIn('con_a.__compiled__', self.driver.pending_reads)
+
+    def test_warm_up(self):
+        for name in ('con_a', 'con_b', 'con_c'):
+            self.driver.set_contract(name, 'a = 1')
+        for name, uses in (('con_a', 1), ('con_b', 3), ('con_c', 2)):
+            for _ in range(uses):
+                self.cache.get(name, self.driver)
+        self.assertEqual(self.cache.most_used(2), ['con_b', 'con_c'])
+
+        path = self.storage_homes[0].joinpath(USAGE_FILENAME)
+        self.cache.save_usage(path)
+
+        cache = CodeCache(size=2)
+        self.assertEqual(cache.warm_up(self.driver, path=path), ['con_b', 'con_c'])
+        self.assertEqual([key[0] for key in cache.entries], ['con_b', 'con_c'])
+        self.assertEqual(cache.most_used(1), ['con_b'])
+
+        self.assertEqual(cache.warm_up(self.driver, names=['con_a', 'con_missing']), ['con_a'])
+        self.assertEqual(cache.warm_up(self.driver, path=path.with_name('missing.json')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.module import INSTANCE_CACHE
+from contracting.execution.runtime import rt
+
+TOKEN = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def balance_of(account: str):
+    return balances[account]
+
+@export
+def height():
+    return block_num
+'''
+
+PAYER = '''
+import con_instance_token
+
+@export
+def pay(amount: int, to: str):
+    con_instance_token.transfer(amount=amount, to=to)
+    return ctx.caller
+'''
+
+LEAKY = '''
+seen = []
+
+@export
+def add(x: int):
+    seen.append(x)
+    return len(seen)
+'''
+
+
+class TestModuleInstances(unittest.TestCase):
+    def setUp(self):
+        self.storage_homes = []
+        self.driver = self.new_driver()
+        self.executor = Executor(driver=self.driver, metering=True, currency_contract='con_instance_token',
+                                 balances_hash='balances')
+
+    def tearDown(self):
+        for storage_home in self.storage_homes:
+            hdf5.close_backend(storage_home)
+            rmtree(storage_home, ignore_errors=True)
+
+    def new_driver(self):
+        storage_home = Path(tempfile.mkdtemp())
+        self.storage_homes.append(storage_home)
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        contracts = {'con_instance_token': TOKEN, 'con_instance_payer': PAYER, 'con_instance_leaky': LEAKY}
+        for name, code in contracts.items():
+            driver.delete_contract(name)
+            client.submit(code, name=name)
+        client.executor.execute('stu', 'con_instance_token', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        client.executor.execute('stu', 'con_instance_token', 'transfer', {'amount': 100, 'to': 'con_instance_payer'})
+        driver.commit()
+        return driver
+
+    def test_module_is_reused(self):
+        self.executor.execute('alice', 'con_instance_token', 'transfer', {'amount': 1, 'to': 'bob'})
+        module = INSTANCE_CACHE['con_instance_token'].module
+
+        output = self.executor.execute('alice', 'con_instance_token', 'transfer', {'amount': 1, 'to': 'bob'})
+        self.assertEqual(output['status_code'], 0)
+        self.assertIs(INSTANCE_CACHE['con_instance_token'].module, module)
+        self.assertEqual(self.driver.get('con_instance_token.balances:bob'), 2)
+        self.assertNotIn('con_instance_token', sys.modules)
+        self.assertEqual(rt.loaded_modules, [])
+
+    def test_stamps_are_the_same_when_reused(self):
+        outputs = [self.executor.execute('alice', 'con_instance_payer', 'pay', {'amount': 1, 'to': 'bob'})
+                   for _ in range(3)]
+        self.assertEqual(len({o['stamps_used'] for o in outputs}), 1)
+        self.assertEqual([o['result'] for o in outputs], ['alice'] * 3)
+        self.assertIn('con_instance_payer', INSTANCE_CACHE)
+
+    def test_environment_is_bound(self):
+        for height in (1, 2, 3):
+            output = self.executor.execute('alice', 'con_instance_token', 'height', {},
+                                           environment={'block_num': height})
+            self.assertEqual(output['result'], height)
+
+        output = self.executor.execute('alice', 'con_instance_token', 'height', {})
+        self.assertIsInstance(output['result'], NameError)
+
+    def test_driver_is_bound(self):
+        self.executor.execute('alice', 'con_instance_token', 'transfer', {'amount': 5, 'to': 'bob'})
+        self.driver.commit()
+
+        other = self.new_driver()
+        executor = Executor(driver=other, metering=False)
+        output = executor.execute('alice', 'con_instance_token', 'balance_of', {'account': 'bob'})
+        self.assertEqual(output['result'], 0)
+
+        output = self.executor.execute('alice', 'con_instance_token', 'balance_of', {'account': 'bob'})
+        self.assertEqual(output['result'], 5)
+
+    def test_module_with_state_is_not_reused(self):
+        outputs = [self.executor.execute('alice', 'con_instance_leaky', 'add', {'x': i}) for i in range(3)]
+        self.assertEqual([o['result'] for o in outputs], [1, 1, 1])
+        self.assertNotIn('con_instance_leaky', INSTANCE_CACHE)
+
+    def test_redeploy_invalidates(self):
+        self.executor.execute('alice', 'con_instance_token', 'height', {}, environment={'block_num': 1})
+        self.assertIn('con_instance_token', INSTANCE_CACHE)
+
+        self.driver.delete_contract('con_instance_token')
+        self.assertNotIn('con_instance_token', INSTANCE_CACHE)
+
+        ContractingClient(driver=self.driver).submit('''
+@export
+def height():
+    return block_num * 2
+''', name='con_instance_token')
+        output = self.executor.execute('alice', 'con_instance_token', 'height', {}, environment={'block_num': 1},
+                                       metering=False)
+        self.assertEqual(output['result'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
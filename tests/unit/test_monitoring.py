@@ -0,0 +1,99 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.runtime import rt, RuntimeState
+from contracting.execution.metering import monitoring
+
+CONTRACT = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def loop(n: int):
+    total = sum([i * i for i in range(n)])
+    return total + sum([i for i in range(n) if i % 2])
+'''
+
+
+class TestMeteringEngines(unittest.TestCase):
+    def test_unknown_engine(self):
+        with self.assertRaises(AssertionError):
+            RuntimeState(metering='profile')
+
+    def test_set_metering(self):
+        with rt.use(RuntimeState()):
+            self.assertEqual(rt.state.metering, 'tracer')
+            rt.set_metering('tracer')
+            with self.assertRaises(AssertionError):
+                rt.set_metering('profile')
+
+    @unittest.skipIf(monitoring.AVAILABLE, 'sys.monitoring is available')
+    def test_monitoring_needs_sys_monitoring(self):
+        with self.assertRaises(AssertionError):
+            RuntimeState(metering='monitoring')
+
+
+@unittest.skipUnless(monitoring.AVAILABLE, 'sys.monitoring needs Python 3.12 or later')
+class TestMonitoringTracer(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+        client = ContractingClient(driver=self.driver)
+        client.submit(CONTRACT, name='con_metered')
+        client.executor.execute('stu', 'con_metered', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        self.driver.commit()
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def new_executor(self, metering):
+        return Executor(driver=self.driver, metering=True, currency_contract='con_metered', balances_hash='balances',
+                        runtime_state=RuntimeState(metering=metering))
+
+    def execute(self, executor, function, kwargs, stamps=10 ** 6):
+        output = executor.execute('alice', 'con_metered', function, kwargs, stamps=stamps)
+        self.driver.rollback()
+        return output
+
+    def test_same_stamps_as_tracer(self):
+        tracer = self.new_executor('tracer')
+        monitor = self.new_executor('monitoring')
+
+        for function, kwargs in [('transfer', {'amount': 5, 'to': 'bob'}), ('loop', {'n': 1}), ('loop', {'n': 50})]:
+            expected = self.execute(tracer, function, kwargs)
+            output = self.execute(monitor, function, kwargs)
+            self.assertEqual(output['status_code'], 0)
+            self.assertEqual(output['stamps_used'], expected['stamps_used'])
+            self.assertEqual(output['result'], expected['result'])
+
+    def test_out_of_stamps(self):
+        expected = self.execute(self.new_executor('tracer'), 'loop', {'n': 10 ** 5}, stamps=1000)
+        output = self.execute(self.new_executor('monitoring'), 'loop', {'n': 10 ** 5}, stamps=1000)
+        self.assertEqual(output['status_code'], 1)
+        self.assertIsInstance(output['result'], AssertionError)
+        self.assertEqual(output['stamps_used'], expected['stamps_used'])
+
+    def test_uninstalled_after_transaction(self):
+        self.execute(self.new_executor('monitoring'), 'loop', {'n': 5})
+        self.assertEqual(monitoring._started, {})
+        self.assertEqual(sys.monitoring.get_events(monitoring.TOOL_ID), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver, OverlayDriver
+from contracting.storage.orm import Hash
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+
+TOKEN = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def balance_of(account: str):
+    return balances[account]
+'''
+
+
+class TestOverlayDriver(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_writes_are_private(self):
+        self.driver.set('a', 1)
+        self.driver.commit()
+        self.driver.set('b', 2)
+        self.driver.get('a')
+
+        overlay = self.driver.overlay()
+        self.assertEqual(overlay.get('a'), 1)
+        self.assertEqual(overlay.get('b'), 2)
+
+        overlay.set('a', 10)
+        overlay.delete('b')
+        self.assertEqual(overlay.get('a'), 10)
+        self.assertIsNone(overlay.get('b'))
+
+        self.assertEqual(self.driver.pending_writes, {'b': 2})
+        self.assertEqual(self.driver.get('a'), 1)
+        self.assertEqual(self.driver.cache.get('a'), 1)
+
+    def test_discard_undoes_changes_in_place(self):
+        self.driver.set('a', {'x': 1})
+        self.driver.commit()
+        self.driver.set('b', [1])
+
+        overlay = self.driver.overlay()
+        a = overlay.get('a')
+        a['x'] = 2
+        overlay.set('a', a)
+        b = overlay.get('b')
+        b.append(2)
+        overlay.set('b', b)
+
+        overlay.discard()
+        self.assertEqual(self.driver.get('a'), {'x': 1})
+        self.assertEqual(self.driver.get('b'), [1])
+        self.assertEqual(overlay.get('a'), {'x': 1})
+
+    def test_sees_later_writes_of_parent(self):
+        overlay = self.driver.overlay()
+        self.driver.set('a', 1)
+        self.assertEqual(overlay.get('a'), 1)
+
+    def test_merge_and_discard(self):
+        self.driver.set('a', 1)
+        overlay = self.driver.overlay()
+        overlay.set('a', 2)
+        overlay.set('b', 3)
+
+        overlay.discard()
+        self.assertEqual(overlay.get('a'), 1)
+        self.assertIsNone(overlay.get('b'))
+
+        overlay.set('b', 3)
+        overlay.merge()
+        self.assertEqual(overlay.pending_writes, {})
+        self.assertEqual(self.driver.pending_writes, {'a': 1, 'b': 3})
+
+        overlay.set('c', 4)
+        overlay.commit()
+        self.assertEqual(self.driver.get('c'), 4)
+        self.assertIsNone(self.driver.value_from_disk('c'))
+
+    def test_stacked(self):
+        self.driver.set('a', 1)
+        first = OverlayDriver(self.driver)
+        first.set('b', 2)
+        second = first.overlay()
+        second.set('c', 3)
+
+        self.assertEqual([second.get(key) for key in 'abc'], [1, 2, 3])
+        self.assertIsNone(first.get('c'))
+
+        second.merge()
+        self.assertEqual(first.pending_writes, {'b': 2, 'c': 3})
+        self.assertNotIn('c', self.driver.pending_writes)
+
+        first.merge()
+        self.assertEqual(self.driver.pending_writes, {'a': 1, 'b': 2, 'c': 3})
+
+    def test_items(self):
+        self.driver.set('x.h:a', 1)
+        self.driver.set('x.h:b', 2)
+        self.driver.commit()
+        self.driver.set('x.h:c', 3)
+        self.driver.delete('x.h:a')
+
+        overlay = self.driver.overlay()
+        overlay.set('x.h:d', 4)
+        overlay.delete('x.h:b')
+
+        self.assertEqual(overlay.items('x.h:'), {'x.h:c': 3, 'x.h:d': 4})
+        self.assertEqual(overlay.keys_from_disk('x.h:'), ['x.h:b', 'x.h:c'])
+        self.assertEqual(self.driver.pending_writes, {'x.h:c': 3, 'x.h:a': None})
+
+        h = Hash('x', 'h', driver=overlay)
+        self.assertEqual(sorted(h.all()), [3, 4])
+
+    def test_merge_into_savepoint(self):
+        self.driver.set('a', 1)
+        savepoint = self.driver.savepoint()
+
+        overlay = self.driver.overlay()
+        overlay.set('a', 2)
+        overlay.merge()
+        self.assertEqual(self.driver.get('a'), 2)
+
+        self.driver.rollback_to_savepoint(savepoint)
+        self.assertEqual(self.driver.get('a'), 1)
+
+        overlay.savepoint()
+        with self.assertRaises(AssertionError):
+            overlay.merge()
+
+    def test_never_writes_to_the_store(self):
+        self.driver.set('a', 1)
+        self.driver.commit()
+
+        overlay = self.driver.overlay()
+        overlay.delete_key_from_disk('a')
+        self.assertIsNone(overlay.get('a'))
+        self.assertEqual(self.driver.value_from_disk('a'), 1)
+
+        with self.assertRaises(AssertionError):
+            overlay.flush_disk()
+
+
+class TestOverlayExecution(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+        client = ContractingClient(driver=self.driver)
+        client.submit(TOKEN, name='con_overlay_token')
+        client.executor.execute('stu', 'con_overlay_token', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        self.driver.commit()
+
+        self.executor = Executor(driver=self.driver, metering=True, currency_contract='con_overlay_token',
+                                 balances_hash='balances')
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_execute_on_overlay(self):
+        expected = self.executor.execute('alice', 'con_overlay_token', 'transfer', {'amount': 5, 'to': 'bob'})
+        self.driver.rollback()
+
+        overlay = self.driver.overlay()
+        output = self.executor.execute('alice', 'con_overlay_token', 'transfer', {'amount': 5, 'to': 'bob'},
+                                       driver=overlay)
+        self.assertEqual(output['stamps_used'], expected['stamps_used'])
+        self.assertEqual(output['writes'], expected['writes'])
+        self.assertEqual(self.driver.pending_writes, {})
+
+        overlay.merge()
+        self.assertEqual(self.driver.pending_writes, expected['writes'])
+
+    def test_executor_with_overlay(self):
+        overlay = self.driver.overlay()
+        executor = Executor(driver=overlay, metering=False)
+        ContractingClient(driver=overlay).submit('''
+@export
+def double(x: int):
+    return x * 2
+''', name='con_overlay_only')
+
+        self.assertEqual(executor.execute('alice', 'con_overlay_only', 'double', {'x': 2})['result'], 4)
+        output = self.executor.execute('alice', 'con_overlay_only', 'double', {'x': 2}, driver=self.driver)
+        self.assertEqual(output['status_code'], 1)
+        self.assertIsNone(self.driver.get_contract('con_overlay_only'))
+
+    def test_concurrent_simulations(self):
+        results = {}
+
+        def simulate(amount):
+            overlay = self.driver.overlay()
+            for _ in range(5):
+                self.executor.execute('alice', 'con_overlay_token', 'transfer', {'amount': amount, 'to': 'bob'},
+                                      driver=overlay)
+            results[amount] = overlay.get('con_overlay_token.balances:bob')
+
+        threads = [threading.Thread(target=simulate, args=(amount,)) for amount in range(1, 6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {amount: amount * 5 for amount in range(1, 6)})
+        self.assertEqual(self.driver.pending_writes, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import random
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver, CONTRACT_LISTENERS
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.parallel import ParallelExecutor
+
+TOKEN = '''
+balances = Hash(default_value=0)
+holders = Hash()
+
+@construct
+def seed():
+    balances['stu'] = 1000000
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+    holders[to] = True
+
+@export
+def count_holders():
+    return len(holders.all())
+
+@export
+def holder_keys():
+    return {'stu': 1}.keys()
+'''
+
+
+NEW = '''
+@export
+def hello():
+    return 'hello'
+'''
+
+
+def block(accounts, size, seed):
+    """
+    Transfers between accounts, so fewer accounts means more conflicts. Some transfers fail and some transactions list
+    a prefix that the transfers write to.
+    """
+    rng = random.Random(seed)
+    txs = []
+    for i in range(size):
+        if i % 10 == 9:
+            txs.append({'sender': 'stu', 'contract_name': 'con_token', 'function_name': 'count_holders',
+                        'kwargs': {}})
+            continue
+        sender, to = rng.sample(accounts, 2)
+        amount = rng.choice([1, 5, 10, 10 ** 9])
+        txs.append({'sender': sender, 'contract_name': 'con_token', 'function_name': 'transfer',
+                    'kwargs': {'amount': amount, 'to': to}})
+    return txs
+
+
+def comparable(output):
+    # Results that are exceptions are not equal to each other, so they are compared by type and arguments
+    result = output['result']
+    if isinstance(result, BaseException):
+        result = (type(result), result.args)
+    return dict(output, result=result, reads=dict(output['reads']))
+
+
+class TestParallelExecutor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.storage_home = Path(tempfile.mkdtemp())
+        cls.driver = Driver(storage_home=cls.storage_home)
+        client = ContractingClient(driver=cls.driver)
+        client.submit(TOKEN, name='con_token')
+
+        cls.accounts = [f'account_{i}' for i in range(20)]
+        for account in cls.accounts:
+            client.executor.execute('stu', 'con_token', 'transfer', {'amount': 1000, 'to': account})
+        cls.driver.commit()
+
+        cls.executor = Executor(driver=cls.driver, metering=True, currency_contract='con_token',
+                                balances_hash='balances')
+        cls.parallel = ParallelExecutor(cls.executor, workers=3)
+        cls.parallel.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.parallel.close()
+        hdf5.close_backend(cls.storage_home)
+        rmtree(cls.storage_home, ignore_errors=True)
+
+    def setUp(self):
+        self.driver.rollback()
+
+    def run_serially(self, txs):
+        # The outputs all hold the reads pending in the driver, which a rollback clears
+        serial = [self.executor.execute(**tx) for tx in txs]
+        return [comparable(output) for output in serial], dict(self.driver.pending_writes)
+
+    def assert_matches_serial(self, serial, serial_writes, parallel):
+        self.assertEqual([comparable(output) for output in parallel], serial)
+        self.assertEqual(self.driver.pending_writes, serial_writes)
+        for output in parallel:
+            self.assertIs(output['reads'], self.driver.pending_reads)
+
+    def assert_block_matches_serial(self, txs):
+        serial, serial_writes = self.run_serially(txs)
+        self.driver.rollback()
+
+        self.assert_matches_serial(serial, serial_writes, self.parallel.execute_block(txs))
+
+    def test_no_contention(self):
+        self.assert_block_matches_serial(block(self.accounts, 60, seed=1))
+
+    def test_high_contention(self):
+        self.assert_block_matches_serial(block(self.accounts[:3], 60, seed=2))
+
+    def test_consecutive_blocks(self):
+        for seed in range(3):
+            self.setUp()
+            self.assert_block_matches_serial(block(self.accounts[:5], 30, seed=seed))
+
+    def test_block_on_top_of_pending_writes(self):
+        self.executor.execute('account_0', 'con_token', 'transfer', {'amount': 7, 'to': 'account_1'})
+        before = dict(self.driver.pending_writes)
+        before_reads = dict(self.driver.pending_reads)
+        txs = block(self.accounts[:4], 20, seed=3)
+
+        serial, serial_writes = self.run_serially(txs)
+        self.driver.rollback()
+        self.driver.pending_writes.update(before)
+        self.driver.pending_reads.update(before_reads)
+
+        self.assert_matches_serial(serial, serial_writes, self.parallel.execute_block(txs))
+
+    def test_journal_and_contract_listeners(self):
+        txs = block(self.accounts[:4], 10, seed=5)
+        txs.insert(4, {'sender': 'stu', 'contract_name': 'submission', 'function_name': 'submit_contract',
+                       'kwargs': {'name': 'con_new', 'code': NEW}})
+        submitted = []
+        CONTRACT_LISTENERS.append(submitted.append)
+        try:
+            savepoint = self.driver.savepoint()
+            serial, serial_writes = self.run_serially(txs)
+            serial_journal = self.driver.release_savepoint(savepoint)
+            serial_submitted = list(submitted)
+            self.driver.rollback()
+            submitted.clear()
+
+            savepoint = self.driver.savepoint()
+            parallel = self.parallel.execute_block(txs)
+            # The time set_contract records by default is that of when a process imported it
+            for writes in [serial_writes, serial_journal, self.driver.pending_writes, self.driver.journal[-1][1]] + \
+                    [output['writes'] for output in serial + parallel]:
+                writes.pop('con_new.__submitted__', None)
+            self.assert_matches_serial(serial, serial_writes, parallel)
+            self.assertEqual(self.driver.journal[-1][1], serial_journal)
+            self.assertEqual(submitted, serial_submitted)
+            self.assertIn('con_new', submitted)
+
+            self.driver.rollback_to_savepoint(savepoint)
+            self.assertEqual(self.driver.pending_writes, {})
+            self.driver.release_savepoint(savepoint)
+        finally:
+            CONTRACT_LISTENERS.remove(submitted.append)
+
+    def test_result_that_can_not_be_sent(self):
+        txs = block(self.accounts[:4], 10, seed=4)
+        txs.insert(3, {'sender': 'stu', 'contract_name': 'con_token', 'function_name': 'holder_keys', 'kwargs': {}})
+
+        serial, serial_writes = self.run_serially(txs)
+        self.driver.rollback()
+
+        local_executions = self.parallel.stats['local_executions']
+        parallel = self.parallel.execute_block(txs)
+        self.assert_matches_serial(serial, serial_writes, parallel)
+        self.assertEqual(type(parallel[3]['result']).__name__, 'dict_keys')
+        self.assertEqual(self.parallel.stats['local_executions'], local_executions + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver, ReadOnlyDriver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.runtime import rt
+
+TOKEN = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def balance_of(account: str):
+    return balances[account]
+
+@export
+def whoami():
+    return ctx.caller
+
+@export
+def mint(amount: int):
+    balances[ctx.caller] += amount
+'''
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+        client = ContractingClient(driver=self.driver)
+        client.submit(TOKEN, name='con_query_token')
+        client.executor.execute('stu', 'con_query_token', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        self.driver.commit()
+
+        self.executor = Executor(driver=self.driver, metering=True, currency_contract='con_query_token',
+                                 balances_hash='balances')
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_query(self):
+        output = self.executor.query('con_query_token', 'balance_of', {'account': 'alice'})
+        self.assertEqual(output, {'status_code': 0, 'result': 10 ** 7})
+
+        output = self.executor.query('con_query_token', 'whoami', {}, signer='nobody')
+        self.assertEqual(output['result'], 'nobody')
+
+    def test_reads_committed_state(self):
+        self.executor.execute('alice', 'con_query_token', 'transfer', {'amount': 5, 'to': 'bob'})
+        self.assertEqual(self.executor.query('con_query_token', 'balance_of', {'account': 'bob'})['result'], 0)
+
+        pending = dict(self.driver.pending_writes)
+        self.driver.commit()
+        self.assertEqual(self.executor.query('con_query_token', 'balance_of', {'account': 'bob'})['result'], 5)
+        self.assertIn('con_query_token.balances:bob', pending)
+
+    def test_writes_fail(self):
+        output = self.executor.query('con_query_token', 'mint', {'amount': 5}, signer='alice')
+        self.assertEqual(output['status_code'], 1)
+        self.assertIsInstance(output['result'], AssertionError)
+        self.assertEqual(self.driver.pending_writes, {})
+
+        driver = ReadOnlyDriver(self.driver)
+        with self.assertRaises(AssertionError):
+            driver.set('con_query_token.balances:alice', 1)
+
+    def test_private_function(self):
+        with self.assertRaises(AssertionError):
+            self.executor.query('con_query_token', '__balances', {})
+
+    def test_runtime_is_left_as_it_was(self):
+        rt.env.update({'__Driver': self.driver, 'block_num': 1})
+        self.executor.query('con_query_token', 'balance_of', {'account': 'alice'})
+        self.assertEqual(rt.env, {'__Driver': self.driver, 'block_num': 1})
+        self.assertEqual(rt.loaded_modules, [])
+        rt.clean_up()
+
+    def test_concurrent_with_execution(self):
+        results = []
+        errors = []
+        stop = threading.Event()
+
+        def serve():
+            while not stop.is_set():
+                output = self.executor.query('con_query_token', 'balance_of', {'account': 'alice'})
+                if output['status_code'] != 0:
+                    errors.append(output['result'])
+                results.append(output['result'])
+
+        threads = [threading.Thread(target=serve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            outputs = [self.executor.execute('alice', 'con_query_token', 'transfer', {'amount': 1, 'to': 'bob'})
+                       for _ in range(100)]
+            self.driver.commit()
+            batch = self.executor.execute_batch([{'sender': 'alice', 'contract_name': 'con_query_token',
+                                                  'function_name': 'transfer', 'kwargs': {'amount': 1, 'to': 'bob'}}
+                                                 for _ in range(100)])
+            self.driver.commit()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(results)
+        self.assertEqual({o['status_code'] for o in outputs + batch}, {0})
+        self.assertEqual(self.driver.get('con_query_token.balances:bob'), 200)
+        self.assertEqual(self.executor.query('con_query_token', 'balance_of', {'account': 'bob'})['result'], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
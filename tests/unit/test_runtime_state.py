@@ -0,0 +1,118 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.client import ContractingClient
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.execution.executor import Executor
+from contracting.execution.runtime import rt, ctx, RuntimeState, DEFAULT_STATE
+
+TOKEN = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 10 ** 9
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+    return ctx.caller
+'''
+
+
+class TestRuntimeState(unittest.TestCase):
+    def test_use(self):
+        state = RuntimeState()
+        self.assertIs(rt.state, DEFAULT_STATE)
+        caller = ctx.caller
+
+        with rt.use(state):
+            self.assertIs(rt.state, state)
+            rt.env.update({'block_num': 1})
+            rt.context._base_state = {**rt.context._base_state, 'caller': 'alice'}
+            self.assertEqual(ctx.caller, 'alice')
+
+        self.assertIs(rt.state, DEFAULT_STATE)
+        self.assertNotIn('block_num', rt.env)
+        self.assertEqual(ctx.caller, caller)
+        self.assertEqual(state.env, {'block_num': 1})
+
+    def test_tracer_of_a_state(self):
+        state = RuntimeState()
+        with rt.use(state):
+            rt.set_up(stmps=1000, meter=True)
+            rt.tracer.stop()
+            self.assertIsNot(rt.tracer, DEFAULT_STATE.tracer)
+            rt.clean_up()
+        self.assertFalse(DEFAULT_STATE.tracer.is_started())
+
+    def test_threads_start_with_the_default_state(self):
+        seen = []
+        with rt.use(RuntimeState()):
+            thread = threading.Thread(target=lambda: seen.append(rt.state))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [DEFAULT_STATE])
+
+
+class TestExecutorsWithOwnState(unittest.TestCase):
+    def setUp(self):
+        self.storage_homes = []
+
+    def tearDown(self):
+        for storage_home in self.storage_homes:
+            hdf5.close_backend(storage_home)
+            rmtree(storage_home, ignore_errors=True)
+
+    def new_executor(self, runtime_state=None):
+        storage_home = Path(tempfile.mkdtemp())
+        self.storage_homes.append(storage_home)
+        driver = Driver(storage_home=storage_home)
+        client = ContractingClient(driver=driver)
+        driver.delete_contract('con_state_token')
+        client.submit(TOKEN, name='con_state_token')
+        client.executor.execute('stu', 'con_state_token', 'transfer', {'amount': 10 ** 7, 'to': 'alice'})
+        driver.commit()
+        return Executor(driver=driver, metering=True, currency_contract='con_state_token', balances_hash='balances',
+                        runtime_state=runtime_state)
+
+    def test_env_is_not_shared(self):
+        executor = self.new_executor(RuntimeState())
+        DEFAULT_STATE.env.update({'block_num': 1})
+        output = executor.execute('alice', 'con_state_token', 'transfer', {'amount': 1, 'to': 'bob'},
+                                  environment={'block_num': 2})
+        self.assertEqual(output['result'], 'alice')
+        self.assertEqual(DEFAULT_STATE.env.get('block_num'), 1)
+        self.assertEqual(executor.runtime_state.env, {'__Driver': executor.driver})
+        rt.clean_up()
+
+    def test_executors_in_threads(self):
+        serial = self.new_executor()
+        expected = [serial.execute('alice', 'con_state_token', 'transfer', {'amount': 1, 'to': 'bob'})['stamps_used']
+                    for _ in range(10)]
+        executors = [self.new_executor(RuntimeState()) for _ in range(3)]
+        outputs = {}
+
+        def run(i):
+            outputs[i] = [executors[i].execute('alice', 'con_state_token', 'transfer', {'amount': 1, 'to': 'bob'})
+                          for _ in range(10)]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i, executor in enumerate(executors):
+            self.assertEqual([o['stamps_used'] for o in outputs[i]], expected)
+            self.assertEqual(executor.driver.get('con_state_token.balances:bob'), 10)
+        rt.clean_up()
+
+
+if __name__ == '__main__':
+    unittest.main()
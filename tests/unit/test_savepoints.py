@@ -0,0 +1,189 @@
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver
+from contracting.storage import hdf5
+from contracting.client import ContractingClient
+from contracting.execution.runtime import Context, rt
+
+COUNTER = '''
+counter = Variable()
+items = Hash()
+
+@construct
+def seed():
+    counter.set(0)
+
+@export
+def tag(name: str):
+    tags = items['tags'] or []
+    tags.append(name)
+    items['tags'] = tags
+
+@export
+def bump(fail: bool):
+    counter.set(counter.get() + 1)
+    items[counter.get()] = 'x'
+    assert not fail, 'Failed on purpose.'
+'''
+
+
+class TestSavepoints(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_rollback_restores_touched_keys(self):
+        self.driver.set('con_a.x', 1)
+        self.driver.set('con_a.y', 2)
+
+        savepoint = self.driver.savepoint()
+        self.driver.set('con_a.x', 3)
+        self.driver.set('con_a.z', 4)
+        self.driver.delete('con_a.y')
+        self.driver.rollback_to_savepoint(savepoint)
+
+        self.assertEqual(self.driver.pending_writes, {'con_a.x': 1, 'con_a.y': 2})
+        self.assertEqual(self.driver.release_savepoint(savepoint), {})
+        self.assertEqual(self.driver.journal, [])
+
+    def test_release_returns_writes(self):
+        self.driver.set('con_a.x', 1)
+
+        savepoint = self.driver.savepoint()
+        self.driver.set('con_a.y', 2)
+        self.driver.set('con_a.y', 3)
+
+        self.assertEqual(self.driver.release_savepoint(savepoint), {'con_a.y': 3})
+        self.assertEqual(self.driver.pending_writes, {'con_a.x': 1, 'con_a.y': 3})
+
+    def test_in_place_changes_are_rolled_back(self):
+        self.driver.set('con_a.x', [1])
+
+        savepoint = self.driver.savepoint()
+        value = self.driver.get('con_a.x')
+        value.append(2)
+        self.driver.set('con_a.x', value)
+        self.driver.rollback_to_savepoint(savepoint)
+
+        self.assertEqual(self.driver.get('con_a.x'), [1])
+
+    def test_nested(self):
+        outer = self.driver.savepoint()
+        self.driver.set('con_a.x', 1)
+
+        inner = self.driver.savepoint()
+        self.driver.set('con_a.x', 2)
+        self.driver.set('con_a.y', 2)
+        self.driver.rollback_to_savepoint(inner)
+        self.assertEqual(self.driver.pending_writes, {'con_a.x': 1})
+
+        self.driver.set('con_a.z', 3)
+        self.assertEqual(self.driver.release_savepoint(inner), {'con_a.z': 3})
+        self.assertEqual(self.driver.release_savepoint(outer), {'con_a.x': 1, 'con_a.z': 3})
+
+    def test_rollback_of_outer_undoes_released_inner(self):
+        outer = self.driver.savepoint()
+        inner = self.driver.savepoint()
+        self.driver.set('con_a.x', 1)
+        self.driver.release_savepoint(inner)
+
+        self.driver.rollback_to_savepoint(outer)
+        self.assertEqual(self.driver.pending_writes, {})
+
+
+class TestContextSavepoints(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.driver = Driver(storage_home=self.storage_home)
+        self.context = Context(base_state={'caller': 'stu', 'signer': 'stu', 'this': 'con_outer', 'owner': None})
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def call(self, contract):
+        self.context._add_state({'caller': self.context.this, 'signer': 'stu', 'this': contract, 'owner': None},
+                                self.driver)
+
+    def test_failed_call_is_rolled_back(self):
+        self.driver.set('con_outer.x', 1)
+
+        self.call('con_inner')
+        self.driver.set('con_inner.x', 2)
+        self.driver.set('con_outer.x', 3)
+        self.context._pop_state(failed=True)
+
+        self.assertEqual(self.driver.pending_writes, {'con_outer.x': 1})
+        self.assertEqual(self.driver.journal, [])
+
+    def test_nested_calls(self):
+        self.call('con_a')
+        self.driver.set('con_a.x', 1)
+        self.call('con_b')
+        self.driver.set('con_b.x', 2)
+        self.context._pop_state()
+        self.call('con_c')
+        self.driver.set('con_c.x', 3)
+        self.context._pop_state(failed=True)
+        self.context._pop_state()
+
+        self.assertEqual(self.driver.pending_writes, {'con_a.x': 1, 'con_b.x': 2})
+        self.assertEqual(self.driver.journal, [])
+
+    def test_runtime_api(self):
+        previous = rt.env.get('__Driver')
+        rt.env.update({'__Driver': self.driver})
+        try:
+            savepoint = rt.savepoint()
+            self.driver.set('con_a.x', 1)
+            rt.rollback_to_savepoint(savepoint)
+            self.driver.set('con_a.y', 2)
+
+            self.assertEqual(rt.release_savepoint(savepoint), {'con_a.y': 2})
+        finally:
+            rt.env.update({'__Driver': previous})
+
+
+class TestExecutorWrites(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.client = ContractingClient(driver=Driver(storage_home=self.storage_home))
+        self.client.submit(COUNTER, name='con_counter')
+        self.executor = self.client.executor
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_writes_are_those_of_the_transaction(self):
+        self.executor.execute('stu', 'con_counter', 'bump', {'fail': False})
+        output = self.executor.execute('stu', 'con_counter', 'bump', {'fail': False})
+
+        self.assertEqual(output['status_code'], 0)
+        self.assertEqual(output['writes'], {'con_counter.counter': 2, 'con_counter.items:2': 'x'})
+
+    def test_writes_are_not_changed_by_later_transactions(self):
+        output = self.executor.execute('stu', 'con_counter', 'tag', {'name': 'a'})
+        self.executor.execute('stu', 'con_counter', 'tag', {'name': 'b'})
+
+        self.assertEqual(output['writes'], {'con_counter.items:tags': ['a']})
+
+    def test_failed_transaction_is_reverted(self):
+        self.executor.execute('stu', 'con_counter', 'bump', {'fail': False})
+        output = self.executor.execute('stu', 'con_counter', 'bump', {'fail': True})
+
+        self.assertEqual(output['status_code'], 1)
+        self.assertEqual(output['writes'], {})
+        self.assertEqual(self.client.raw_driver.get('con_counter.counter'), 1)
+        self.assertIsNone(self.client.raw_driver.get('con_counter.items:2'))
+        self.assertEqual(self.client.raw_driver.journal, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import itertools
+import tempfile
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver, LAYOUT_CONTRACT
+from contracting.storage.hdf5 import HDF5Backend
+from contracting.storage.sqlite import SQLiteBackend
+from contracting.storage.snapshot import write_snapshot, load_snapshot, iter_snapshot, iter_view_items, CHUNK_HEADER, \
+    MAGIC
+from contracting.storage.encoder import encode
+from contracting.storage import hdf5
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.source = HDF5Backend(self.storage_home.joinpath('source'), layout=LAYOUT_CONTRACT)
+        self.state = {f'currency.balances:{i:04}': ContractingDecimal(f'{i}.5') for i in range(250)}
+        self.state['con_thing.owner'] = 'stu'
+        self.state['__run_state__'] = {'height': 7}
+        self.source.set_many(self.state)
+        self.path = self.storage_home.joinpath('state.snapshot')
+
+    def tearDown(self):
+        self.source.close()
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_iter_items(self):
+        items = list(self.source.iter_items(batch=16))
+
+        self.assertEqual([key for key, _ in items], sorted(self.state))
+        self.assertEqual(dict(items), {key: encode(value) for key, value in self.state.items()})
+        self.assertEqual(len(list(self.source.iter_items('currency.', batch=16))), 250)
+
+    def test_round_trip(self):
+        count = write_snapshot(self.source.iter_items(), self.path, chunk_keys=32)
+        self.assertEqual(count, len(self.state))
+        self.assertEqual(list(iter_snapshot(self.path)), list(self.source.iter_items()))
+
+        for target in (HDF5Backend(self.storage_home.joinpath('hdf5')),
+                       SQLiteBackend(self.storage_home.joinpath('sqlite'))):
+            self.assertEqual(load_snapshot(target, self.path, workers=3), len(self.state))
+            self.assertEqual(list(target.iter_items()), list(self.source.iter_items()))
+            self.assertEqual(target.get('currency.balances:0010'), ContractingDecimal('10.5'))
+            target.close()
+
+    def test_export_from_a_view(self):
+        expected = list(self.source.iter_items())
+
+        with self.source.snapshot() as view:
+            items = iter_view_items(view, batch=16)
+            first = next(items)
+            # Written while the export runs
+            self.source.set_many({'currency.balances:0100': 1, 'currency.balances:9999': 2, 'con_thing.owner': None})
+            write_snapshot(itertools.chain([first], items), self.path, chunk_keys=32)
+
+        self.assertEqual(list(iter_snapshot(self.path)), expected)
+
+    def test_corrupt_chunk(self):
+        write_snapshot(self.source.iter_items(), self.path, chunk_keys=32)
+        data = bytearray(self.path.read_bytes())
+        data[len(MAGIC) + CHUNK_HEADER.size + 10] ^= 0xFF
+        self.path.write_bytes(bytes(data))
+
+        with self.assertRaises(AssertionError):
+            list(iter_snapshot(self.path))
+
+    def test_truncated(self):
+        write_snapshot(self.source.iter_items(), self.path, chunk_keys=32)
+        data = self.path.read_bytes()
+        self.path.write_bytes(data[:-CHUNK_HEADER.size])
+
+        with self.assertRaises(AssertionError):
+            list(iter_snapshot(self.path))
+
+    def test_only_into_empty_store(self):
+        write_snapshot(self.source.iter_items(), self.path)
+
+        with self.assertRaises(AssertionError):
+            load_snapshot(self.source, self.path)
+
+
+class TestDriverIterState(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_iter_state(self):
+        driver = Driver(storage_home=self.storage_home)
+        driver.set('con_b.x', 2)
+        driver.set('con_a.x', 1)
+        driver.commit()
+
+        self.assertEqual(list(driver.iter_state()), [('con_a.x', encode(1)), ('con_b.x', encode(2))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage.driver import Driver
+from contracting.storage.hdf5 import HDF5Backend
+from contracting.storage.versions import MVCCBackend, VERSIONS_FILENAME
+from contracting.storage import hdf5
+
+# The nanoseconds of a block of late 2023
+NANOS = 1_700_000_000_000_000_000
+
+
+class TestMVCCBackend(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.inner = HDF5Backend(self.storage_home)
+        self.path = self.storage_home.joinpath(VERSIONS_FILENAME)
+        self.backend = MVCCBackend(self.inner, self.path)
+
+    def tearDown(self):
+        self.backend.close()
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_reads_at_height(self):
+        self.backend.set_many({'currency.balances:a': 1}, 10)
+        self.backend.set_many({'currency.balances:a': 2, 'currency.balances:b': 5}, 20)
+        self.backend.set_many({'currency.balances:a': None}, 30)
+
+        self.assertIsNone(self.backend.get_at('currency.balances:a', 5))
+        self.assertEqual(self.backend.get_at('currency.balances:a', 10), 1)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 25), 2)
+        self.assertIsNone(self.backend.get_at('currency.balances:a', 30))
+        self.assertIsNone(self.backend.get_at('currency.balances:b', 15))
+        self.assertEqual(self.backend.get_at('currency.balances:b', 30), 5)
+        self.assertIsNone(self.backend.get('currency.balances:a'))
+
+    def test_value_before_versions(self):
+        self.inner.set_many({'currency.balances:a': 1, 'currency.balances:b': 7}, 1)
+        self.backend.set_many({'currency.balances:a': 2}, 10)
+
+        self.assertEqual(self.backend.get_at('currency.balances:a', 5), 1)
+        self.assertEqual(self.backend.get_at('currency.balances:b', 5), 7)
+
+    def test_heights_must_not_decrease(self):
+        self.backend.set_many({'currency.balances:a': 1}, 10)
+        self.backend.set_many({'currency.balances:a': 2})
+
+        self.assertEqual(self.backend.latest, 11)
+        with self.assertRaises(AssertionError):
+            self.backend.set_many({'currency.balances:a': 3}, 5)
+
+    def test_snapshot(self):
+        self.backend.set_many({'currency.balances:a': 1, 'currency.balances:b': 2}, 10)
+        snapshot = self.backend.snapshot()
+        self.backend.set_many({'currency.balances:a': 3, 'currency.balances:b': None, 'currency.balances:c': 4}, 20)
+
+        self.assertEqual(snapshot.get('currency.balances:a'), 1)
+        self.assertEqual(snapshot.get_many(['currency.balances:b', 'currency.balances:c']),
+                         {'currency.balances:b': 2, 'currency.balances:c': None})
+        self.assertEqual(snapshot.iter_prefix('currency.balances'), ['currency.balances:a', 'currency.balances:b'])
+        self.assertEqual(self.backend.snapshot(20).iter_prefix('currency.balances'),
+                         ['currency.balances:a', 'currency.balances:c'])
+
+    def test_same_height_is_not_rewritten_under_a_snapshot(self):
+        self.backend.set_many({'currency.balances:a': 1}, 10)
+        self.backend.set_many({'currency.balances:a': 2}, 10)
+
+        with self.backend.snapshot() as snapshot:
+            with self.assertRaises(AssertionError):
+                self.backend.set_many({'currency.balances:a': 3}, 10)
+            self.backend.set_many({'currency.balances:a': 3}, 11)
+            self.assertEqual(snapshot.get('currency.balances:a'), 2)
+
+        self.backend.set_many({'currency.balances:a': 4}, 11)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 11), 4)
+
+    def write_during(self, name, values, height):
+        """
+        Makes the next call to method name of the store in this thread write values at height in another thread first,
+        and wait for that write up to a timeout, which it runs into if the read holds the write off.
+        """
+        method = getattr(self.inner, name)
+        writer = threading.Thread(target=self.backend.set_many, args=(values, height))
+
+        def write_first(*args, **kwargs):
+            if threading.current_thread() is threading.main_thread() and not writer.is_alive():
+                setattr(self.inner, name, method)
+                writer.start()
+                writer.join(0.5)
+            return method(*args, **kwargs)
+
+        setattr(self.inner, name, write_first)
+        return writer
+
+    def test_reads_at_height_while_writing(self):
+        self.inner.set_many({'currency.balances:a': 1}, 1)
+        self.backend.set_many({'currency.balances:b': 1}, 10)
+
+        writer = self.write_during('get', {'currency.balances:a': 2}, 11)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 10), 1)
+        writer.join()
+
+        writer = self.write_during('iter_prefix', {'currency.balances:c': 3}, 12)
+        self.assertEqual(self.backend.iter_prefix_at(10, 'currency.'), ['currency.balances:a', 'currency.balances:b'])
+        writer.join()
+
+        self.assertEqual(self.backend.get_at('currency.balances:a', 12), 2)
+        self.assertEqual(self.backend.get_at('currency.balances:c', 12), 3)
+
+    def test_pages_at_height_list_a_page(self):
+        self.backend.set_many({f'currency.balances:{i:04}': i for i in range(1000)}, 10)
+        self.backend.set_many({'currency.balances:0500x': 1, 'currency.balances:0501': None}, 20)
+
+        listed = []
+        scan = self.inner.iter_prefix
+
+        def iter_prefix(*args, **kwargs):
+            keys = scan(*args, **kwargs)
+            listed.append(len(keys))
+            return keys
+
+        self.inner.iter_prefix = iter_prefix
+        keys = []
+        cursor = None
+        while True:
+            page = self.backend.iter_prefix_at(10, 'currency.', 100, cursor)
+            keys.extend(page)
+            if len(page) < 100:
+                break
+            cursor = page[-1]
+
+        self.assertEqual(keys, [f'currency.balances:{i:04}' for i in range(1000)])
+        # A page and the one new key that may be dropped from it
+        self.assertLessEqual(max(listed), 101)
+        self.assertLessEqual(sum(listed), 1000 + len(listed))
+
+    def test_prune(self):
+        for height in range(1, 11):
+            self.backend.set_many({'currency.balances:a': height}, height)
+        self.backend.prune(8)
+
+        self.assertEqual(self.backend.versions.count(), 3)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 8), 8)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 10), 10)
+        with self.assertRaises(AssertionError):
+            self.backend.get_at('currency.balances:a', 7)
+
+    def test_retain(self):
+        self.backend.retain = 5
+        for height in range(1, 201):
+            self.backend.set_many({'currency.balances:a': height}, height)
+
+        self.assertEqual(self.backend.versions.pruned, 195)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 196), 196)
+
+    def test_versions_survive_reopen(self):
+        self.backend.set_many({'currency.balances:a': 1}, 10)
+        self.backend.set_many({'currency.balances:a': 2}, 20)
+        self.backend.close()
+
+        self.backend = MVCCBackend(HDF5Backend(self.storage_home), self.path)
+        self.assertEqual(self.backend.latest, 20)
+        self.assertEqual(self.backend.get_at('currency.balances:a', 15), 1)
+
+
+class TestDriverVersions(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_get_at_height(self):
+        driver = Driver(storage_home=self.storage_home, versions=True)
+        driver.set('currency.balances:a', 1)
+        driver.hard_apply(NANOS, block_num=100)
+        driver.set('currency.balances:a', 2)
+        driver.hard_apply(NANOS + 10 ** 9, block_num=200)
+
+        self.assertEqual(driver.get('currency.balances:a', at_height=150), 1)
+        self.assertEqual(driver.get('currency.balances:a'), 2)
+        self.assertEqual(driver.snapshot(at_height=100).get('currency.balances:a'), 1)
+
+    def test_retain_with_nanos(self):
+        driver = Driver(storage_home=self.storage_home, versions=True, retain=5)
+        for height in range(1, 201):
+            driver.set('currency.balances:a', height)
+            driver.hard_apply(NANOS + height * 10 ** 9, block_num=height)
+
+        self.assertEqual(driver.backend.versions.pruned, 195)
+        self.assertEqual(driver.get('currency.balances:a', at_height=196), 196)
+        with self.assertRaises(AssertionError):
+            driver.get('currency.balances:a', at_height=194)
+
+    def test_heights_without_block_num(self):
+        driver = Driver(storage_home=self.storage_home, versions=True)
+        for i in range(3):
+            driver.set('currency.balances:a', i)
+            driver.hard_apply(NANOS + i * 10 ** 9)
+
+        self.assertEqual(driver.backend.latest, 2)
+        self.assertEqual(driver.get('currency.balances:a', at_height=1), 1)
+
+    def test_get_at_height_needs_versions(self):
+        driver = Driver(storage_home=self.storage_home)
+        with self.assertRaises(AssertionError):
+            driver.get('currency.balances:a', at_height=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+from shutil import rmtree
+from contracting.storage import hdf5
+from contracting.storage.driver import Driver, LAYOUT_CONTRACT
+from contracting.storage.hdf5 import HDF5Backend
+from contracting.storage.wal import WALBackend, WAL_FILENAME, read_records, replay
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+
+
+class TestWAL(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+        self.path = self.storage_home.joinpath(WAL_FILENAME)
+        self.backend = HDF5Backend(self.storage_home, layout=LAYOUT_CONTRACT)
+
+    def tearDown(self):
+        self.backend.close()
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def lazy(self):
+        # Never applies on its own, as if the process died before it got to it
+        return WALBackend(self.backend, self.path, background=False, max_pending=1000)
+
+    def test_unapplied_writes_are_read_from_the_log(self):
+        wal = self.lazy()
+        wal.set_many({'currency.balances:a': ContractingDecimal('1.5'), 'currency.balances:b': 2})
+        wal.set_many({'currency.balances:b': None})
+
+        self.assertIsNone(self.backend.get('currency.balances:a'))
+        self.assertEqual(wal.get('currency.balances:a'), ContractingDecimal('1.5'))
+        self.assertIsNone(wal.get('currency.balances:b'))
+        self.assertEqual(wal.iter_prefix('currency.'), ['currency.balances:a'])
+        self.assertEqual(len(read_records(self.path)[0]), 2)
+
+    def test_apply_writes_to_backend_and_truncates(self):
+        wal = self.lazy()
+        wal.set_many({'currency.balances:a': 1}, block_num=1)
+        wal.set_many({'currency.balances:a': 2, 'currency.balances:b': 3}, block_num=2)
+        wal.apply()
+
+        self.assertEqual(self.backend.get('currency.balances:a'), 2)
+        self.assertEqual(hdf5.get_block(*self.backend.location('currency.balances:a')), 2)
+        self.assertEqual(wal.overlay, {})
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_replay_after_crash(self):
+        wal = self.lazy()
+        wal.set_many({'currency.balances:a': 1, 'con_thing.owner': 'stu'})
+        wal.set_many({'currency.balances:a': None})
+
+        self.assertEqual(replay(self.backend, self.path), 2)
+        self.assertIsNone(self.backend.get('currency.balances:a'))
+        self.assertEqual(self.backend.get('con_thing.owner'), 'stu')
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_torn_record_is_discarded(self):
+        wal = self.lazy()
+        wal.set_many({'currency.balances:a': 1})
+        wal.set_many({'currency.balances:b': 2})
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+
+        records, _ = read_records(self.path)
+        self.assertEqual(records, [(-1, {'currency.balances:a': 1})])
+
+        replay(self.backend, self.path)
+        self.assertEqual(self.backend.get('currency.balances:a'), 1)
+        self.assertIsNone(self.backend.get('currency.balances:b'))
+
+    def test_background_apply(self):
+        wal = WALBackend(self.backend, self.path)
+        for i in range(50):
+            wal.set_many({f'currency.balances:{i}': i}, block_num=i)
+        wal.drain()
+
+        for i in range(50):
+            self.assertEqual(self.backend.get(f'currency.balances:{i}'), i)
+        self.assertEqual(wal.overlay, {})
+
+    def fail_once(self):
+        set_many = self.backend.set_many
+        errors = [OSError('disk full')]
+
+        def failing(values, block_num=None):
+            if errors:
+                raise errors.pop()
+            set_many(values, block_num)
+
+        return mock.patch.object(self.backend, 'set_many', side_effect=failing)
+
+    def test_failed_apply_is_raised_and_retried(self):
+        wal = WALBackend(self.backend, self.path)
+        with self.fail_once():
+            wal.set_many({'currency.balances:a': 1}, block_num=1)
+            with self.assertRaises(OSError):
+                wal.drain()
+            self.assertEqual(wal.get('currency.balances:a'), 1)
+
+            wal.set_many({'currency.balances:b': 2}, block_num=2)
+            wal.drain()
+
+        self.assertEqual(self.backend.get('currency.balances:a'), 1)
+        self.assertEqual(self.backend.get('currency.balances:b'), 2)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertTrue(wal.thread.is_alive())
+        self.assertEqual(wal.stats['wal_apply_errors'], 1)
+
+    def test_next_write_raises(self):
+        wal = WALBackend(self.backend, self.path)
+        with mock.patch.object(self.backend, 'set_many', side_effect=OSError('disk full')):
+            wal.set_many({'currency.balances:a': 1})
+            with wal.lock:
+                while wal.error is None:
+                    wal.condition.wait()
+            with self.assertRaises(OSError):
+                wal.set_many({'currency.balances:b': 2})
+            self.assertEqual(len(read_records(self.path)[0]), 1)
+
+            with self.assertRaises(OSError):
+                wal.close()
+        self.assertFalse(wal.thread.is_alive())
+
+        # Left in the log for the next open
+        self.backend = HDF5Backend(self.storage_home)
+        self.assertEqual(replay(self.backend, self.path), 1)
+        self.assertEqual(self.backend.get('currency.balances:a'), 1)
+
+
+class TestDriverWAL(unittest.TestCase):
+    def setUp(self):
+        self.storage_home = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        hdf5.close_backend(self.storage_home)
+        rmtree(self.storage_home, ignore_errors=True)
+
+    def test_commit_through_log(self):
+        driver = Driver(storage_home=self.storage_home, wal=True)
+        self.assertIsInstance(driver.backend, WALBackend)
+
+        driver.set('currency.balances:a', 1)
+        driver.commit()
+        driver.set('currency.balances:b', 2)
+        driver.hard_apply('1')
+
+        self.assertEqual(Driver(storage_home=self.storage_home).get('currency.balances:b'), 2)
+
+        hdf5.close_backend(self.storage_home)
+        driver = Driver(storage_home=self.storage_home)
+        self.assertEqual(driver.get('currency.balances:a'), 1)
+        self.assertEqual(driver.get('currency.balances:b'), 2)
+
+    def test_leftover_log_is_replayed_on_open(self):
+        backend = WALBackend(HDF5Backend(self.storage_home), self.storage_home.joinpath(WAL_FILENAME),
+                             background=False, max_pending=1000)
+        backend.set_many({'currency.balances:a': 1})
+
+        driver = Driver(storage_home=self.storage_home)
+        self.assertNotIsInstance(driver.backend, WALBackend)
+        self.assertEqual(driver.get('currency.balances:a'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()